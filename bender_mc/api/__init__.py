@@ -1,3 +1,6 @@
 from bender_mc.api.video import video_api_blueprint
 from bender_mc.api.media_center import media_center_api_blueprint
 from bender_mc.api.slots import slots_blueprint
+from bender_mc.api.jobs import jobs_blueprint
+from bender_mc.api.metrics import metrics_blueprint
+from bender_mc.api.profiles import profiles_blueprint
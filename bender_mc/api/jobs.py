@@ -0,0 +1,37 @@
+from flask import request, Blueprint, Response
+from bender_mc.api.utils import get_job_manager
+
+
+jobs_blueprint = Blueprint('jobs_blueprint', __name__)
+
+
+@jobs_blueprint.route("", methods=["GET"])
+def jobs_router():
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        limit = 20
+    return {"jobs": [job.to_dict() for job in get_job_manager().recent(limit)]}
+
+
+@jobs_blueprint.route("/<job_id>", methods=["GET"])
+def jobs_job_router(job_id):
+    """Get the status of a job.
+
+    Pass `?wait=seconds` to long poll: the response is held until the
+    job finishes or that many seconds (at most 30) have passed.
+
+    """
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return Response(
+            '{"message": "No such job.", "code": "job_not_found"}',
+            mimetype="application/json",
+            status=404)
+    try:
+        wait = min(float(request.args.get("wait", 0)), 30)
+    except ValueError:
+        wait = 0
+    if wait > 0:
+        job.wait(wait)
+    return job.to_dict()
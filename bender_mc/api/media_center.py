@@ -1,12 +1,19 @@
+import json
 import os
-import subprocess
-import tempfile
 from contextlib import suppress
-from flask import request, Blueprint
-from bender_mc import playsound
+from drowsy.exc import DrowsyError
+from flask import request, Blueprint, Response
 from bender_mc.api.utils import (
-    audio_controller, close_db_sessions, get_rpc_client, load_db_sessions,
-    load_rpc_client)
+    audio_backend_error_handler, close_db_sessions,
+    generic_drowsy_error_handler, get_audio_commands, get_clip_cache,
+    get_playback_service, get_rpc_client, job_accepted_response,
+    jobs_enabled, jobs_full_error_handler, kodi_rpc_error_handler,
+    load_db_sessions, load_rpc_client, playback_error_handler, submit_job)
+from bender_mc.audio_backends import AudioBackendError
+from bender_mc.jobs import JobsFullError
+from bender_mc.kodi.rpc_client import KodiRpcError
+from bender_mc.playback import PlaybackError
+from bender_mc.utils import run_process
 
 
 media_center_api_blueprint = Blueprint('media_center_api_blueprint', __name__)
@@ -23,15 +30,86 @@ def teardown_media_center_api_teardown_request(error):
     close_db_sessions()
 
 
+@media_center_api_blueprint.errorhandler(DrowsyError)
+def media_center_api_error_handler(error):
+    return generic_drowsy_error_handler(error)
+
+
+@media_center_api_blueprint.errorhandler(KodiRpcError)
+def media_center_api_rpc_error_handler(error):
+    return kodi_rpc_error_handler(error)
+
+
+@media_center_api_blueprint.errorhandler(AudioBackendError)
+def media_center_api_audio_error_handler(error):
+    return audio_backend_error_handler(error)
+
+
+@media_center_api_blueprint.errorhandler(PlaybackError)
+def media_center_api_playback_error_handler(error):
+    return playback_error_handler(error)
+
+
+@media_center_api_blueprint.errorhandler(JobsFullError)
+def media_center_api_jobs_full_error_handler(error):
+    return jobs_full_error_handler(error)
+
+
+def enqueue_announcement(data, clip_hash):
+    """Queue `data` to play, with the priority and interruption given
+    in the request's query string."""
+    priority = 0
+    with suppress(ValueError, TypeError):
+        priority = int(request.args.get("priority", 0))
+    interrupt = request.args.get("interrupt", "").lower() in ("1", "true")
+    announcement = get_playback_service().enqueue(
+        data, priority=priority, interrupt=interrupt)
+    if announcement.dropped:
+        return Response(
+            json.dumps({
+                "message": "Announcement queue is full.",
+                "code": "queue_full",
+                "clipHash": clip_hash
+            }),
+            mimetype="application/json",
+            status=503)
+    return {
+        "result": "success",
+        "announcement": announcement.to_dict(),
+        "clipHash": clip_hash
+    }
+
+
 @media_center_api_blueprint.route("/speakers/play", methods=["POST"])
 def media_center_speakers_play():
-    tmpdir = tempfile.TemporaryDirectory()
-    temp_file_path = os.path.join(tmpdir.name, "test.wav")
-    with open(temp_file_path, "wb") as file:
-        file.write(request.data)
-    playsound.playsound(temp_file_path)
-    os.remove(temp_file_path)
-    tmpdir.cleanup()
+    # Queued to play in the background, straight from memory. The clip
+    # is cached, so it can be replayed by hash without uploading it.
+    data = request.get_data()
+    clip_hash = get_clip_cache().put(data)
+    return enqueue_announcement(data, clip_hash)
+
+
+@media_center_api_blueprint.route(
+    "/speakers/play/<clip_hash>", methods=["POST"])
+def media_center_speakers_play_cached(clip_hash):
+    """Play a previously uploaded clip by its SHA-256 hash.
+
+    Responds with a 404 if the clip isn't cached, in which case it
+    should be posted to ``/speakers/play`` instead.
+
+    """
+    data = get_clip_cache().get(clip_hash.lower())
+    if data is None:
+        return Response(
+            '{"message": "Clip not cached.", "code": "clip_not_cached"}',
+            mimetype="application/json",
+            status=404)
+    return enqueue_announcement(data, clip_hash.lower())
+
+
+@media_center_api_blueprint.route("/speakers/stop", methods=["POST"])
+def media_center_speakers_stop():
+    get_playback_service().stop()
     return {"result": "success"}
 
 
@@ -44,26 +122,22 @@ def media_center_speakers_volume_set():
         value = int(value)
     with suppress(ValueError, TypeError):
         amount = int(amount)
-    if str(value).lower() == "mute":
-        audio_controller.mute()
-    elif str(value).lower() == "unmute":
-        audio_controller.unmute()
-    elif str(value).lower() == "dim":
-        audio_controller.dim()
-    elif str(value).lower() == "undim":
-        audio_controller.undim()
+    # Changes are queued and merged with any others arriving around
+    # the same time, rather than applied before responding.
+    audio_commands = get_audio_commands()
+    if str(value).lower() in ("mute", "unmute", "dim", "undim"):
+        audio_commands.submit(str(value).lower())
     else:
         if str(amount).lower() == "a lot":
             amount = 20
         else:
             amount = 10
-        if audio_controller.volume is not None:
-            if str(value).lower() == "decrease":
-                audio_controller.volume = audio_controller.volume - amount
-            elif str(value).lower() == "increase":
-                audio_controller.volume = audio_controller.volume + amount
-            elif isinstance(value, int):
-                audio_controller.volume = value
+        if str(value).lower() == "decrease":
+            audio_commands.submit("adjust", -amount)
+        elif str(value).lower() == "increase":
+            audio_commands.submit("adjust", amount)
+        elif isinstance(value, int):
+            audio_commands.submit("volume", value)
     return {"result": "success"}
 
 
@@ -92,17 +166,25 @@ def media_center_switch_monitor_router():
 @media_center_api_blueprint.route("/rooms/switch", methods=["POST"])
 def media_center_switch_room_router():
     data = request.json
-    room_id = data.get("roomId", None)
+    if jobs_enabled():
+        job = submit_job(
+            "switch_room", switch_room, data.get("roomId", None),
+            callback_url=data.get("callbackUrl"))
+        return job_accepted_response(job)
+    return switch_room(data.get("roomId", None))
+
+
+def switch_room(room_id):
     if room_id == "bedroom":
         arg = "external"
     else:
         arg = "extend"
     script = os.path.join(os.path.dirname(__file__), "..", "scripts", "display_switch.ps1")
-    p = subprocess.Popen(
-        ["powershell.exe", script, arg], stdout=subprocess.PIPE)
-    p.wait()
+    run_process(
+        ["powershell.exe", script, arg], name="display_switch.ps1")
+    audio_commands = get_audio_commands()
     if arg == "external":
-        audio_controller.switch_device("HDMI")
+        audio_commands.submit("switch_device", "HDMI")
     else:
-        audio_controller.switch_device("Speakers")
+        audio_commands.submit("switch_device", "Speakers")
     return {"result": "success"}
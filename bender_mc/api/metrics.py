@@ -0,0 +1,12 @@
+from flask import Blueprint, Response
+from bender_mc.metrics import render
+
+
+metrics_blueprint = Blueprint('metrics_blueprint', __name__)
+
+
+@metrics_blueprint.route("/metrics", methods=["GET"])
+def metrics_router():
+    return Response(
+        render(),
+        mimetype="text/plain; version=0.0.4")
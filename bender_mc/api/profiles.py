@@ -0,0 +1,53 @@
+from flask import request, Blueprint, Response
+from bender_mc.api.utils import get_profiler
+
+
+profiles_blueprint = Blueprint('profiles_blueprint', __name__)
+
+
+def _not_found(message, code):
+    return Response(
+        f'{{"message": "{message}", "code": "{code}"}}',
+        mimetype="application/json",
+        status=404)
+
+
+@profiles_blueprint.route("", methods=["GET"])
+def profiles_router():
+    """List the slowest recently profiled requests."""
+    profiler = get_profiler()
+    if profiler is None:
+        return _not_found("Profiling is not enabled.", "profiling_disabled")
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        limit = 10
+    return {
+        "sampleRate": profiler.sample_rate,
+        "profiles": profiler.slowest(limit)
+    }
+
+
+@profiles_blueprint.route("/<name>", methods=["GET"])
+def profiles_profile_router(name):
+    """Get a pstats text summary of a single profile.
+
+    Pass `?sort=` with any :mod:`pstats` sort key (defaults to
+    cumulative).
+
+    """
+    profiler = get_profiler()
+    if profiler is None:
+        return _not_found("Profiling is not enabled.", "profiling_disabled")
+    if profiler.get(name) is None:
+        return _not_found("No such profile.", "profile_not_found")
+    sort = request.args.get("sort", "cumulative")
+    try:
+        try:
+            summary = profiler.summary(name, sort=sort)
+        except KeyError:
+            summary = profiler.summary(name)
+    except OSError:
+        # Pruned since it was looked up.
+        return _not_found("No such profile.", "profile_not_found")
+    return Response(summary, mimetype="text/plain")
@@ -1,14 +1,20 @@
-import inflect
 import re
+import threading
+from functools import lru_cache
 from drowsy.exc import DrowsyError
 from flask import Blueprint
 from bender_mc.api.utils import (
     close_db_sessions, get_scoped_db_session, generic_drowsy_error_handler,
-    load_db_sessions)
-from bender_mc.kodi.models.video import Movie, TvShow, Episode
+    get_snapshot_publisher, load_db_sessions)
 
 
 slots_blueprint = Blueprint('slots_blueprint', __name__)
+_inflector = None
+_inflector_lock = threading.Lock()
+# Most recently generated video slots, along with the library
+# fingerprint they were generated from.
+_video_slots_cache = {"fingerprint": None, "slots": None}
+_video_slots_lock = threading.Lock()
 
 
 @slots_blueprint.before_request
@@ -26,8 +32,20 @@ def slots_error_handler(error):
     return generic_drowsy_error_handler(error)
 
 
+def get_inflector():
+    """Get a shared inflect engine, importing inflect on first use."""
+    global _inflector
+    if _inflector is None:
+        with _inflector_lock:
+            if _inflector is None:
+                import inflect
+                _inflector = inflect.engine()
+    return _inflector
+
+
+@lru_cache(maxsize=16384)
 def title_to_spoken_text(title):
-    inflector = inflect.engine()
+    inflector = get_inflector()
     manual_mappings = {
         "50/50": "fifty fifty",
         "3:10 to Yuma": "three ten to yuma",
@@ -84,6 +102,7 @@ def title_to_spoken_text(title):
 
 @slots_blueprint.route("/video", methods=["GET"])
 def slots_video_router():
+    from bender_mc.kodi.models.video import Movie, TvShow
     db_session = get_scoped_db_session("video")
     results = {}
     tv_shows = db_session.query(TvShow).all()
@@ -111,6 +130,7 @@ def generate_video_slots(db_session):
         {"kill bill one": "1234_movie"}
 
     """
+    from bender_mc.kodi.models.video import Movie, TvShow, Episode
     # Always have to generate slots for all videos, even if we only
     # care about one particular type.
     # This allows us to handle and avoid collisions
@@ -153,14 +173,59 @@ def generate_video_slots(db_session):
     return movie_results, tv_show_results, episode_results
 
 
+def get_library_snapshot(db_session):
+    """Get the shared library snapshot, republishing it first if the
+    library has changed.
+
+    :return: A :class:`~bender_mc.kodi.snapshot.LibrarySnapshot`, or
+        `None` if snapshots are disabled.
+
+    """
+    from bender_mc.kodi.library import library_fingerprint
+    publisher = get_snapshot_publisher()
+    if publisher is None:
+        return None
+    return publisher.get(
+        db_session, library_fingerprint(db_session), generate_video_slots)
+
+
+def get_video_slots(db_session):
+    """Get the :func:`generate_video_slots` result, cached until the
+    library changes."""
+    snapshot = get_library_snapshot(db_session)
+    if snapshot is not None:
+        return snapshot.video_slots()
+    from bender_mc.kodi.library import library_fingerprint
+    fingerprint = library_fingerprint(db_session)
+    with _video_slots_lock:
+        if _video_slots_cache["fingerprint"] == fingerprint:
+            return _video_slots_cache["slots"]
+        slots = generate_video_slots(db_session)
+        _video_slots_cache["fingerprint"] = fingerprint
+        _video_slots_cache["slots"] = slots
+        return slots
+
+
+def iter_video_slots(db_session, media_type):
+    """Iterate `(spoken_text, converted_value)` slots of a media type,
+    read straight from the library snapshot where possible.
+
+    :param str media_type: ``movie``, ``tvshow``, or ``episode``.
+
+    """
+    snapshot = get_library_snapshot(db_session)
+    if snapshot is not None:
+        return snapshot.iter_slots(media_type)
+    index = ("movie", "tvshow", "episode").index(media_type)
+    return get_video_slots(db_session)[index].items()
+
+
 @slots_blueprint.route("/movies", methods=["GET"])
 def slots_movies_router():
     db_session = get_scoped_db_session("video")
-    results = generate_video_slots(db_session)[0]
     output = ""
-    for key in results:
-        spoken_text = key
-        converted_value = results[key]
+    for spoken_text, converted_value in iter_video_slots(
+            db_session, "movie"):
         output += f"({spoken_text}):({converted_value})\n"
     return output
 
@@ -168,11 +233,9 @@ def slots_movies_router():
 @slots_blueprint.route("/tvShows", methods=["GET"])
 def slots_tv_shows_router():
     db_session = get_scoped_db_session("video")
-    results = generate_video_slots(db_session)[1]
     output = ""
-    for key in results:
-        spoken_text = key
-        converted_value = results[key]
+    for spoken_text, converted_value in iter_video_slots(
+            db_session, "tvshow"):
         output += f"({spoken_text}):({converted_value})\n"
     return output
 
@@ -180,10 +243,8 @@ def slots_tv_shows_router():
 @slots_blueprint.route("/episodes", methods=["GET"])
 def slots_episodes_router():
     db_session = get_scoped_db_session("video")
-    results = generate_video_slots(db_session)[2]
     output = ""
-    for key in results:
-        spoken_text = key
-        converted_value = results[key]
+    for spoken_text, converted_value in iter_video_slots(
+            db_session, "episode"):
         output += f"({spoken_text}):({converted_value})\n"
     return output
@@ -1,28 +1,73 @@
 import json
-from flask import request, url_for, g, current_app, Response
+import logging
+import os
+import threading
+import requests
+from functools import wraps
+from urllib.parse import urlparse
+from flask import (
+    request, url_for, g, current_app, has_request_context, make_response,
+    Response)
 from drowsy.exc import (
     UnprocessableEntityError, BadRequestError, MethodNotAllowedError,
     ResourceNotFoundError
 )
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
-from bender_mc.audio_controller import AudioController
-from bender_mc.browser_controller import BrowserController
-from bender_mc.kodi.rpc_client import KodiRpcClient
+from bender_mc.coalesce import SingleFlight
+from bender_mc.jobs import JobManager
+from bender_mc.metrics import instrument_engine
+from bender_mc.kodi.rpc_client import (
+    CircuitBreaker, KodiRpcClient, KodiTimeoutError, KodiUnavailableError)
+from bender_mc.utils import Deadline
 
 
 # Database session/engine management.
 # Basically rolling our own pseudo Flask-SQLAlchemy
 db_scoped_sessions = {}
 db_engines = {}
-audio_controller = AudioController()
+db_connect_strings = {}
+audio_registry = []
+audio_command_registry = []
+playback_registry = []
+clip_cache_registry = []
 browser_registry = []
+rpc_circuit_breakers = {}
+rpc_sessions = {}
+job_manager_registry = []
+single_flight_registry = []
+profiler_registry = []
+snapshot_registry = []
+# Config sections the registries kept across reloads were built from.
+kept_registry_config = {}
 
+logger = logging.getLogger(__name__)
 
-def set_db_engine(engine_name, connect_string):
-    """Add a database engine connect string to a dict of engines."""
+
+def set_db_engine(engine_name, connect_string, pool_size=None):
+    """Add a database engine connect string to a dict of engines.
+
+    :param int pool_size: If given, keep up to this many connections
+        open in a pool. SQLAlchemy doesn't pool connections to SQLite
+        files by default, which means every request reconnects and
+        reparses the Kodi schema.
+
+    """
+    if db_connect_strings.get(engine_name) != connect_string:
+        # Connect string changed on reload, replace the engine. Requests
+        # in flight keep the session they already checked out.
+        db_engines.pop(engine_name, None)
     if engine_name not in db_engines:
-        db_engines[engine_name] = create_engine(connect_string, echo=False)
+        db_connect_strings[engine_name] = connect_string
+        kwargs = {}
+        if pool_size and connect_string.startswith("sqlite"):
+            kwargs["poolclass"] = QueuePool
+            kwargs["pool_size"] = pool_size
+            kwargs["connect_args"] = {"check_same_thread": False}
+        db_engines[engine_name] = create_engine(
+            connect_string, echo=False, **kwargs)
+        instrument_engine(db_engines[engine_name], engine_name)
         db_scoped_sessions[engine_name] = scoped_session(sessionmaker(
             bind=db_engines[engine_name], autoflush=True, autocommit=False))
 
@@ -33,6 +78,12 @@ def get_db_engine(engine_name):
         return db_engines[engine_name]
 
 
+def dispose_db_engines():
+    """Close every pooled database connection, e.g. before forking."""
+    for engine in db_engines.values():
+        engine.dispose()
+
+
 def configure_scoped_db_session(engine_name):
     """Returns a scoped db session for this engine."""
     if engine_name in db_engines and engine_name in db_scoped_sessions:
@@ -90,27 +141,208 @@ def close_db_sessions():
                 db_sessions[key].remove()
 
 
+# Request deadline setup
+def load_deadline():
+    """Attach a latency budget for the current request to `g`.
+
+    The budget defaults to `request_budget` seconds from the
+    `[api_server]` config section, and may be lowered (but never
+    raised) by a client supplied `X-Request-Timeout` header.
+
+    """
+    if not hasattr(g, "deadline"):
+        budget = current_app.config.get(
+            "api_server", {}).get("request_budget", 30)
+        header = None
+        if has_request_context():
+            header = request.headers.get("X-Request-Timeout")
+        if header:
+            try:
+                requested = float(header)
+            except ValueError:
+                requested = None
+            if requested is not None and requested > 0:
+                budget = requested if budget is None else min(
+                    budget, requested)
+        g.deadline = Deadline(budget)
+
+
+def get_deadline():
+    return getattr(g, "deadline", None)
+
+
 # Rpc Client Setup
+def get_rpc_circuit_breaker(config):
+    """Get the circuit breaker shared by all clients for this Kodi."""
+    url = config["kodirpc"]["url"]
+    if url not in rpc_circuit_breakers:
+        rpc_circuit_breakers[url] = CircuitBreaker(
+            failure_threshold=config["kodirpc"].get("breaker_threshold", 3),
+            reset_timeout=config["kodirpc"].get("breaker_reset", 15))
+    return rpc_circuit_breakers[url]
+
+
+def get_rpc_session(config):
+    """Get the HTTP session shared by all clients for this Kodi.
+
+    Sharing it keeps the connection to Kodi alive between requests.
+
+    """
+    url = config["kodirpc"]["url"]
+    if url not in rpc_sessions:
+        rpc_sessions[url] = requests.Session()
+    return rpc_sessions[url]
+
+
 def load_rpc_client():
     config = current_app.config
+    load_deadline()
     if not hasattr(g, "rpc_client"):
         g.rpc_client = KodiRpcClient(
             base_url=config["kodirpc"]["url"],
             username=config["kodirpc"]["username"],
-            password=config["kodirpc"]["password"])
+            password=config["kodirpc"]["password"],
+            timeout=config["kodirpc"].get("timeout", 5),
+            connect_timeout=config["kodirpc"].get("connect_timeout", 2),
+            deadline=get_deadline(),
+            circuit_breaker=get_rpc_circuit_breaker(config),
+            session=get_rpc_session(config))
 
 
 def get_rpc_client():
     return getattr(g, "rpc_client", None)
 
 
+# Controllers are created on first use, since they're slow to set up
+# (spawning processes, importing selenium) and may never be needed.
+_controller_lock = threading.Lock()
+
+
+def _remember_config(config, *sections):
+    """Record the config `sections` a kept registry entry used, see
+    :func:`warn_unapplied_config`."""
+    for section in sections:
+        kept_registry_config[section] = dict(config.get(section, {}))
+
+
+# audio controller setup
+def get_audio_controller():
+    if not audio_registry:
+        with _controller_lock:
+            if not audio_registry:
+                from bender_mc.audio_backends import get_audio_backend
+                from bender_mc.audio_controller import AudioController
+                _remember_config(current_app.config, "audio")
+                config = current_app.config.get("audio", {})
+                backend = get_audio_backend(config.get("backend", "auto"))
+                audio_registry.append(AudioController(
+                    backend=backend,
+                    reconcile_interval=config.get("reconcile_interval", 30),
+                    fade_duration=config.get("fade_duration", 1.5),
+                    dim_volume=config.get("dim_volume", 10)))
+    return audio_registry[-1]
+
+
+def get_audio_commands():
+    """Get the queue that audio changes should be submitted to.
+
+    :return: An :class:`~bender_mc.audio_commands.AudioCommandQueue`
+        driving the audio controller.
+
+    """
+    if not audio_command_registry:
+        controller = get_audio_controller()
+        with _controller_lock:
+            if not audio_command_registry:
+                from bender_mc.audio_commands import AudioCommandQueue
+                _remember_config(current_app.config, "audio")
+                config = current_app.config.get("audio", {})
+                audio_command_registry.append(AudioCommandQueue(
+                    controller,
+                    merge_window=config.get("merge_window", .05)))
+    return audio_command_registry[-1]
+
+
+def get_playback_service():
+    """Get the service that announcements should be queued on.
+
+    :return: A :class:`~bender_mc.playback.PlaybackService`.
+
+    """
+    if not playback_registry:
+        with _controller_lock:
+            if not playback_registry:
+                from bender_mc.playback import PlaybackService, get_player
+                _remember_config(current_app.config, "playback")
+                config = current_app.config.get("playback", {})
+                playback_registry.append(PlaybackService(
+                    player=get_player(config.get("player", "auto")),
+                    max_queued=config.get("max_queued", 50)))
+    return playback_registry[-1]
+
+
+def get_clip_cache():
+    """Get the cache of recently played announcement clips.
+
+    :return: A :class:`~bender_mc.clip_cache.ClipCache`, spilling to
+        disk unless disabled in the `[clip_cache]` config.
+
+    """
+    if not clip_cache_registry:
+        with _controller_lock:
+            if not clip_cache_registry:
+                from bender_mc.clip_cache import ClipCache
+                config = current_app.config
+                _remember_config(config, "clip_cache")
+                cache_config = config.get("clip_cache", {})
+                spill_dir = None
+                if cache_config.get("spill", True):
+                    spill_dir = cache_config.get("spill_dir") or os.path.join(
+                        config["global"]["user_data_path"], "clips")
+                clip_cache_registry.append(ClipCache(
+                    max_bytes=cache_config.get(
+                        "max_bytes", 32 * 1024 * 1024),
+                    spill_dir=spill_dir,
+                    max_spill_bytes=cache_config.get(
+                        "max_spill_bytes", 256 * 1024 * 1024)))
+    return clip_cache_registry[-1]
+
+
 # browser controller setup
 def load_browser_controller():
     if not browser_registry:
-        config = current_app.config
-        ublock_path = config["browser"]["ublock_path"]
-        browser_registry.append(
-            BrowserController(extension_paths=[ublock_path]))
+        with _controller_lock:
+            if not browser_registry:
+                config = current_app.config
+                _remember_config(config, "browser", "nba")
+                browser_config = config["browser"]
+                ublock_path = browser_config["ublock_path"]
+                if browser_config.get("isolate", True):
+                    # Keeps Chrome and Selenium out of this process.
+                    from bender_mc.browser_worker import BrowserWorker
+                    browser_controller = BrowserWorker(
+                        extension_paths=[ublock_path],
+                        max_rss_mb=browser_config.get("max_rss_mb", 2048),
+                        max_cpu_percent=browser_config.get(
+                            "max_cpu_percent"),
+                        watchdog_interval=browser_config.get(
+                            "watchdog_interval", 10),
+                        command_timeout=browser_config.get(
+                            "command_timeout", 120))
+                else:
+                    from bender_mc.browser_controller import (
+                        BrowserController)
+                    browser_controller = BrowserController(
+                        extension_paths=[ublock_path])
+                if browser_config.get("standby", False):
+                    browser_controller.start_standby(
+                        username=config["nba"]["username"],
+                        password=config["nba"]["password"],
+                        recycle_interval=browser_config.get(
+                            "recycle_interval", 14400),
+                        check_interval=browser_config.get(
+                            "health_check_interval", 60))
+                browser_registry.append(browser_controller)
     g.browser_controller = browser_registry[-1]
 
 
@@ -118,6 +350,246 @@ def get_browser_controller():
     return getattr(g, "browser_controller", None)
 
 
+# Background job setup
+def get_job_manager():
+    if not job_manager_registry:
+        with _controller_lock:
+            if not job_manager_registry:
+                _remember_config(current_app.config, "jobs")
+                config = current_app.config.get("jobs", {})
+                job_manager_registry.append(JobManager(
+                    max_workers=config.get("workers", 4),
+                    max_retained=config.get("retained", 200)))
+    return job_manager_registry[-1]
+
+
+def jobs_enabled():
+    """Whether long running actions should be run as background jobs.
+
+    Enabled unless turned off with `enabled = False` in the `[jobs]`
+    config section, or the request asks for `?sync=true`.
+
+    """
+    if request.args.get("sync", "").lower() in ("1", "true", "yes"):
+        return False
+    return current_app.config.get("jobs", {}).get("enabled", True)
+
+
+def submit_job(name, func, *args, callback_url=None, group=None,
+               **kwargs):
+    """Queue `func` to run in the background with an app context.
+
+    The job gets the same db sessions and rpc client a request would,
+    along with its own deadline (`budget` from the `[jobs]` config
+    section). If `callback_url` is given, the finished job's status is
+    POSTed to it.
+
+    Unless coalescing is turned off in the `[api_server]` config
+    section, a duplicate of a request (see
+    :func:`request_fingerprint`) whose job hasn't finished gets that
+    job rather than queuing another, so retried voice commands only
+    run once.
+
+    :param str callback_url: Optional url on one of the hosts listed
+        in `callback_hosts` in the `[jobs]` config section.
+    :param str group: Optional shared resource the job uses, such as
+        ``browser``, which only one job may use at a time.
+    :return: The queued :class:`~bender_mc.jobs.Job`.
+    :raise BadRequestError: If `callback_url` isn't allowed.
+    :raise JobConflictError: If another job in `group` is unfinished.
+    :raise JobsFullError: If too many jobs are unfinished.
+
+    """
+    app = current_app._get_current_object()
+    jobs_config = app.config.get("jobs", {})
+    budget = jobs_config.get("budget", 120)
+    if callback_url:
+        # Otherwise any client could have the server post to any url.
+        allowed_hosts = [
+            host.lower() for host in jobs_config.get("callback_hosts") or []]
+        parsed = urlparse(callback_url)
+        if parsed.scheme not in ("http", "https") or (
+                parsed.hostname not in allowed_hosts):
+            raise BadRequestError(
+                code="callback_not_allowed",
+                message=(
+                    "callbackUrl must be an http url on one of the "
+                    "configured callback hosts."))
+
+    def run_job():
+        with app.app_context():
+            g.deadline = Deadline(budget)
+            load_db_sessions()
+            load_rpc_client()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_db_sessions()
+
+    on_finished = None
+    if callback_url:
+        def on_finished(job):
+            try:
+                requests.post(callback_url, json=job.to_dict(), timeout=5)
+            except requests.RequestException:
+                pass
+    key = None
+    if app.config.get("api_server", {}).get("coalesce", True):
+        key = request_fingerprint()
+    return get_job_manager().submit(
+        name, run_job, on_finished=on_finished, group=group, key=key)
+
+
+def job_accepted_response(job):
+    """Build a 202 response pointing at the status of `job`."""
+    location = url_for("jobs_blueprint.jobs_job_router", job_id=job.id)
+    return job.to_dict(), 202, {"Location": location}
+
+
+def reset_config_registries():
+    """Forget registry entries built from config that may have changed.
+
+    Used when reloading, so the new config takes effect. The audio,
+    playback and browser controllers, clip cache and job manager are
+    kept, since replacing them would cut off whatever they're doing;
+    see :func:`warn_unapplied_config`. HTTP sessions are kept too.
+
+    """
+    del single_flight_registry[:]
+    del profiler_registry[:]
+    del snapshot_registry[:]
+    rpc_circuit_breakers.clear()
+
+
+def warn_unapplied_config(config):
+    """Log each changed config section that a kept registry entry was
+    built from, since those changes need a restart.
+
+    :param config: The reloaded app's config.
+    :return: Names of the sections that changed.
+
+    """
+    changed = sorted(
+        section for section, values in kept_registry_config.items()
+        if dict(config.get(section, {})) != values)
+    for section in changed:
+        logger.warning(
+            f"Changes to [{section}] can't be applied without a restart.")
+    return changed
+
+
+# Shared library snapshot
+def get_snapshot_publisher():
+    """Get this process's library snapshot publisher.
+
+    :return: A :class:`~bender_mc.kodi.snapshot.SnapshotPublisher`, or
+        `None` if snapshots are disabled in the `[snapshot]` config.
+
+    """
+    if not snapshot_registry:
+        config = current_app.config
+        snapshot_config = config.get("snapshot", {})
+        publisher = None
+        if snapshot_config.get("enabled", True):
+            from bender_mc.kodi.snapshot import SnapshotPublisher
+            path = snapshot_config.get("path") or os.path.join(
+                config["global"]["user_data_path"], "library.snapshot")
+            publisher = SnapshotPublisher(path)
+        snapshot_registry.append(publisher)
+    return snapshot_registry[-1]
+
+
+# Duplicate request coalescing
+def get_single_flight():
+    if not single_flight_registry:
+        with _controller_lock:
+            if not single_flight_registry:
+                single_flight_registry.append(SingleFlight())
+    return single_flight_registry[-1]
+
+
+def request_fingerprint():
+    """Get a key identifying duplicates of the current request.
+
+    Requests are duplicates if they hit the same endpoint with the
+    same method, query string and body. JSON bodies are compared by
+    value, so key order and formatting don't matter.
+
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = request.get_data(as_text=True)
+    return json.dumps([
+        request.endpoint,
+        request.method,
+        sorted(request.args.items(multi=True)),
+        data
+    ], sort_keys=True)
+
+
+def coalesce_requests(func):
+    """Decorator letting simultaneous duplicate requests share one
+    execution of a view.
+
+    Duplicates (see :func:`request_fingerprint`) that arrive while the
+    view is running receive a copy of its response instead of running
+    again, waiting no longer than the request deadline. Their
+    responses are marked with an `X-Coalesced` header. Requests
+    arriving after it finished always run, so repeated commands aren't
+    lost. Views run as jobs are deduplicated by :func:`submit_job`
+    instead, since their responses are sent straight away.
+
+    """
+    def respond(*args, **kwargs):
+        # Shared as plain values, so each request builds its own
+        # response that the others' after request hooks can't touch.
+        response = make_response(func(*args, **kwargs))
+        return response.get_data(), response.status, list(response.headers)
+
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if not current_app.config.get("api_server", {}).get("coalesce", True):
+            return func(*args, **kwargs)
+        load_deadline()
+        deadline = get_deadline()
+        try:
+            result, shared = get_single_flight().do(
+                request_fingerprint(), respond, *args,
+                timeout=deadline.remaining() if deadline else None,
+                **kwargs)
+        except TimeoutError:
+            result = None
+            if request.method.upper() != "HEAD":
+                result = json.dumps({
+                    "message": (
+                        "Request deadline passed waiting for a duplicate "
+                        "request."),
+                    "code": "deadline_exceeded"
+                })
+            return Response(
+                result,
+                mimetype="application/json",
+                status=504)
+        data, status, headers = result
+        response = current_app.response_class(
+            data, status=status, headers=headers)
+        if shared:
+            response.headers["X-Coalesced"] = "true"
+        return response
+    return inner
+
+
+# Profiler setup
+def set_profiler(profiler):
+    profiler_registry.append(profiler)
+
+
+def get_profiler():
+    if profiler_registry:
+        return profiler_registry[-1]
+    return None
+
+
 def ensure_kodi():
     """Make sure Kodi is running and bring to front of screen."""
     pass
@@ -130,6 +602,78 @@ def url_for_other_page(page):
     args['page'] = page
     return url_for(request.endpoint, **args)
 
+
+def kodi_rpc_error_handler(error):
+    """Turn a failed Kodi RPC call into a 502, 503 or 504 response."""
+    if isinstance(error, KodiTimeoutError):
+        status = 504
+    elif isinstance(error, KodiUnavailableError):
+        status = 503
+    else:
+        status = 502
+    result = None
+    if request.method.upper() != "HEAD":
+        result = json.dumps({"message": error.message, "code": error.code})
+    return Response(
+        result,
+        mimetype="application/json",
+        status=status)
+
+
+def playback_error_handler(error):
+    """Turn a player that can't be used into a 503 response."""
+    result = None
+    if request.method.upper() != "HEAD":
+        result = json.dumps(
+            {"message": str(error), "code": "playback_unavailable"})
+    return Response(
+        result,
+        mimetype="application/json",
+        status=503)
+
+
+def audio_backend_error_handler(error):
+    """Turn a failed audio backend call into a 503 response."""
+    result = None
+    if request.method.upper() != "HEAD":
+        result = json.dumps(
+            {"message": str(error), "code": "audio_unavailable"})
+    return Response(
+        result,
+        mimetype="application/json",
+        status=503)
+
+
+def job_conflict_error_handler(error):
+    """Turn a job rejected for its busy group into a 409 response
+    pointing at the job that's in the way."""
+    result = None
+    if request.method.upper() != "HEAD":
+        result = json.dumps({
+            "message": str(error),
+            "code": "job_conflict",
+            "jobId": error.job.id
+        })
+    location = url_for("jobs_blueprint.jobs_job_router", job_id=error.job.id)
+    return Response(
+        result,
+        mimetype="application/json",
+        status=409,
+        headers={"Location": location})
+
+
+def jobs_full_error_handler(error):
+    """Turn a job refused because too many are unfinished into a 503
+    response."""
+    result = None
+    if request.method.upper() != "HEAD":
+        result = json.dumps({"message": str(error), "code": "jobs_full"})
+    return Response(
+        result,
+        mimetype="application/json",
+        status=503)
+
+
 def generic_drowsy_error_handler(error):
     if error:
         errors = None
@@ -1,24 +1,27 @@
 import json
 import os
-import pytz
-import statsapi
-import subprocess
 from datetime import datetime, timedelta
 from drowsy.exc import BadRequestError, DrowsyError
-from drowsy.resource import ResourceCollection
-from drowsy.router import ModelResourceRouter
 from flask import current_app, request, Blueprint, Response
 from sqlalchemy import Integer
 from bender_mc.api.utils import (
-    close_db_sessions, generic_drowsy_error_handler, get_browser_controller,
-    get_rpc_client, get_scoped_db_session, load_browser_controller,
-    load_db_sessions, load_rpc_client, url_for_other_page)
-from bender_mc.kodi.resources.video import *
-from bender_mc.kodi.models.video import Movie, TvShow, Episode, File, Bookmark
-from bender_mc.utils import deformat_title
+    close_db_sessions, coalesce_requests, generic_drowsy_error_handler,
+    get_browser_controller, get_job_manager, get_rpc_client,
+    get_scoped_db_session, job_accepted_response, job_conflict_error_handler,
+    jobs_enabled, jobs_full_error_handler, kodi_rpc_error_handler,
+    load_browser_controller, load_db_sessions, load_rpc_client, submit_job,
+    url_for_other_page)
+from bender_mc import metrics
+from bender_mc.jobs import JobConflictError, JobsFullError
+from bender_mc.kodi.rpc_client import KodiRpcError
+from bender_mc.utils import deformat_title, run_process
 
 
 def find_next_episode(db_session, tv_show=None, episode=None):
+    from bender_mc.kodi.models.video import Episode, File, Bookmark
+    # Queried directly rather than from the library snapshot, which
+    # watching anything invalidates, so this stays a few indexed
+    # lookups.
     if not episode:
         # Find the most recently played bookmarked episode
         bookmarked_file = db_session.query(File).filter(
@@ -84,7 +87,6 @@ video_api_blueprint = Blueprint('video_api_blueprint', __name__)
 def before_video_api_request():
     load_db_sessions()
     load_rpc_client()
-    load_browser_controller()
 
 
 @video_api_blueprint.teardown_request
@@ -97,7 +99,23 @@ def video_api_error_handler(error):
     return generic_drowsy_error_handler(error)
 
 
+@video_api_blueprint.errorhandler(KodiRpcError)
+def video_api_rpc_error_handler(error):
+    return kodi_rpc_error_handler(error)
+
+
+@video_api_blueprint.errorhandler(JobConflictError)
+def video_api_job_conflict_error_handler(error):
+    return job_conflict_error_handler(error)
+
+
+@video_api_blueprint.errorhandler(JobsFullError)
+def video_api_jobs_full_error_handler(error):
+    return jobs_full_error_handler(error)
+
+
 @video_api_blueprint.route("/player/state", methods=["POST"])
+@coalesce_requests
 def video_player_state_router():
     action = request.data.decode("utf-8")
     rpc_client = get_rpc_client()
@@ -119,10 +137,51 @@ def video_player_queue_router():
 
 
 @video_api_blueprint.route("/player/media", methods=["POST"])
+@coalesce_requests
 def video_player_media_router():
+    """Play a movie, show, episode, or game.
+
+    Runs as a background job by default, immediately returning a 202
+    response pointing at the job's status. Pass `?sync=true` to wait
+    for playback to start instead.
+
+    """
+    data = request.json
+    # There's only the one browser, so only one game may be started at
+    # a time.
+    group = "browser" if media_type_of(data) == "nba" else None
+    if jobs_enabled():
+        job = submit_job(
+            "play_media", play_media, data,
+            callback_url=data.get("callbackUrl"), group=group)
+        return job_accepted_response(job)
+    if group is not None:
+        # Held like a job's, so nothing else drives the browser
+        # meanwhile.
+        with get_job_manager().reserve("play_media", group):
+            return play_media(data)
+    return play_media(data)
+
+
+def media_type_of(data):
+    """Get the media type a `/player/media` body asks for, if any."""
+    media_combo_id = data.get("mediaComboId", None)
+    if media_combo_id and "-" in media_combo_id:
+        return media_combo_id.split("-")[1]
+    return data.get("mediaType", None)
+
+
+def play_media(data):
+    """Find and play the media described by a `/player/media` body.
+
+    Needs db sessions and an rpc client loaded for the current
+    request or job.
+
+    """
+    from bender_mc.kodi.models.video import Movie, TvShow, Episode
+    load_browser_controller()
     db_session = get_scoped_db_session("video")
     rpc_client = get_rpc_client()
-    data = request.json
     media_id = data.get("mediaId", None)
     media_type = data.get("mediaType", None)
     media_title = data.get("mediaTitle", None)
@@ -152,10 +211,9 @@ def video_player_media_router():
             script = os.path.join(
                 os.path.dirname(__file__), "..", "scripts",
                 "bring_to_front.ps1")
-            p = subprocess.Popen(
-                ["powershell.exe", script], stdout=subprocess.PIPE)
-            p.wait()
-            browser_controller.close_driver()
+            run_process(["powershell.exe", script], name="bring_to_front.ps1")
+            with metrics.timed("browser", "release"):
+                browser_controller.release()
         if media_type == "tvshow":
             tv_show = db_session.query(TvShow).filter(
                 TvShow.id_show == media_id).first()
@@ -187,11 +245,12 @@ def video_player_media_router():
             attempts = 2
             while attempts > 0:
                 attempts += -1
-                result = browser_controller.play_nba_game(
-                    username=current_app.config["nba"]["username"],
-                    password=current_app.config["nba"]["password"],
-                    team=media_id
-                )
+                with metrics.timed("browser", "play_nba_game"):
+                    result = browser_controller.play_nba_game(
+                        username=current_app.config["nba"]["username"],
+                        password=current_app.config["nba"]["password"],
+                        team=media_id
+                    )
                 if result:
                     attempts = 0
             return {"result": "success"}
@@ -253,15 +312,19 @@ def video_player_media_router():
             for bookmark in episode.file.bookmarks:
                 if bookmark.type == 1:
                     resume_time = bookmark.time_in_seconds
-        if queue_next:
+        if queue_next and episode is not None:
+            # queue up the following episodes in watch order
             media_id = [media_id]
             last_episode = episode
             for i in range(0, queue_next):
-                # try next episode of this season
-                next_up = find_next_episode(db_session, episode=last_episode)
-                media_id.append(next_up)
+                next_up = find_next_episode(
+                    db_session, tv_show=last_episode.tv_show,
+                    episode=last_episode)
+                if next_up is None or next_up.id_episode in media_id:
+                    # ran out of episodes and looped back around
+                    break
+                media_id.append(next_up.id_episode)
                 last_episode = next_up
-        # multi episode here...
     if media_id is not None and media_type is not None:
         rpc_client.play_video(
             media_id=media_id, media_type=media_type, resume_time=resume_time)
@@ -285,6 +348,11 @@ def api_router(path):
     routing, querying, and updating automatically.
 
     """
+    # Resources register themselves with drowsy when first imported,
+    # which is slow, so wait until the router is actually used.
+    from drowsy.resource import ResourceCollection
+    from drowsy.router import ModelResourceRouter
+    import bender_mc.kodi.resources.video
     # get your SQLAlchemy db session however you normally would
     db_session = get_scoped_db_session("video")
     # This should be some context related to the current request.
@@ -346,6 +414,8 @@ def api_router(path):
 
 
 def mlb_game_info():
+    import pytz
+    import statsapi
     mlb_date = datetime.now(pytz.timezone('US/Eastern'))
     mlb_hour = mlb_date.strftime('%H')
     if int(mlb_hour) < 3:
@@ -0,0 +1,387 @@
+"""
+    bender_mc.audio_backends
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Platform specific ways of controlling the media center's audio
+    devices, used by :class:`~bender_mc.audio_controller.AudioController`.
+
+    Volumes are percentages from 0 to 100.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from contextlib import suppress
+from drowsy.log import Loggable
+from bender_mc.utils import check_process_output, run_process
+
+
+class AudioBackendError(Exception):
+
+    """Raised when the audio system can't be reached or controlled."""
+
+
+class AudioBackend(Loggable):
+
+    """Interface for controlling audio output devices.
+
+    Devices are identified by name, as shown to users (e.g.
+    ``Speakers`` or ``HDMI``).
+
+    """
+
+    name = None
+
+    def default_device(self):
+        """Get the name of the current default output device."""
+        raise NotImplementedError
+
+    def set_default_device(self, device):
+        raise NotImplementedError
+
+    def get_volume(self, device):
+        raise NotImplementedError
+
+    def set_volume(self, device, volume):
+        raise NotImplementedError
+
+    def get_mute(self, device):
+        """Whether `device` is muted, or `None` if unknown."""
+        raise NotImplementedError
+
+    def set_mute(self, device, muted):
+        raise NotImplementedError
+
+    def subscribe(self, callback):
+        """Ask to be told when device, volume or mute state changes.
+
+        `callback` is called with no arguments, from any thread, after
+        something may have changed, including changes made outside of
+        this process.
+
+        :return: `True` if change notifications are supported, or
+            `False` if the state must be polled instead.
+
+        """
+        return False
+
+    def close(self):
+        """Release any connection held to the audio system."""
+
+
+class FakeAudioBackend(AudioBackend):
+
+    """In memory backend, for testing without real audio devices.
+
+    Every call made is recorded in `calls`.
+
+    :param devices: Names of the devices to pretend exist.
+    :param float latency: Seconds each call should take.
+
+    """
+
+    name = "fake"
+
+    def __init__(self, devices=("Speakers", "HDMI"), latency=0.0):
+        self.devices = {
+            device: {"volume": 50.0, "muted": False} for device in devices}
+        self.default = devices[0]
+        self.latency = latency
+        self.calls = []
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def _call(self, name, *args):
+        with self._lock:
+            self.calls.append((name, ) + args)
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+    def _device(self, device):
+        try:
+            return self.devices[device]
+        except KeyError:
+            raise AudioBackendError(f"No such audio device: {device}")
+
+    def default_device(self):
+        self._call("default_device")
+        return self.default
+
+    def set_default_device(self, device):
+        self._call("set_default_device", device)
+        self._device(device)
+        self.default = device
+
+    def get_volume(self, device):
+        self._call("get_volume", device)
+        return self._device(device)["volume"]
+
+    def set_volume(self, device, volume):
+        self._call("set_volume", device, volume)
+        self._device(device)["volume"] = float(volume)
+
+    def get_mute(self, device):
+        self._call("get_mute", device)
+        return self._device(device)["muted"]
+
+    def set_mute(self, device, muted):
+        self._call("set_mute", device, muted)
+        self._device(device)["muted"] = bool(muted)
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+        return True
+
+    def simulate_change(self, device=None, volume=None, muted=None):
+        """Change state as if another program had, and notify
+        subscribers.
+
+        :param device: Device to change, or make the default if no
+            `volume` or `muted` is given.
+
+        """
+        if device is not None and volume is None and muted is None:
+            self._device(device)
+            self.default = device
+        else:
+            state = self._device(device or self.default)
+            if volume is not None:
+                state["volume"] = float(volume)
+            if muted is not None:
+                state["muted"] = bool(muted)
+        for callback in list(self.listeners):
+            callback()
+
+
+class SoundVolumeViewBackend(AudioBackend):
+
+    """Windows backend driving NirSoft's SoundVolumeView.exe.
+
+    Every call runs a process, so this is slow; prefer a persistent
+    backend where one is available.
+
+    Depends on SoundVolumeView.exe being in your path.
+
+    """
+
+    name = "soundvolumeview"
+
+    def __init__(self, exe_path=None):
+        self.exe_path = (
+            exe_path or shutil.which("SoundVolumeView.exe") or
+            "SoundVolumeView.exe")
+
+    def _run(self, *args):
+        run_process([self.exe_path, *args], name="SoundVolumeView.exe")
+
+    def default_device(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            audio_json = os.path.join(tmpdirname, "audio.json")
+            self._run("/sjson", audio_json)
+            with open(audio_json, "rb") as f:
+                data = json.load(f)
+        for row in data:
+            if row["Default"] == "Render":
+                return row["Name"]
+        return None
+
+    def set_default_device(self, device):
+        self._run("/SetDefault", device)
+
+    def get_volume(self, device):
+        output = check_process_output(
+            ["getvolume.bat", device],  # TODO - script loc
+            name="getvolume.bat", shell=True)
+        return .1 * int(output.decode().split("\r\n")[-2])
+
+    def set_volume(self, device, volume):
+        self._run("/SetVolume", device, str(volume))
+
+    def get_mute(self, device):
+        return None
+
+    def set_mute(self, device, muted):
+        self._run("/Mute" if muted else "/Unmute", device)
+
+
+class PulseAudioBackend(AudioBackend):
+
+    """Linux backend for PulseAudio, or PipeWire's PulseAudio server.
+
+    Holds a single connection to the sound server through the optional
+    `pulsectl` package, so each call is a quick local IPC round trip
+    rather than a process spawn. The connection is reopened if it
+    drops.
+
+    Devices can be referred to by sink name or description.
+
+    Subscribers are notified of sink and server changes by a listener
+    thread with its own connection, as a connection can't be used for
+    anything else while it waits for events.
+
+    """
+
+    name = "pulseaudio"
+
+    def __init__(self, client_name="bender-mc"):
+        try:
+            import pulsectl
+        except ImportError as exc:
+            raise AudioBackendError(
+                "The pulsectl package is required for PulseAudio "
+                "support.") from exc
+        self._pulsectl = pulsectl
+        self.client_name = client_name
+        self._pulse = None
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._listener_thread = None
+        self._closed = threading.Event()
+        self._changed = False
+
+    def _connection(self):
+        if self._pulse is None:
+            try:
+                self._pulse = self._pulsectl.Pulse(self.client_name)
+            except self._pulsectl.PulseError as exc:
+                raise AudioBackendError(
+                    f"Unable to connect to PulseAudio: {exc}") from exc
+        return self._pulse
+
+    def _call(self, func):
+        """Run `func` with the connection, reconnecting once if the
+        connection has dropped."""
+        with self._lock:
+            for attempt in range(2):
+                pulse = self._connection()
+                try:
+                    return func(pulse)
+                except self._pulsectl.PulseDisconnected:
+                    self.close()
+                    if attempt:
+                        raise AudioBackendError(
+                            "Lost connection to PulseAudio.")
+                except self._pulsectl.PulseError as exc:
+                    raise AudioBackendError(str(exc)) from exc
+
+    @staticmethod
+    def _sink(pulse, device):
+        for sink in pulse.sink_list():
+            if device in (sink.name, sink.description):
+                return sink
+        lowered = device.lower()
+        for sink in pulse.sink_list():
+            if lowered in sink.description.lower():
+                return sink
+        raise AudioBackendError(f"No such audio device: {device}")
+
+    def default_device(self):
+        def default_device(pulse):
+            name = pulse.server_info().default_sink_name
+            for sink in pulse.sink_list():
+                if sink.name == name:
+                    return sink.description
+            return name
+        return self._call(default_device)
+
+    def set_default_device(self, device):
+        self._call(lambda pulse: pulse.default_set(self._sink(pulse, device)))
+
+    def get_volume(self, device):
+        return self._call(
+            lambda pulse: round(
+                self._sink(pulse, device).volume.value_flat * 100, 2))
+
+    def set_volume(self, device, volume):
+        self._call(lambda pulse: pulse.volume_set_all_chans(
+            self._sink(pulse, device), volume / 100))
+
+    def get_mute(self, device):
+        return self._call(lambda pulse: bool(self._sink(pulse, device).mute))
+
+    def set_mute(self, device, muted):
+        self._call(lambda pulse: pulse.mute(
+            self._sink(pulse, device), bool(muted)))
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+            if self._listener_thread is None:
+                self._listener_thread = threading.Thread(
+                    target=self._listen, name="bender-mc-pulse-events",
+                    daemon=True)
+                self._listener_thread.start()
+        return True
+
+    def _on_event(self, event):
+        self._changed = True
+        # Stop listening, so subscribers can be notified outside of
+        # pulsectl's event loop.
+        raise self._pulsectl.PulseLoopStop
+
+    def _listen(self):
+        while not self._closed.is_set():
+            try:
+                with self._pulsectl.Pulse(
+                        f"{self.client_name}-events") as pulse:
+                    pulse.event_mask_set("sink", "server")
+                    pulse.event_callback_set(self._on_event)
+                    while not self._closed.is_set():
+                        self._changed = False
+                        pulse.event_listen(timeout=1)
+                        if self._changed:
+                            for callback in list(self._listeners):
+                                try:
+                                    callback()
+                                except Exception:
+                                    self.logger.exception(
+                                        "Audio change callback failed.")
+            except self._pulsectl.PulseError:
+                self.logger.warning(
+                    "Lost PulseAudio event connection, retrying.",
+                    exc_info=True)
+                # Changes may have been missed while disconnected.
+                for callback in list(self._listeners):
+                    with suppress(Exception):
+                        callback()
+                self._closed.wait(5)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self._pulse is not None:
+                try:
+                    self._pulse.close()
+                finally:
+                    self._pulse = None
+
+
+AUDIO_BACKENDS = {
+    FakeAudioBackend.name: FakeAudioBackend,
+    SoundVolumeViewBackend.name: SoundVolumeViewBackend,
+    PulseAudioBackend.name: PulseAudioBackend
+}
+
+
+def get_audio_backend(name="auto"):
+    """Create an audio backend by name.
+
+    :param str name: One of :data:`AUDIO_BACKENDS`, or ``auto`` to pick
+        the one for this platform.
+    :raise AudioBackendError: If the backend can't be used here.
+
+    """
+    if name in (None, "auto"):
+        if sys.platform.startswith("win"):
+            name = SoundVolumeViewBackend.name
+        else:
+            name = PulseAudioBackend.name
+    try:
+        backend_cls = AUDIO_BACKENDS[name]
+    except KeyError:
+        raise AudioBackendError(f"Unknown audio backend: {name}")
+    return backend_cls()
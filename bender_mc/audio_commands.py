@@ -0,0 +1,160 @@
+"""
+    bender_mc.audio_commands
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Serializes audio changes through a single worker thread, merging
+    bursts of commands into as few backend calls as possible.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import queue
+import threading
+import time
+from drowsy.log import Loggable
+
+# Command name -> number of arguments it takes.
+COMMANDS = {
+    "adjust": 1,
+    "volume": 1,
+    "mute": 0,
+    "unmute": 0,
+    "dim": 0,
+    "undim": 0,
+    "switch_device": 1
+}
+
+
+def merge_commands(commands, muted=None):
+    """Reduce a sequence of audio commands to an equivalent shorter one.
+
+    Consecutive volume changes are combined (five ``("adjust", 10)``
+    become one ``("adjust", 50)``, and anything followed by a
+    ``("volume", x)`` is replaced by it), a ``dim`` directly followed
+    by ``undim`` cancels out, and mute commands collapse to the last
+    one, which is dropped if it matches the current state.
+
+    Changes are never merged across a ``switch_device``, as they apply
+    to whichever device is current.
+
+    :param commands: Tuples of a name from :data:`COMMANDS` followed by
+        its arguments, in the order they were received.
+    :param muted: Whether the current device is muted, or `None` if
+        unknown.
+    :return: A list of commands to run, in order.
+
+    """
+    merged = []
+    mute = None
+
+    def flush_mute():
+        if mute is not None and mute != muted:
+            merged.append(("mute", ) if mute else ("unmute", ))
+
+    for command in commands:
+        name = command[0]
+        previous = merged[-1] if merged else (None, )
+        if name in ("mute", "unmute"):
+            mute = name == "mute"
+        elif name == "adjust" and previous[0] == "adjust":
+            merged[-1] = ("adjust", previous[1] + command[1])
+        elif name == "adjust" and previous[0] == "volume":
+            merged[-1] = (
+                "volume", min(max(previous[1] + command[1], 0), 100))
+        elif name == "volume" and previous[0] in ("adjust", "volume"):
+            merged[-1] = command
+        elif name == "undim" and previous[0] == "dim":
+            merged.pop()
+        elif name == "dim" and previous[0] == "dim":
+            # Already dimming, restarting the fade would only slow it.
+            continue
+        elif name == "switch_device":
+            flush_mute()
+            # The new device's mute state isn't known yet.
+            mute = muted = None
+            if previous[0] == "switch_device":
+                merged.pop()
+            merged.append(command)
+        else:
+            merged.append(command)
+    flush_mute()
+    return merged
+
+
+class AudioCommandQueue(Loggable):
+
+    """Runs audio commands on a single worker thread.
+
+    Commands are queued by :meth:`submit`, which returns straight
+    away. The worker takes everything queued up, plus anything arriving
+    within `merge_window` seconds of the first command, merges it with
+    :func:`merge_commands` and runs the result against the controller.
+    A burst of voice commands therefore costs a single backend call,
+    and concurrent requests can't race each other.
+
+    :param controller: The
+        :class:`~bender_mc.audio_controller.AudioController` to drive.
+    :param float merge_window: Seconds to wait for more commands after
+        the first of a burst.
+
+    """
+
+    def __init__(self, controller, merge_window=.05):
+        self.controller = controller
+        self.merge_window = merge_window
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="bender-mc-audio", daemon=True)
+        self._thread.start()
+
+    def submit(self, name, *args):
+        """Queue a command from :data:`COMMANDS` to run.
+
+        :raise ValueError: If the command or its arguments are invalid.
+
+        """
+        if COMMANDS.get(name) != len(args):
+            raise ValueError(f"Invalid audio command: {name}{args}")
+        self._queue.put((name, ) + args)
+
+    def join(self):
+        """Wait for every command submitted so far to be run."""
+        self._queue.join()
+
+    def close(self):
+        """Run any queued commands, then stop the worker."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is not None and self.merge_window:
+                time.sleep(self.merge_window)
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            commands = [command for command in batch if command is not None]
+            try:
+                for command in merge_commands(
+                        commands, self.controller.muted):
+                    self._execute(command)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if len(commands) != len(batch):
+                return
+
+    def _execute(self, command):
+        name, args = command[0], command[1:]
+        controller = self.controller
+        try:
+            if name == "adjust":
+                controller.adjust_volume(*args)
+            elif name == "volume":
+                controller.volume = args[0]
+            else:
+                getattr(controller, name)(*args)
+        except Exception:
+            self.logger.exception(f"Audio command {name} failed.")
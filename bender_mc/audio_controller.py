@@ -4,78 +4,269 @@
 
     Crudely controls the audio on a media center.
 
-    Depends on SoundVolumeView.exe being in your path.
+    The actual work is done by an
+    :class:`~bender_mc.audio_backends.AudioBackend` for the platform.
 
 """
 # :copyright: (c) 2022 by Nicholas Repole.
 # :license: MIT - See LICENSE for more details.
-import json
-import os
-import shutil
-import subprocess
-import tempfile
+import threading
+import time
+from drowsy.log import Loggable
+from bender_mc import metrics
+from bender_mc.audio_backends import AudioBackendError, get_audio_backend
 
 
-class AudioController(object):
+class VolumeRamp(object):
 
-    def __init__(self):
-        self._volume = None
+    """A linear change in volume over time.
+
+    :param float start: Volume at `started`.
+    :param float target: Volume to finish at.
+    :param float duration: Seconds the change takes.
+    :param float started: :func:`time.perf_counter` value it starts at.
+
+    """
+
+    def __init__(self, start, target, duration, started):
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.started = started
+        self.ends = started + duration
+
+    def value_at(self, now):
+        """Get the whole volume the ramp is at by `now`."""
+        if now >= self.ends or not self.duration:
+            return self.target
+        fraction = max(now - self.started, 0) / self.duration
+        return round(self.start + (self.target - self.start) * fraction)
+
+    def step_interval(self, minimum):
+        """Seconds between steps that each change the volume by about
+        one, or `minimum` if that's longer."""
+        change = abs(self.target - self.start)
+        if not change:
+            return minimum
+        return max(minimum, self.duration / change)
+
+
+class AudioController(Loggable):
+
+    """Controls the volume and output device of the media center.
+
+    The current device, volume and mute state are cached, so reading
+    them is free and relative changes only need a single write. The
+    cache is kept fresh by the backend's change notifications, or
+    where those aren't supported, by periodically reconciling it with
+    the backend.
+
+    Volume can also be ramped smoothly over time, see
+    :meth:`ramp_volume`. Ramps run on a scheduler thread and are
+    cancelled by any newer change to the volume or device.
+
+    :param backend: The :class:`~bender_mc.audio_backends.AudioBackend`
+        to use. Defaults to the one for this platform.
+    :param float reconcile_interval: Seconds between re-reading state
+        from a backend that can't notify of changes. `0` disables
+        reconciling.
+    :param float fade_duration: Default seconds :meth:`dim` and
+        :meth:`undim` take to fade.
+    :param float dim_volume: Volume to dim to.
+    :param float ramp_interval: Minimum seconds between ramp steps.
+
+    """
+
+    def __init__(self, backend=None, reconcile_interval=30,
+                 fade_duration=1.5, dim_volume=10, ramp_interval=.02):
+        self.backend = backend or get_audio_backend()
+        self.fade_duration = fade_duration
+        self.dim_volume = dim_volume
+        self.ramp_interval = ramp_interval
         self._pre_dim_volume = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._ramp = None
+        self._ramp_changed = threading.Condition(self._lock)
+        self._ramp_thread = None
+        # Bumped on every write, so a refresh that raced with a write
+        # doesn't overwrite it with stale values.
+        self._version = 0
+        self._volume = None
+        self._muted = None
         self.device = "Speakers"
-        # determine the currently active device
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            audio_json = os.path.join(tmpdirname, "audio.json")
-            exe_path = shutil.which("SoundVolumeView.exe")
-            p = subprocess.Popen(
-                [exe_path, "/sjson", audio_json], stdout=subprocess.PIPE)
-            p.wait()
-            with open(audio_json, "rb") as f:
-                data = json.load(f)
-            for row in data:
-                if row["Default"] == "Render":
-                    self.device = row["Name"]
+        self.refresh()
+        self._reconciler = None
+        subscribed = self.backend.subscribe(self._on_backend_change)
+        if not subscribed and reconcile_interval:
+            self._reconciler = threading.Thread(
+                target=self._reconcile, args=(reconcile_interval, ),
+                name="bender-mc-audio-reconciler", daemon=True)
+            self._reconciler.start()
+
+    def _backend_call(self, name, *args):
+        with metrics.timed("audio", name):
+            return getattr(self.backend, name)(*args)
+
+    def refresh(self):
+        """Re-read the device, volume and mute state from the backend."""
+        with self._lock:
+            version = self._version
+        device = self._backend_call("default_device") or self.device
+        volume = self._backend_call("get_volume", device)
+        muted = self._backend_call("get_mute", device)
+        with self._lock:
+            if version == self._version:
+                self.device = device
+                self._volume = volume
+                self._muted = muted
+
+    def _on_backend_change(self):
+        try:
+            self.refresh()
+        except AudioBackendError:
+            self.logger.warning(
+                "Unable to refresh audio state.", exc_info=True)
+
+    def _reconcile(self, interval):
+        while not self._stop.wait(interval):
+            self._on_backend_change()
+
+    def ramp_volume(self, target, duration):
+        """Smoothly change the volume to `target` over `duration`
+        seconds, replacing any ramp already running.
+
+        Returns straight away. Each step writes the volume once, and
+        only when it has changed by a whole percent.
+
+        """
+        target = min(max(target, 0), 100)
+        with self._lock:
+            if self._volume is None or duration <= 0:
+                self._cancel_ramp()
+                self._set_volume(target)
+                return
+            self._ramp = VolumeRamp(
+                self._volume, target, duration, time.perf_counter())
+            if self._ramp_thread is None:
+                self._ramp_thread = threading.Thread(
+                    target=self._run_ramps, name="bender-mc-audio-ramps",
+                    daemon=True)
+                self._ramp_thread.start()
+            self._ramp_changed.notify()
+
+    def _cancel_ramp(self):
+        if self._ramp is not None:
+            self._ramp = None
+            self._ramp_changed.notify()
+
+    def _run_ramps(self):
+        with self._lock:
+            while not self._stop.is_set():
+                ramp = self._ramp
+                if ramp is None:
+                    self._ramp_changed.wait()
+                    continue
+                now = time.perf_counter()
+                value = ramp.value_at(now)
+                try:
+                    if value != self._volume:
+                        self._set_volume(value)
+                except AudioBackendError:
+                    self.logger.warning(
+                        "Volume ramp failed.", exc_info=True)
+                    self._ramp = None
+                    continue
+                if now >= ramp.ends:
+                    self._ramp = None
+                    continue
+                # Steps are timed from the clock rather than counted, so
+                # a late step catches up instead of stretching the ramp.
+                self._ramp_changed.wait(
+                    ramp.step_interval(self.ramp_interval))
 
     def switch_device(self, device):
-        self.device = device
-        p = subprocess.Popen(
-            ["SoundVolumeView.exe", "/SetDefault", device],
-            stdout=subprocess.PIPE)
-        p.wait()
+        with self._lock:
+            self._cancel_ramp()
+            self._version += 1
+            self._backend_call("set_default_device", device)
+            self.device = device
+            self._volume = self._backend_call("get_volume", device)
+            self._muted = self._backend_call("get_mute", device)
+
+    def dim(self, duration=None):
+        """Fade down to `dim_volume`, remembering the volume to restore.
 
-    def dim(self):
-        self._pre_dim_volume = self.volume
-        self.volume = 10
+        :param float duration: Seconds to fade over. Defaults to
+            `fade_duration`.
 
-    def undim(self):
-        self.volume = self._pre_dim_volume
+        """
+        if duration is None:
+            duration = self.fade_duration
+        with self._lock:
+            if self._pre_dim_volume is None:
+                ramp = self._ramp
+                self._pre_dim_volume = (
+                    ramp.target if ramp is not None else self._volume)
+            self.ramp_volume(self.dim_volume, duration)
+
+    def undim(self, duration=None):
+        """Fade back up to the volume from before :meth:`dim`."""
+        if duration is None:
+            duration = self.fade_duration
+        with self._lock:
+            if self._pre_dim_volume is not None:
+                self.ramp_volume(self._pre_dim_volume, duration)
+                self._pre_dim_volume = None
 
     def mute(self):
-        p = subprocess.Popen(
-            ["SoundVolumeView.exe", "/Mute", self.device],
-            stdout=subprocess.PIPE)
-        p.wait()
+        with self._lock:
+            self._version += 1
+            self._backend_call("set_mute", self.device, True)
+            self._muted = True
 
     def unmute(self):
-        p = subprocess.Popen(
-            ["SoundVolumeView.exe", "/Unmute", self.device],
-            stdout=subprocess.PIPE)
-        p.wait()
+        with self._lock:
+            self._version += 1
+            self._backend_call("set_mute", self.device, False)
+            self._muted = False
+
+    @property
+    def muted(self):
+        """Whether the current device is muted, or `None` if unknown."""
+        return self._muted
 
     @property
     def volume(self):
-        if self._volume is not None:
-            self._volume = .1 * int(
-                subprocess.check_output(
-                    ["getvolume.bat", self.device],  # TODO - script loc
-                    shell=True
-                ).decode().split("\r\n")[-2]
-            )
         return self._volume
 
     @volume.setter
     def volume(self, value):
-        p = subprocess.Popen(
-            ["SoundVolumeView.exe", "/SetVolume", self.device, value],
-            stdout=subprocess.PIPE)
-        p.wait()
-        self._volume = value
+        with self._lock:
+            self._cancel_ramp()
+            self._set_volume(value)
+
+    def _set_volume(self, value):
+        value = min(max(value, 0), 100)
+        with self._lock:
+            self._version += 1
+            self._backend_call("set_volume", self.device, value)
+            self._volume = value
+
+    def adjust_volume(self, amount):
+        """Change the volume by `amount`, using the cached volume.
+
+        Does nothing if the current volume isn't known.
+
+        """
+        with self._lock:
+            if self._volume is not None:
+                self.volume = self._volume + amount
+
+    def close(self):
+        """Stop reconciling and ramping, and release the backend."""
+        with self._lock:
+            self._stop.set()
+            self._cancel_ramp()
+            self._ramp_changed.notify_all()
+        self.backend.close()
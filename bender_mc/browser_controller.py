@@ -1,32 +1,123 @@
 import os
 import psutil
+import threading
 import time
 from drowsy.log import Loggable
+from bender_mc import metrics
+from bender_mc.browser_steps import (
+    BrowserSteps, any_present, document_ready, fullscreen_exited,
+    video_playing)
 from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions
-from selenium.webdriver.support.ui import WebDriverWait
+
+
+# Returns the lines of text and watch link of each nba.com scoreboard
+# game card, for parse_scoreboard.
+SCOREBOARD_SCRIPT = """
+return Array.from(
+    document.querySelectorAll("div[class*='ScoreboardGame_game__']"),
+    function (card) {
+        var link = card.querySelector(":scope > a");
+        return {
+            lines: card.innerText.split("\\n"),
+            watchLink: link ? link.href : null
+        };
+    });
+"""
+
+
+def parse_scoreboard(cards):
+    """Parse nba.com scoreboard game cards.
+
+    :param cards: A list of dicts of each card's `lines` of text and
+        `watchLink` url, as returned by :data:`SCOREBOARD_SCRIPT`.
+    :return: A list of dicts of game info, with `watchLink`,
+        `awayTeam`, `awayScore`, `homeTeam`, `homeScore`, and if known,
+        `status` and `period`. Cards without a watch link or that
+        can't be parsed are skipped.
+
+    """
+    games = []
+    for card in cards or []:
+        if not card.get("watchLink"):
+            continue
+        game_data = {"watchLink": card["watchLink"]}
+        game_lines = [line.strip() for line in card.get("lines") or []]
+        game_lines = [line for line in game_lines if line]
+        if len(game_lines) == 6:
+            game_data["awayTeam"] = game_lines[2]
+            game_data["awayScore"] = game_lines[3]
+            game_data["homeTeam"] = game_lines[4]
+            game_data["homeScore"] = game_lines[5]
+        elif len(game_lines) == 9:
+            # playoffs!?
+            game_data["awayTeam"] = game_lines[3]
+            game_data["awayScore"] = game_lines[4]
+            game_data["homeTeam"] = game_lines[6]
+            game_data["homeScore"] = game_lines[7]
+        else:
+            continue
+        if game_lines[0] == "FINAL":
+            game_data["status"] = "COMPLETED"
+            game_data["period"] = 4
+        elif game_lines[0] == "HALF":
+            game_data["status"] = "BREAK"
+            game_data["period"] = 3
+        elif game_lines[0].startswith("Q"):
+            game_data["status"] = "LIVE"
+            game_data["period"] = int(game_lines[0][1])
+        elif game_lines[0].startswith("END Q"):
+            game_data["status"] = "BREAK"
+            game_data["period"] = int(game_lines[0][5]) + 1
+        elif game_lines[0][0].isdigit():
+            game_data["status"] = "PREGAME"
+            game_data["period"] = 0
+        games.append(game_data)
+    return games
 
 
 def browser_error_handler(func):
     def inner(driver, *args, **kwargs):
-        try:
-            return func(driver, *args, **kwargs)
-        except (WebDriverException, AttributeError):
-            driver.logger.exception("Web driver encountered an error.")
-            driver.close_driver()
+        # The standby thread shares the driver with request threads.
+        with driver.lock:
+            try:
+                return func(driver, *args, **kwargs)
+            except (WebDriverException, AttributeError):
+                driver.logger.exception("Web driver encountered an error.")
+                driver.close_driver()
     return inner
 
 
 class BrowserController(Loggable):
 
+    """Drives Chrome to play things Kodi can't.
+
+    In standby mode (see :meth:`start_standby`) a logged in NBA session
+    is kept open and minimized in the background, so playing a game
+    doesn't have to start the browser and log in first.
+
+    """
+
+    home_url = "https://www.nba.com/"
+
     def __init__(self, extension_paths=None):
         self.driver = None
         self.driver_app = None
         self._pid = None
         self.extension_paths = extension_paths or []
+        self.lock = threading.RLock()
+        # Whether the browser is in use (e.g. showing a game), and so
+        # mustn't be recycled.
+        self.active = False
+        # Bumped whenever a game is started, so a release asked for
+        # before then doesn't stop it.
+        self._generation = 0
+        self._started = None
+        self._standby_thread = None
+        self._standby_stop = threading.Event()
         super(BrowserController, self).__init__()
 
     @property
@@ -48,59 +139,74 @@ class BrowserController(Loggable):
     @browser_error_handler
     def _init_nba_app(self, username, password):
         if self.driver_app == "nba" and self.driver:
-            # ensure we're not in full screen mode
+            steps = BrowserSteps(self.driver, "nba_resume")
+            # ensure we're not in full screen mode. Always tried, as the
+            # player's own full screen may not use the Fullscreen API.
             try:
-                video_player = WebDriverWait(self.driver, 1).until(
+                video_player = steps.wait(
+                    "find_player",
                     expected_conditions.element_to_be_clickable((
                         By.XPATH,
                         ('//div[contains(@class, "nlQuadPlayer") and '
-                         'contains(@class, "sel")]'))))
-                if video_player:
-                    webdriver.ActionChains(self.driver).move_to_element(
-                        video_player).perform()
-                    fullscreen_button = WebDriverWait(self.driver, 1).until(
-                        expected_conditions.element_to_be_clickable((
-                            By.XPATH,
-                            ('//div[contains(@class, "nlQuadPlayer") and '
-                             'contains(@class, "sel")]'
-                             '//div[contains(@class, "nlFullscreenBtnExit")]')
-                        ))
-                    )
-                    if fullscreen_button:
-                        fullscreen_button.click()
+                         'contains(@class, "sel")]'))),
+                    timeout=1)
+                webdriver.ActionChains(self.driver).move_to_element(
+                    video_player).perform()
+                steps.wait(
+                    "find_exit_fullscreen",
+                    expected_conditions.element_to_be_clickable((
+                        By.XPATH,
+                        ('//div[contains(@class, "nlQuadPlayer") and '
+                         'contains(@class, "sel")]'
+                         '//div[contains(@class, "nlFullscreenBtnExit")]')
+                    )),
+                    timeout=1).click()
             except WebDriverException:
                 # if something went wrong then we weren't in fullscreen
                 pass
-            time.sleep(.5)
-            self.driver.maximize_window()
+            steps.wait(
+                "exit_fullscreen", fullscreen_exited(), timeout=5,
+                required=False)
+            with steps.step("maximize"):
+                self.driver.maximize_window()
+            steps.finish()
             return
         options = self.default_options
-        options.add_argument("--app=https://www.nba.com/")
+        options.add_argument(f"--app={self.home_url}")
         self.driver_app = "nba"
-        self.driver = webdriver.Chrome(options=options)
+        steps = BrowserSteps(None, "nba_login")
+        with steps.step("launch"):
+            self.driver = webdriver.Chrome(options=options)
+        steps.driver = self.driver
         self._pid = self.driver.service.process.pid
-        time.sleep(1)
-        WebDriverWait(self.driver, 20).until(
-            expected_conditions.element_to_be_clickable((
+        self._started = time.monotonic()
+        steps.wait("page_load", document_ready())
+        steps.wait(
+            "accept_cookies", expected_conditions.element_to_be_clickable((
                 By.ID, "onetrust-accept-btn-handler"))).click()
-        self.driver.find_element(By.ID, "nbaMenuButton").click()
-        self.driver.find_element(By.ID, "nbaMenuNBASignIn").click()
-        self.driver.find_element(By.ID, "nbaLoginModalId").send_keys(
-            username)
+        with steps.step("open_login"):
+            self.driver.find_element(By.ID, "nbaMenuButton").click()
+            self.driver.find_element(By.ID, "nbaMenuNBASignIn").click()
+        steps.wait(
+            "login_form", expected_conditions.visibility_of_element_located((
+                By.ID, "nbaLoginModalId"))).send_keys(username)
         self.driver.find_element(By.ID, "nbaLoginModalPw").send_keys(
             password)
-        WebDriverWait(self.driver, 20).until(
-            expected_conditions.element_to_be_clickable((
+        steps.wait(
+            "submit_login", expected_conditions.element_to_be_clickable((
                 By.ID, "nbaLoginModalSignIn"))).click()
-        # self.driver.find_element(By.ID, "nbaMenuButton").click()
-        time.sleep(1)
-        WebDriverWait(self.driver, 20).until(
-            expected_conditions.element_to_be_clickable((
+        steps.wait(
+            "login_closed",
+            expected_conditions.invisibility_of_element_located((
+                By.ID, "nbaLoginModalId")))
+        steps.wait(
+            "open_menu", expected_conditions.element_to_be_clickable((
                 By.ID, "nbaMenuButton"))).click()
-        WebDriverWait(self.driver, 20).until(
-            expected_conditions.element_to_be_clickable((
+        steps.wait(
+            "logged_in", expected_conditions.element_to_be_clickable((
                 By.ID, "nbaMenuMyAccount")))
         self.driver.find_element(By.ID, "nbaMenuButton").click()
+        steps.finish()
         return True
 
     @browser_error_handler
@@ -117,78 +223,52 @@ class BrowserController(Loggable):
             otherwise.
 
         """
+        self.active = True
+        self._generation += 1
         self._init_nba_app(username, password)
-        games = []
-        game_elements = self.driver.find_elements(
-            By.XPATH,
-            "//div[contains(@class, 'ScoreboardGame_game__')]")
-        for game_element in game_elements:
-            try:
-                watch_link = game_element.find_element(By.XPATH, "a")
-            except WebDriverException:
-                continue
-            game_data = {"watchLink": watch_link}
-            game_lines = game_element.text.split("\n")
-            if game_lines and len(game_lines) == 6:
-                game_data["awayTeam"] = game_lines[2]
-                game_data["awayScore"] = game_lines[3]
-                game_data["homeTeam"] = game_lines[4]
-                game_data["homeScore"] = game_lines[5]
-            elif game_lines and len(game_lines) == 9:
-                # playoffs!?
-                game_data["awayTeam"] = game_lines[3]
-                game_data["awayScore"] = game_lines[4]
-                game_data["homeTeam"] = game_lines[6]
-                game_data["homeScore"] = game_lines[7]
-            else:
-                continue
-            if game_lines and game_lines[0] == "FINAL":
-                game_data["status"] = "COMPLETED"
-                game_data["period"] = 4
-            elif game_lines and game_lines[0] == "HALF":
-                game_data["status"] = "BREAK"
-                game_data["period"] = 3
-            elif game_lines and game_lines[0].startswith("Q"):
-                game_data["status"] = "LIVE"
-                game_data["period"] = int(game_lines[0][1])
-            elif game_lines and game_lines[0].startswith("END Q"):
-                game_data["status"] = "BREAK"
-                game_data["period"] = int(game_lines[0][1]) + 1
-            elif game_lines and game_lines[0][0].isdigit():
-                game_data["status"] = "PREGAME"
-                game_data["period"] = 0
-            games.append(game_data)
+        steps = BrowserSteps(self.driver, "nba_play")
+        # One round trip for the whole scoreboard, rather than several
+        # per game card.
+        with steps.step("scoreboard"):
+            cards = self.driver.execute_script(SCOREBOARD_SCRIPT)
         game = None
-        for game in games:
+        for game in parse_scoreboard(cards):
             if game["awayTeam"].lower() == team or game["homeTeam"].lower() == team:
                 break
             else:
                 game = None
         if not game:
+            steps.finish()
+            self.active = False
             return True
-        self.driver.get(game["watchLink"].get_attribute("href"))
+        with steps.step("open_game"):
+            self.driver.get(game["watchLink"])
         # wait until new page has loaded
-        WebDriverWait(self.driver, 20).until(
-            expected_conditions.element_to_be_clickable((
+        steps.wait(
+            "game_page", expected_conditions.element_to_be_clickable((
                 By.ID, "nbaMenuButton")))
-        # now check to see if the stream options popped up
-        time.sleep(1)
-        stream_elements = self.driver.find_elements(
-            By.CLASS_NAME, "nba-action-body-row-double") or []
-        if not stream_elements:
+        # wait for the stream options to pop up, or if it's pregame,
+        # for there to be only a Watch button
+        watch_locator = (
+            By.XPATH, '//button[@data-id="nba:games:game-details:hero:watch"]')
+        stream_locator = (By.CLASS_NAME, "nba-action-body-row-double")
+        locator, elements = steps.wait(
+            "stream_options", any_present(stream_locator, watch_locator))
+        stream_elements = []
+        if locator == stream_locator:
+            stream_elements = elements
+        else:
             # it's pregame...click the Watch button
-            watch_button = self.driver.find_element(
-                By.XPATH,
-                '//button[@data-id="nba:games:game-details:hero:watch"]')
-            watch_button.click()
-            time.sleep(1)
-            modal = WebDriverWait(self.driver, 5).until(
-                expected_conditions.element_to_be_clickable((
-                    By.ID, "nbaModalContent")))
+            elements[0].click()
+            modal = steps.wait(
+                "watch_modal", expected_conditions.element_to_be_clickable((
+                    By.ID, "nbaModalContent")), timeout=5)
             try:
                 modal.find_element(
                     By.CLASS_NAME, "nba-action-body-unavailable")
+                # Leave the unavailable message up long enough to read.
                 time.sleep(5)
+                steps.finish()
                 self.close_driver()
                 return True
             except NoSuchElementException:
@@ -216,29 +296,161 @@ class BrowserController(Loggable):
         preferred_stream_element = (
                 preferred_stream_element or secondary_stream_element)
         preferred_stream_element.click()
-        fullscreen_button = WebDriverWait(self.driver, 20).until(
-            expected_conditions.element_to_be_clickable((
+        fullscreen_button = steps.wait(
+            "player", expected_conditions.element_to_be_clickable((
                 By.XPATH,
                 ('//div[contains(@class, "nlQuadPlayer") and '
                  'contains(@class, "sel")]'
                  '//div[contains(@class, "nlFullscreenBtn")]'))))
-        time.sleep(3)
-        fullscreen_button.click()
+        # Going full screen before the stream starts doesn't stick.
+        steps.wait("video_playing", video_playing(), timeout=10,
+                   required=False)
+        with steps.step("fullscreen"):
+            fullscreen_button.click()
+        steps.finish()
         return True
 
-    def close_driver(self):
-        if self.driver is not None:
-            self.driver_app = None
+    def start_standby(self, username, password, recycle_interval=14400,
+                      check_interval=60):
+        """Keep a logged in NBA session ready in the background.
+
+        A background thread opens the browser and logs in, then every
+        `check_interval` seconds makes sure it's still responsive,
+        replacing it if not. While idle, the browser is also replaced
+        once it's `recycle_interval` seconds old, so it doesn't slowly
+        bloat or get logged out.
+
+        :param str username: NBA LP username
+        :param str password: NBA LP password
+        :param float recycle_interval: Seconds to keep an idle browser
+            for.
+        :param float check_interval: Seconds between health checks.
+
+        """
+        if self._standby_thread is not None:
+            return
+        self._standby_stop.clear()
+        self._standby_thread = threading.Thread(
+            target=self._run_standby,
+            args=(username, password, recycle_interval, check_interval),
+            name="bender-mc-browser-standby", daemon=True)
+        self._standby_thread.start()
+
+    def stop_standby(self):
+        """Stop keeping a browser ready. The browser is left open."""
+        thread = self._standby_thread
+        if thread is not None:
+            self._standby_stop.set()
+            thread.join()
+            self._standby_thread = None
+
+    @property
+    def standby(self):
+        return self._standby_thread is not None
+
+    def _run_standby(self, username, password, recycle_interval,
+                     check_interval):
+        while True:
             try:
-                self.driver.close()
+                self._tend_standby(username, password, recycle_interval)
+            except Exception:
+                self.logger.exception("Unable to ready standby browser.")
+            if self._standby_stop.wait(check_interval):
+                return
+
+    def _tend_standby(self, username, password, recycle_interval):
+        with self.lock:
+            if self.active:
+                if self.driver is None or not self._game_over():
+                    return
+                self.logger.info("Game is over, returning to standby.")
+                self._release(self._generation)
+            if self.driver is not None:
+                age = time.monotonic() - (self._started or 0)
+                if age > recycle_interval:
+                    self.logger.info("Recycling standby browser.")
+                    self.close_driver()
+                elif not self.is_healthy():
+                    self.logger.warning(
+                        "Standby browser is unresponsive, replacing it.")
+                    self.close_driver()
+            if self.driver is None:
+                with metrics.timed("browser", "standby_start"):
+                    if self._init_nba_app(username, password):
+                        self.driver.minimize_window()
+
+    def is_healthy(self):
+        """Whether the browser is open, responsive and on nba.com."""
+        with self.lock:
+            if self.driver is None:
+                return False
+            try:
+                state = self.driver.execute_script(
+                    "return [document.readyState, location.hostname];")
+            except WebDriverException:
+                return False
+            return bool(state) and state[1].endswith("nba.com")
+
+    def _game_over(self):
+        """Whether the game being shown has ended, or there's none."""
+        try:
+            return not self.driver.execute_script(
+                "return Array.from(document.querySelectorAll('video'))"
+                ".some(function (video) { return !video.ended; });")
+        except WebDriverException:
+            return True
+
+    def release(self):
+        """Stop using the browser, e.g. because other media is playing.
+
+        In standby mode the browser is sent back to the home page, which
+        stops any game, and minimized. Otherwise it's closed. Either way
+        this happens in the background once the browser is free, so the
+        caller never waits on it, and not at all if the browser is
+        already idle.
+
+        """
+        if not self.active and (self.standby or self.driver is None):
+            return
+        threading.Thread(
+            target=self._release, args=(self._generation, ),
+            name="bender-mc-browser-release", daemon=True).start()
+
+    def _release(self, generation):
+        with self.lock:
+            if generation != self._generation:
+                # A game was started since the release was asked for.
+                return
+            if not self.active and self.standby and self.driver is not None:
+                return
+            self.active = False
+            if not self.standby or self.driver is None:
+                self.close_driver()
+                return
+            try:
+                self.driver.get(self.home_url)
+                self.driver.minimize_window()
             except WebDriverException:
                 self.logger.warning(
-                    "Browser was closed manually. Terminating driver process.")
-                if self._pid:
-                    proc = psutil.Process(pid=self._pid)
-                    proc.kill()
-            self.driver = None
-            self._pid = None
+                    "Unable to return browser to standby, closing it.")
+                self.close_driver()
+
+    def close_driver(self):
+        with self.lock:
+            self.active = False
+            if self.driver is not None:
+                self.driver_app = None
+                try:
+                    self.driver.close()
+                except WebDriverException:
+                    self.logger.warning(
+                        "Browser was closed manually. Terminating driver "
+                        "process.")
+                    if self._pid:
+                        proc = psutil.Process(pid=self._pid)
+                        proc.kill()
+                self.driver = None
+                self._pid = None
 
     def __del__(self):
         self.logger.info("Removing browser driver.")
@@ -0,0 +1,139 @@
+"""
+    bender_mc.browser_steps
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs browser automation as named steps that each wait on a page
+    condition rather than a fixed sleep, and times them.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import time
+from contextlib import contextmanager
+from drowsy.log import Loggable
+from selenium.common.exceptions import (
+    JavascriptException, NoSuchElementException,
+    StaleElementReferenceException, TimeoutException)
+from selenium.webdriver.support.ui import WebDriverWait
+from bender_mc import metrics
+
+
+def document_ready():
+    """Condition that the page has finished loading."""
+    def condition(driver):
+        return driver.execute_script(
+            "return document.readyState;") == "complete"
+    return condition
+
+
+def fullscreen_exited():
+    """Condition that nothing on the page is full screen."""
+    def condition(driver):
+        return driver.execute_script(
+            "return !document.fullscreenElement && "
+            "!document.webkitFullscreenElement;")
+    return condition
+
+
+def video_playing(selector="video"):
+    """Condition that a video matching the CSS `selector` is playing
+    and has data buffered to keep playing."""
+    def condition(driver):
+        return driver.execute_script(
+            "return Array.from(document.querySelectorAll(arguments[0]))"
+            ".some(function (video) {"
+            "  return !video.paused && !video.ended && "
+            "video.readyState >= 3;"
+            "});", selector)
+    return condition
+
+
+def any_present(*locators):
+    """Condition that any of `locators` matches an element.
+
+    :return: The condition, which returns a `(locator, elements)` tuple
+        for the first locator with matching elements.
+
+    """
+    def condition(driver):
+        for locator in locators:
+            elements = driver.find_elements(*locator)
+            if elements:
+                return locator, elements
+        return False
+    return condition
+
+
+class BrowserSteps(Loggable):
+
+    """Runs and times the steps of one browser automation flow.
+
+    Each step's duration is recorded in the browser duration histogram
+    as ``{flow}.{step}``, so the slowest steps show up in metrics, and
+    a per flow summary is logged by :meth:`finish`.
+
+    :param driver: The Selenium web driver.
+    :param str flow: Name of the flow, e.g. ``nba_login``.
+    :param float poll_frequency: Seconds between condition checks.
+
+    """
+
+    def __init__(self, driver, flow, poll_frequency=.1):
+        self.driver = driver
+        self.flow = flow
+        self.poll_frequency = poll_frequency
+        self.timings = []
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def step(self, name):
+        """Time the enclosed block as step `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings.append((name, elapsed))
+            # Observed directly rather than through metrics.record, as
+            # the whole flow is already attributed to the request.
+            metrics.browser_duration.observe(elapsed, f"{self.flow}.{name}")
+
+    def wait(self, name, condition, timeout=20, required=True):
+        """Run step `name`, waiting until `condition` is met.
+
+        :param condition: Callable taking the driver, returning a truthy
+            value once the page is ready, e.g. from
+            :mod:`selenium.webdriver.support.expected_conditions`.
+        :param float timeout: Seconds to wait before giving up.
+        :param bool required: Whether to raise if `timeout` passes, or
+            just carry on.
+        :return: The condition's result, or `None` if an optional
+            condition wasn't met in time.
+        :raise TimeoutException: If `timeout` passes first on a required
+            step.
+
+        """
+        with self.step(name):
+            try:
+                return WebDriverWait(
+                    self.driver, timeout, poll_frequency=self.poll_frequency,
+                    ignored_exceptions=(
+                        JavascriptException, NoSuchElementException,
+                        StaleElementReferenceException)
+                ).until(condition, f"Timed out waiting for step {name}.")
+            except TimeoutException:
+                if required:
+                    raise
+                self.logger.debug(f"Gave up waiting for step {name}.")
+                return None
+
+    def finish(self):
+        """Log how long each step took, and which took longest."""
+        total = time.perf_counter() - self._started
+        if not self.timings:
+            return
+        slowest = max(self.timings, key=lambda timing: timing[1])
+        steps = ", ".join(
+            f"{name} {elapsed:.2f}s" for name, elapsed in self.timings)
+        self.logger.info(
+            f"Browser flow {self.flow} took {total:.2f}s, slowest step "
+            f"{slowest[0]} ({slowest[1]:.2f}s): {steps}.")
@@ -0,0 +1,465 @@
+"""
+    bender_mc.browser_worker
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs the browser controller in its own supervised process, so a
+    hung or bloated browser can't take the API server down with it.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import psutil
+from logging.handlers import QueueHandler
+from drowsy.log import Loggable
+from bender_mc import metrics
+
+# Controller methods the worker will run on request.
+WORKER_COMMANDS = frozenset((
+    "play_nba_game", "release", "close_driver", "is_healthy",
+    "start_standby", "stop_standby"))
+# Commands the worker runs as soon as they arrive, rather than after
+# whatever it's busy with. They must not block.
+IMMEDIATE_COMMANDS = frozenset(("release", ))
+
+
+class _PipeQueue(object):
+
+    """Lets a :class:`~logging.handlers.QueueHandler` send log records
+    to the parent process."""
+
+    def __init__(self, send):
+        self.send = send
+
+    def put_nowait(self, record):
+        self.send(("log", record))
+
+
+def _worker_main(conn, extension_paths, log_level):
+    """Serve browser commands received over `conn`, until it closes.
+
+    Commands are run one at a time on a separate thread, apart from
+    :data:`IMMEDIATE_COMMANDS`. Log records and metric observations are
+    sent back over `conn` along with the replies.
+
+    """
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    # Everything is logged by the parent, in the same way as if the
+    # controller ran there.
+    root_logger = logging.getLogger()
+    root_logger.setLevel(log_level)
+    root_logger.handlers = [QueueHandler(_PipeQueue(send))]
+    metrics.forward_observations(
+        lambda name, value, labels: send(("observe", name, value, labels)))
+    from bender_mc.browser_controller import BrowserController
+    controller = BrowserController(extension_paths=extension_paths)
+    commands = queue.Queue()
+
+    def run(request_id, name, args, kwargs):
+        try:
+            result = getattr(controller, name)(*args, **kwargs)
+        except Exception as exc:
+            ok, result = False, f"{type(exc).__name__}: {exc}"
+        else:
+            ok = True
+        if request_id is not None:
+            send(("reply", request_id, ok, result))
+
+    def run_commands():
+        while True:
+            command = commands.get()
+            if command is None:
+                return
+            run(*command)
+
+    threading.Thread(
+        target=run_commands, name="bender-mc-browser-commands",
+        daemon=True).start()
+    try:
+        while True:
+            try:
+                command = conn.recv()
+            except EOFError:
+                return
+            if command[1] in IMMEDIATE_COMMANDS:
+                run(*command)
+            else:
+                commands.put(command)
+    finally:
+        commands.put(None)
+        controller.stop_standby()
+        controller.close_driver()
+
+
+class _PendingCall(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.done = threading.Event()
+        self.ok = False
+        self.result = None
+
+
+class BrowserWorker(Loggable):
+
+    """Client for a :class:`~bender_mc.browser_controller.BrowserController`
+    running in a separate process.
+
+    Has the same methods as the controller, which are sent to the
+    worker process over a pipe and run one at a time. Like the
+    controller's own error handling, a failed call is logged and
+    returns `None` rather than raising. :meth:`release` doesn't wait
+    at all, and the worker runs it straight away, even while busy.
+
+    Log records from the worker are handled by this process's loggers,
+    and its browser timings are recorded in this process's metrics.
+
+    A watchdog thread keeps an eye on the worker and the browser
+    processes it has started, and recycles the lot if they use more
+    than `max_rss_mb` of memory, stay above `max_cpu_percent` CPU for
+    `cpu_strikes` checks in a row, or the worker dies. A call that
+    takes longer than `command_timeout` also recycles the worker.
+    Callers never wait on each other, only on their own call.
+
+    :param extension_paths: Passed to the controller.
+    :param float max_rss_mb: Memory limit for the worker and its
+        children, in MiB. `None` for no limit.
+    :param float max_cpu_percent: CPU limit for the worker and its
+        children, as a percentage of one core. `None` for no limit.
+    :param int cpu_strikes: Checks in a row the CPU limit must be
+        exceeded for.
+    :param float watchdog_interval: Seconds between checks.
+    :param float command_timeout: Seconds to wait for a call.
+
+    """
+
+    def __init__(self, extension_paths=None, max_rss_mb=2048,
+                 max_cpu_percent=None, cpu_strikes=3, watchdog_interval=10,
+                 command_timeout=120):
+        self.extension_paths = extension_paths or []
+        self.max_rss_mb = max_rss_mb
+        self.max_cpu_percent = max_cpu_percent
+        self.cpu_strikes = cpu_strikes
+        self.watchdog_interval = watchdog_interval
+        self.command_timeout = command_timeout
+        self.recycles = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._conn = None
+        self._usage_cache = None
+        self._standby = None
+        self._request_ids = itertools.count()
+        # request id -> _PendingCall
+        self._pending = {}
+        # Guards the state above. Never held while waiting on the
+        # worker.
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._watchdog = threading.Thread(
+            target=self._watch, name="bender-mc-browser-watchdog",
+            daemon=True)
+        self._watchdog.start()
+
+    def _ensure_process(self):
+        # Called with the lock held.
+        if self._process is not None and self._process.is_alive():
+            return
+        if self._process is not None:
+            self.logger.warning(
+                f"Browser worker exited with code "
+                f"{self._process.exitcode}, restarting.")
+            self._kill(*self._detach())
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(child_conn, self.extension_paths,
+                  logging.getLogger().getEffectiveLevel()),
+            name="bender-mc-browser", daemon=True)
+        process.start()
+        child_conn.close()
+        self._process = process
+        self._conn = parent_conn
+        threading.Thread(
+            target=self._read, args=(parent_conn, ),
+            name="bender-mc-browser-reader", daemon=True).start()
+        self.logger.info(f"Started browser worker (pid {process.pid}).")
+        if self._standby is not None:
+            self._send("start_standby", (), self._standby, wait=False)
+
+    def _send(self, name, args, kwargs, wait=True):
+        # Called with the lock held.
+        request_id = None
+        pending = None
+        if wait:
+            request_id = next(self._request_ids)
+            pending = self._pending[request_id] = _PendingCall(self._conn)
+        try:
+            self._conn.send((request_id, name, args, kwargs))
+        except Exception:
+            self._pending.pop(request_id, None)
+            raise
+        return pending
+
+    def _read(self, conn):
+        """Handle replies, log records and metrics sent by a worker,
+        until it exits."""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "reply":
+                _, request_id, ok, result = message
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                if pending is not None:
+                    pending.ok, pending.result = ok, result
+                    pending.done.set()
+            elif kind == "log":
+                record = message[1]
+                logger = logging.getLogger(record.name)
+                if logger.isEnabledFor(record.levelno):
+                    logger.handle(record)
+            elif kind == "observe":
+                _, name, value, labels = message
+                metric = metrics.registry.get(name)
+                if metric is not None:
+                    metric.observe(value, *labels)
+        # Fail any calls still waiting on this worker.
+        with self._lock:
+            abandoned = [
+                request_id for request_id, pending in self._pending.items()
+                if pending.conn is conn]
+            abandoned = [
+                self._pending.pop(request_id) for request_id in abandoned]
+        for pending in abandoned:
+            pending.result = "Browser worker exited."
+            pending.done.set()
+
+    def call(self, name, *args, **kwargs):
+        """Run controller method `name` in the worker.
+
+        :return: The method's result, or `None` if it failed.
+
+        """
+        return self._call(name, args, kwargs)
+
+    def _call(self, name, args, kwargs, wait=True):
+        if name not in WORKER_COMMANDS:
+            raise ValueError(f"Unknown browser command: {name}")
+        process = None
+        try:
+            with self._lock:
+                self._ensure_process()
+                process = self._process
+                pending = self._send(name, args, kwargs, wait=wait)
+        except (OSError, EOFError):
+            self.logger.exception(f"Unable to send browser command {name}.")
+            self._recycle_if_current(process)
+            return None
+        if pending is None:
+            return None
+        if not pending.done.wait(self.command_timeout):
+            self.logger.error(
+                f"Browser worker didn't respond to {name} within "
+                f"{self.command_timeout}s.")
+            self._recycle_if_current(process)
+            return None
+        if not pending.ok:
+            self.logger.error(
+                f"Browser command {name} failed: {pending.result}")
+            self._recycle_if_current(process)
+            return None
+        return pending.result
+
+    def play_nba_game(self, username, password, team=None):
+        return self.call(
+            "play_nba_game", username=username, password=password,
+            team=team)
+
+    def release(self):
+        """Ask the worker to release the browser, without waiting."""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                # Nothing to release.
+                return None
+        return self._call("release", (), {}, wait=False)
+
+    def close_driver(self):
+        return self.call("close_driver")
+
+    def is_healthy(self):
+        return self.call("is_healthy")
+
+    def start_standby(self, username, password, recycle_interval=14400,
+                      check_interval=60):
+        # Remembered so a recycled worker starts its standby browser too.
+        with self._lock:
+            self._standby = {
+                "username": username,
+                "password": password,
+                "recycle_interval": recycle_interval,
+                "check_interval": check_interval
+            }
+            if self._process is None or not self._process.is_alive():
+                # Starting the worker starts the standby browser.
+                self._ensure_process()
+                return None
+        return self.call("start_standby", **self._standby)
+
+    def stop_standby(self):
+        self._standby = None
+        return self.call("stop_standby")
+
+    def _watch(self):
+        strikes = 0
+        while not self._stop.wait(self.watchdog_interval):
+            try:
+                strikes = self._check(strikes)
+            except Exception:
+                self.logger.exception("Browser watchdog check failed.")
+
+    def _check(self, strikes):
+        process = self._process
+        if process is None:
+            return 0
+        if not process.is_alive():
+            with self._lock:
+                if self._process is process:
+                    self._ensure_process()
+            return 0
+        usage = self.usage()
+        if usage is None:
+            return 0
+        rss_mb, cpu_percent = usage
+        if self.max_rss_mb is not None and rss_mb > self.max_rss_mb:
+            self.logger.warning(
+                f"Browser worker using {rss_mb:.0f}MiB, over the "
+                f"{self.max_rss_mb}MiB limit. Recycling it.")
+            self._recycle_if_current(process)
+            return 0
+        if (self.max_cpu_percent is not None and
+                cpu_percent > self.max_cpu_percent):
+            strikes += 1
+            if strikes >= self.cpu_strikes:
+                self.logger.warning(
+                    f"Browser worker using {cpu_percent:.0f}% CPU, over "
+                    f"the {self.max_cpu_percent}% limit. Recycling it.")
+                self._recycle_if_current(process)
+                return 0
+            return strikes
+        return 0
+
+    def usage(self):
+        """Get the memory (MiB) and CPU (percent of one core) used by
+        the worker and every process it has started.
+
+        CPU use is measured since the previous call.
+
+        :return: A `(rss_mb, cpu_percent)` tuple, or `None` if the
+            worker isn't running.
+
+        """
+        process = self._process
+        if process is None or not process.is_alive():
+            return None
+        # psutil measures CPU use between calls on the same Process
+        # object, so they're kept from one check to the next.
+        if self._usage_cache is None or self._usage_cache[0] != process.pid:
+            try:
+                self._usage_cache = (
+                    process.pid, psutil.Process(process.pid), {})
+            except psutil.Error:
+                return None
+        _, root, known = self._usage_cache
+        try:
+            children = root.children(recursive=True)
+        except psutil.Error:
+            return None
+        rss = 0
+        cpu = 0.0
+        current = {}
+        for proc in [root] + children:
+            proc = known.get(proc.pid, proc)
+            current[proc.pid] = proc
+            try:
+                rss += proc.memory_info().rss
+                cpu += proc.cpu_percent(interval=None)
+            except psutil.Error:
+                continue
+        known.clear()
+        known.update(current)
+        return rss / (1024 * 1024), cpu
+
+    def _recycle_if_current(self, process):
+        # Does nothing if the worker was already replaced, e.g. by
+        # another caller that noticed the same problem.
+        with self._lock:
+            if process is None or self._process is not process:
+                return
+            detached = self._detach()
+            self.recycles += 1
+        self._restart(detached)
+
+    def recycle(self):
+        """Kill the worker and its browser. A new one is started when
+        next needed, or straight away if a standby browser is wanted."""
+        with self._lock:
+            detached = self._detach()
+            self.recycles += 1
+        self._restart(detached)
+
+    def _restart(self, detached):
+        # The old worker is killed first, so the two browsers don't
+        # fight over the profile.
+        self._kill(*detached)
+        with self._lock:
+            if self._standby is None or self._stop.is_set():
+                return
+            try:
+                self._ensure_process()
+            except (OSError, EOFError):
+                self.logger.exception(
+                    "Unable to restart the browser worker.")
+                self._kill(*self._detach())
+
+    def _detach(self):
+        # Called with the lock held. Waiting calls are failed by the
+        # reader thread once the pipe closes.
+        detached = self._process, self._conn
+        self._process = self._conn = None
+        return detached
+
+    def _kill(self, process, conn):
+        if conn is not None:
+            conn.close()
+        if process is None:
+            return
+        try:
+            root = psutil.Process(process.pid)
+            victims = root.children(recursive=True) + [root]
+        except psutil.Error:
+            victims = []
+        for proc in victims:
+            try:
+                proc.kill()
+            except psutil.Error:
+                pass
+        psutil.wait_procs(victims, timeout=5)
+        process.join(timeout=1)
+
+    def close(self):
+        """Stop the watchdog, then the worker and its browser."""
+        self._stop.set()
+        with self._lock:
+            detached = self._detach()
+        self._kill(*detached)
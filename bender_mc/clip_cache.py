@@ -0,0 +1,222 @@
+"""
+    bender_mc.clip_cache
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Content addressed cache of announcement clips, so repeated ones can
+    be played by hash instead of being uploaded again.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from drowsy.log import Loggable
+
+CLIP_SUFFIX = ".clip"
+CLIP_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def clip_hash(data):
+    """Get the hex SHA-256 of a clip's contents."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ClipCache(Loggable):
+
+    """A bounded LRU of clips, keyed by :func:`clip_hash`.
+
+    Clips are held in memory up to `max_bytes`. If `spill_dir` is
+    given, clips evicted from memory are written there instead of
+    being forgotten, up to `max_spill_bytes`, and moved back into
+    memory when next used. Spilled clips survive restarts.
+
+    Spilling happens on a background thread, so adding a clip never
+    waits on the disk. Evicted clips stay readable while they wait to
+    be written; if the disk falls more than `max_bytes` behind, the
+    oldest of them are forgotten instead.
+
+    :param int max_bytes: Most bytes of clips to hold in memory.
+    :param str spill_dir: Optional directory to spill clips to.
+    :param int max_spill_bytes: Most bytes of clips to keep on disk.
+
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, spill_dir=None,
+                 max_spill_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # hash -> size, least recently used first.
+        self._spilled = OrderedDict()
+        self._spilled_bytes = 0
+        # Evicted clips waiting to be spilled, oldest first.
+        self._pending = OrderedDict()
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._pending_changed = threading.Condition(self._lock)
+        self._spill_thread = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._load_spilled()
+            self._spill_thread = threading.Thread(
+                target=self._run_spill, name="bender-mc-clip-spill",
+                daemon=True)
+            self._spill_thread.start()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, key + CLIP_SUFFIX)
+
+    def _load_spilled(self):
+        entries = []
+        for name in os.listdir(self.spill_dir):
+            key = name[:-len(CLIP_SUFFIX)]
+            if not name.endswith(CLIP_SUFFIX) or not CLIP_HASH_RE.match(key):
+                continue
+            stat = os.stat(os.path.join(self.spill_dir, name))
+            entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._spilled[key] = size
+            self._spilled_bytes += size
+        self._trim_spilled()
+
+    def put(self, data):
+        """Add a clip, returning its hash."""
+        data = bytes(data)
+        key = clip_hash(data)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+            else:
+                self._memory[key] = data
+                self._memory_bytes += len(data)
+                self._trim_memory()
+        return key
+
+    def get(self, key):
+        """Get a clip by hash, or `None` if it isn't cached."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+            data = self._pending.get(key)
+            if data is not None:
+                # Still being spilled, which can carry on regardless.
+                self.hits += 1
+                self._remember(key, data)
+                return data
+            if key not in self._spilled:
+                self.misses += 1
+                return None
+            self._spilled.move_to_end(key)
+        try:
+            with open(self._spill_path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            self.logger.warning(
+                f"Unable to read spilled clip {key}.", exc_info=True)
+            with self._lock:
+                self._forget_spilled(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._remember(key, data)
+        return data
+
+    def __contains__(self, key):
+        with self._lock:
+            return (key in self._memory or key in self._pending or
+                    key in self._spilled)
+
+    def _remember(self, key, data):
+        if key not in self._memory:
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            self._trim_memory()
+
+    def _trim_memory(self):
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            key, data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(data)
+            if (self.spill_dir and key not in self._spilled and
+                    key not in self._pending):
+                self._pending[key] = data
+                self._pending_bytes += len(data)
+                self._pending_changed.notify()
+        while self._pending_bytes > self.max_bytes and len(self._pending) > 1:
+            key, data = self._pending.popitem(last=False)
+            self._pending_bytes -= len(data)
+            self.logger.warning(f"Spilling behind, forgot clip {key}.")
+
+    def _run_spill(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._pending_changed.wait()
+                key, data = next(iter(self._pending.items()))
+            spilled = self._spill(key, data)
+            with self._lock:
+                if self._pending.get(key) is data:
+                    del self._pending[key]
+                    self._pending_bytes -= len(data)
+                if spilled and key not in self._spilled:
+                    self._spilled[key] = len(data)
+                    self._spilled_bytes += len(data)
+                    self._trim_spilled()
+                self._pending_changed.notify_all()
+
+    def _spill(self, key, data):
+        path = self._spill_path(key)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            self.logger.warning(
+                f"Unable to spill clip {key}.", exc_info=True)
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """Wait for evicted clips to finish being spilled.
+
+        :return: `True` if nothing is left waiting to be spilled.
+
+        """
+        with self._lock:
+            return self._pending_changed.wait_for(
+                lambda: not self._pending, timeout)
+
+    def _forget_spilled(self, key):
+        size = self._spilled.pop(key, None)
+        if size is not None:
+            self._spilled_bytes -= size
+
+    def _trim_spilled(self):
+        while self._spilled_bytes > self.max_spill_bytes and self._spilled:
+            key = next(iter(self._spilled))
+            self._forget_spilled(key)
+            try:
+                os.remove(self._spill_path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memoryClips": len(self._memory),
+                "memoryBytes": self._memory_bytes,
+                "pendingClips": len(self._pending),
+                "spilledClips": len(self._spilled),
+                "spilledBytes": self._spilled_bytes
+            }
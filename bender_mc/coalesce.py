@@ -0,0 +1,70 @@
+"""
+    bender_mc.coalesce
+    ~~~~~~~~~~~~~~~~~~
+
+    Single-flight execution, so duplicate commands only run once.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+
+    """Share one execution among duplicate calls with the same key.
+
+    A call made while another call with the same key is still running
+    waits for and shares that call's outcome. Once a call finishes its
+    outcome is forgotten, so a later call with the same key always runs
+    again; repeating a toggle such as pause is intentional.
+
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, timeout=None, **kwargs):
+        """Run `func` unless an equivalent call can be shared.
+
+        :param key: Hashable key identifying duplicate calls.
+        :param float timeout: Most seconds to wait for a running call
+            to share, or `None` to wait for as long as it takes.
+        :return: A `(result, shared)` tuple, where `shared` is `True`
+            if the result came from another call.
+        :raise TimeoutError: If `timeout` passes before the running
+            call finishes.
+        :raise: Whatever exception the shared execution raised.
+
+        """
+        with self._lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(
+                    "Timed out waiting for a duplicate call to finish.")
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self._lock:
+                self.calls.pop(key, None)
+            call.done.set()
+        return call.result, False
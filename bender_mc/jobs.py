@@ -0,0 +1,251 @@
+"""
+    bender_mc.jobs
+    ~~~~~~~~~~~~~~
+
+    Background job execution for long running media actions.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from drowsy.log import Loggable
+
+
+class JobConflictError(Exception):
+
+    """Raised when a job is submitted while another in its group is
+    still unfinished."""
+
+    def __init__(self, job):
+        self.job = job
+        super(JobConflictError, self).__init__(
+            f"Job {job.name} ({job.id}) is already {job.status}.")
+
+
+class JobsFullError(Exception):
+
+    """Raised when a job is submitted while the manager is already
+    tracking as many unfinished jobs as it may."""
+
+    pass
+
+
+class Job(object):
+
+    """A unit of work queued to a :class:`JobManager`."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    def __init__(self, name, func, on_finished=None, group=None, key=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.func = func
+        self.on_finished = on_finished
+        self.group = group
+        self.key = key
+        self.status = self.QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes or `timeout` seconds pass.
+
+        :return: `True` if the job has finished.
+
+        """
+        return self.done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "jobId": self.id,
+            "name": self.name,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at
+        }
+
+
+class JobManager(Loggable):
+
+    """Runs jobs on a thread pool and keeps track of their status.
+
+    :param int max_workers: Number of jobs that may run at once.
+    :param int max_retained: Number of jobs remembered for status
+        lookups. The oldest finished jobs are forgotten to make room.
+        Unfinished jobs never are, so once this many are queued or
+        running new ones are refused.
+
+    """
+
+    def __init__(self, max_workers=4, max_retained=200):
+        self.max_retained = max_retained
+        self.jobs = OrderedDict()
+        # group -> its unfinished job.
+        self._groups = {}
+        # key -> its unfinished job.
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bender-mc-job")
+
+    def submit(self, name, func, on_finished=None, group=None, key=None):
+        """Queue `func` to be run in the background.
+
+        :param str name: Human readable name for the job.
+        :param func: Callable taking no arguments. Its return value
+            becomes the job result.
+        :param on_finished: Optional callable that is passed the job
+            once it has finished, successfully or not.
+        :param str group: Optional name of a shared resource the job
+            uses, e.g. ``browser``. Only one job per group may be
+            queued or running at a time.
+        :param key: Optional hashable key identifying duplicate jobs.
+            While a job with the same key is unfinished, it's returned
+            instead of queuing `func` again.
+        :return: The newly queued :class:`Job`, or the unfinished one
+            with the same `key`.
+        :raise JobConflictError: If another job in `group` hasn't
+            finished yet.
+        :raise JobsFullError: If `max_retained` jobs are unfinished.
+
+        """
+        job = Job(name, func, on_finished=on_finished, group=group, key=key)
+        existing = self._add(job)
+        if existing is not None:
+            return existing
+        self._executor.submit(self._run, job)
+        return job
+
+    @contextmanager
+    def reserve(self, name, group):
+        """Hold `group` while the caller works on it in this thread.
+
+        The work is tracked as a running job, so it appears in status
+        lookups and conflicting submissions point at it. Exceptions
+        fail the job and are raised as usual.
+
+        :param str name: Human readable name for the work.
+        :param str group: Name of the shared resource to hold.
+        :return: A context manager giving the running :class:`Job`.
+        :raise JobConflictError: If another job in `group` hasn't
+            finished yet.
+        :raise JobsFullError: If `max_retained` jobs are unfinished.
+
+        """
+        job = Job(name, None, group=group)
+        self._add(job)
+        job.status = Job.RUNNING
+        job.started_at = time.time()
+        try:
+            yield job
+        except Exception as exc:
+            job.error = self._describe_error(exc)
+            job.status = Job.FAILED
+            raise
+        else:
+            job.status = Job.SUCCEEDED
+        finally:
+            self._finish(job)
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def unfinished(self, group):
+        """Get the queued or running job in `group`, if any."""
+        with self._lock:
+            return self._groups.get(group)
+
+    def recent(self, limit=20):
+        """Get the most recently created jobs, newest first."""
+        with self._lock:
+            jobs = list(self.jobs.values())
+        return list(reversed(jobs))[:limit]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _add(self, job):
+        # Returns the unfinished duplicate of `job` if there is one,
+        # otherwise starts tracking `job`.
+        with self._lock:
+            if job.key is not None and job.key in self._keys:
+                return self._keys[job.key]
+            self._prune()
+            if len(self.jobs) >= self.max_retained:
+                # Everything left is unfinished, so jobs are stuck or
+                # the pool is swamped.
+                raise JobsFullError(
+                    f"{len(self.jobs)} jobs are already unfinished.")
+            if job.group is not None:
+                current = self._groups.get(job.group)
+                if current is not None:
+                    raise JobConflictError(current)
+                self._groups[job.group] = job
+            if job.key is not None:
+                self._keys[job.key] = job
+            self.jobs[job.id] = job
+        return None
+
+    def _prune(self):
+        # Called with the lock held. Makes room for one more job.
+        excess = len(self.jobs) - self.max_retained + 1
+        for job_id in list(self.jobs):
+            if excess <= 0:
+                return
+            if self.jobs[job_id].finished:
+                del self.jobs[job_id]
+                excess -= 1
+
+    @staticmethod
+    def _describe_error(exc):
+        return {
+            "message": getattr(exc, "message", None) or str(exc),
+            "code": getattr(exc, "code", None) or "job_failed"
+        }
+
+    def _finish(self, job):
+        job.finished_at = time.time()
+        with self._lock:
+            if self._groups.get(job.group) is job:
+                del self._groups[job.group]
+            if self._keys.get(job.key) is job:
+                del self._keys[job.key]
+        job.done.set()
+
+    def _run(self, job):
+        job.status = Job.RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = job.func()
+            job.status = Job.SUCCEEDED
+        except Exception as exc:
+            self.logger.exception(f"Job {job.name} ({job.id}) failed.")
+            job.error = self._describe_error(exc)
+            job.status = Job.FAILED
+        finally:
+            self._finish(job)
+        if job.on_finished is not None:
+            try:
+                job.on_finished(job)
+            except Exception:
+                self.logger.exception(
+                    f"Finished callback for job {job.id} failed.")
@@ -0,0 +1,490 @@
+"""
+    bender_mc.kodi.fake_server
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Stand-in Kodi HTTP JSON-RPC server for load and latency testing.
+
+    Implements the subset of the Kodi JSON-RPC API that bender-mc uses,
+    keeps just enough player/playlist state in memory to make those
+    calls behave sensibly, and can inject artificial latency and
+    failures.
+
+    Run it with ``python -m bender_mc.kodi.fake_server`` and point the
+    ``[kodirpc]`` url in your config.ini at it.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import base64
+import json
+import logging
+import random
+import threading
+import time
+import click
+from cheroot import wsgi
+
+logger = logging.getLogger(__name__)
+
+
+# Positional parameter names, used to normalize list style params.
+POSITIONAL_PARAMS = {
+    "Addons.ExecuteAddon": ["addonid", "params", "wait"],
+    "GUI.SetFullscreen": ["fullscreen"],
+    "Input.ExecuteAction": ["action"],
+    "Player.GoTo": ["playerid", "to"],
+    "Player.Open": ["item", "options"],
+    "Player.PlayPause": ["playerid", "play"],
+    "Player.Seek": ["playerid", "value"],
+    "Playlist.Add": ["playlistid", "item"],
+    "Playlist.Clear": ["playlistid"],
+    "Playlist.GetItems": ["playlistid"],
+    "Playlist.Insert": ["playlistid", "position", "item"],
+    "Settings.GetSettingValue": ["setting"],
+    "Settings.SetSettingValue": ["setting", "value"],
+}
+
+
+class FakeKodiError(Exception):
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super(FakeKodiError, self).__init__(message)
+
+
+class FakeKodi(object):
+
+    """In memory Kodi state and JSON-RPC method implementations.
+
+    :param float latency: Seconds to wait before answering each HTTP
+        request.
+    :param float jitter: Maximum random seconds added to `latency`.
+    :param float failure_rate: Probability (0-1) that an HTTP request
+        fails with a 500 status.
+    :param float error_rate: Probability (0-1) that any single call in
+        a request returns a JSON-RPC error instead of a result.
+    :param float hang_rate: Probability (0-1) that an HTTP request
+        hangs for `hang_time` seconds before being answered, as Kodi
+        does while restarting.
+    :param float hang_time: Seconds a hung request is held for.
+
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 error_rate=0.0, hang_rate=0.0, hang_time=30.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_time = hang_time
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.settings = {
+                "videoscreen.monitor": "\\\\.\\DISPLAY1",
+                "videoscreen.screen": 0
+            }
+            self.playlists = {0: [], 1: [], 2: []}
+            self.player = None
+            self.fullscreen = False
+            self.executed_addons = []
+            self.inputs = []
+            self.call_counts = {}
+            self.http_requests = 0
+
+    def configure(self, **kwargs):
+        """Change the injected faults.
+
+        :raise ValueError: If a value isn't a number. Nothing is
+            changed in that case.
+
+        """
+        values = {}
+        for key in ("latency", "jitter", "failure_rate", "error_rate",
+                    "hang_rate", "hang_time"):
+            if key in kwargs and kwargs[key] is not None:
+                try:
+                    values[key] = float(kwargs[key])
+                except (TypeError, ValueError):
+                    raise ValueError(f"{key} must be a number.")
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    @property
+    def faults(self):
+        return {
+            "latency": self.latency,
+            "jitter": self.jitter,
+            "failureRate": self.failure_rate,
+            "errorRate": self.error_rate,
+            "hangRate": self.hang_rate,
+            "hangTime": self.hang_time
+        }
+
+    @property
+    def state(self):
+        with self.lock:
+            return {
+                "settings": dict(self.settings),
+                "playlists": {
+                    str(k): list(v) for k, v in self.playlists.items()},
+                "player": dict(self.player) if self.player else None,
+                "fullscreen": self.fullscreen,
+                "executedAddons": list(self.executed_addons),
+                "inputs": list(self.inputs),
+                "callCounts": dict(self.call_counts),
+                "httpRequests": self.http_requests,
+                "faults": self.faults
+            }
+
+    def delay(self):
+        """Sleep for the configured latency, possibly hanging."""
+        if self.hang_rate and random.random() < self.hang_rate:
+            time.sleep(self.hang_time)
+        wait = self.latency
+        if self.jitter:
+            wait += random.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    def handle_call(self, call):
+        """Handle a single JSON-RPC call, returning the response dict."""
+        call_id = call.get("id") if isinstance(call, dict) else None
+        try:
+            if not isinstance(call, dict) or "method" not in call:
+                raise FakeKodiError(-32600, "Invalid request.")
+            method = call["method"]
+            params = call.get("params", {})
+            if isinstance(params, list):
+                names = POSITIONAL_PARAMS.get(method, [])
+                params = dict(zip(names, params))
+            if self.error_rate and random.random() < self.error_rate:
+                raise FakeKodiError(-32100, "Injected failure.")
+            result = self.dispatch(method, params or {})
+        except FakeKodiError as exc:
+            return {
+                "id": call_id,
+                "jsonrpc": "2.0",
+                "error": {"code": exc.code, "message": exc.message}
+            }
+        return {"id": call_id, "jsonrpc": "2.0", "result": result}
+
+    def dispatch(self, method, params):
+        # Kodi treats method names case insensitively (Input.down)
+        namespace, _, name = method.partition(".")
+        handler_name = "rpc_" + namespace.lower() + "_" + name.lower()
+        handler = getattr(self, handler_name, None)
+        if handler is None:
+            raise FakeKodiError(-32601, "Method not found.")
+        with self.lock:
+            self.call_counts[method] = self.call_counts.get(method, 0) + 1
+            return handler(params)
+
+    # JSONRPC
+    def rpc_jsonrpc_ping(self, params):
+        return "pong"
+
+    # Settings
+    def rpc_settings_getsettingvalue(self, params):
+        setting = params.get("setting")
+        if setting not in self.settings:
+            raise FakeKodiError(-32602, "Invalid params.")
+        return {"value": self.settings[setting]}
+
+    def rpc_settings_setsettingvalue(self, params):
+        self.settings[params.get("setting")] = params.get("value")
+        return True
+
+    # GUI
+    def rpc_gui_setfullscreen(self, params):
+        fullscreen = params.get("fullscreen")
+        if fullscreen == "toggle":
+            fullscreen = not self.fullscreen
+        self.fullscreen = bool(fullscreen)
+        return self.fullscreen
+
+    # Input
+    def rpc_input_executeaction(self, params):
+        self.inputs.append(params.get("action"))
+        return "OK"
+
+    def _input(self, name):
+        self.inputs.append(name)
+        return "OK"
+
+    def rpc_input_up(self, params):
+        return self._input("up")
+
+    def rpc_input_down(self, params):
+        return self._input("down")
+
+    def rpc_input_left(self, params):
+        return self._input("left")
+
+    def rpc_input_right(self, params):
+        return self._input("right")
+
+    def rpc_input_select(self, params):
+        return self._input("select")
+
+    def rpc_input_back(self, params):
+        return self._input("back")
+
+    # Addons
+    def rpc_addons_executeaddon(self, params):
+        self.executed_addons.append(params.get("addonid"))
+        return "OK"
+
+    # Playlist
+    def _playlist(self, params):
+        playlist_id = params.get("playlistid")
+        if playlist_id not in self.playlists:
+            raise FakeKodiError(-32602, "Invalid params.")
+        return self.playlists[playlist_id]
+
+    def rpc_playlist_clear(self, params):
+        self._playlist(params)[:] = []
+        return "OK"
+
+    def rpc_playlist_add(self, params):
+        playlist = self._playlist(params)
+        items = params.get("item")
+        if isinstance(items, dict):
+            items = [items]
+        playlist.extend(items or [])
+        return "OK"
+
+    def rpc_playlist_insert(self, params):
+        playlist = self._playlist(params)
+        position = params.get("position", 0)
+        if not isinstance(position, int) or position > len(playlist):
+            raise FakeKodiError(-32602, "Invalid params.")
+        playlist.insert(position, params.get("item"))
+        return "OK"
+
+    def rpc_playlist_getitems(self, params):
+        items = list(self._playlist(params))
+        return {
+            "items": items,
+            "limits": {"start": 0, "end": len(items), "total": len(items)}
+        }
+
+    # Player
+    def _active_player(self):
+        if self.player is None:
+            raise FakeKodiError(-32100, "No active player.")
+        return self.player
+
+    def rpc_player_open(self, params):
+        item = params.get("item") or {}
+        options = params.get("options") or {}
+        if "playlistid" in item:
+            playlist = self._playlist(item)
+            position = item.get("position", 0)
+            if position >= len(playlist):
+                raise FakeKodiError(-32602, "Invalid params.")
+            current = playlist[position]
+        else:
+            current = item
+            position = None
+        resume = options.get("resume")
+        seconds = 0
+        if isinstance(resume, dict):
+            seconds = (resume.get("hours", 0) * 3600 +
+                       resume.get("minutes", 0) * 60 +
+                       resume.get("seconds", 0))
+        self.player = {
+            "playerid": 1,
+            "item": current,
+            "playlistid": item.get("playlistid"),
+            "position": position,
+            "speed": 1,
+            "time": seconds
+        }
+        return "OK"
+
+    def rpc_player_getactiveplayers(self, params):
+        if self.player is None:
+            return []
+        return [{"playerid": 1, "type": "video"}]
+
+    def rpc_player_playpause(self, params):
+        player = self._active_player()
+        play = params.get("play", "toggle")
+        if play == "toggle":
+            player["speed"] = 0 if player["speed"] else 1
+        else:
+            player["speed"] = 1 if play else 0
+        return {"speed": player["speed"]}
+
+    def rpc_player_goto(self, params):
+        player = self._active_player()
+        playlist = self.playlists.get(player["playlistid"])
+        if playlist is None:
+            raise FakeKodiError(-32100, "Player is not using a playlist.")
+        to = params.get("to")
+        if to == "next":
+            position = player["position"] + 1
+        elif to == "previous":
+            position = player["position"] - 1
+        else:
+            position = to
+        if not isinstance(position, int) or not (
+                0 <= position < len(playlist)):
+            raise FakeKodiError(-32602, "Invalid params.")
+        player["position"] = position
+        player["item"] = playlist[position]
+        player["time"] = 0
+        return "OK"
+
+    def rpc_player_seek(self, params):
+        player = self._active_player()
+        value = params.get("value") or {}
+        if isinstance(value, dict) and "seconds" in value:
+            player["time"] = value["seconds"]
+        return {"time": player["time"]}
+
+
+class FakeKodiApp(object):
+
+    """WSGI application serving a :class:`FakeKodi` instance.
+
+    Besides ``/jsonrpc`` it exposes ``GET /fake/state`` to inspect the
+    fake's state and ``POST /fake/config`` (JSON body using the
+    :class:`FakeKodi` constructor argument names) to change the
+    injected faults while a load test is running. ``POST /fake/reset``
+    clears all state.
+
+    """
+
+    def __init__(self, kodi=None, username=None, password=None):
+        self.kodi = kodi or FakeKodi()
+        self.username = username
+        self.password = password
+
+    @staticmethod
+    def _respond(start_response, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        start_response(status, [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(payload)))])
+        return [payload]
+
+    def _authorized(self, environ):
+        if not self.username:
+            return True
+        header = environ.get("HTTP_AUTHORIZATION", "")
+        if not header.startswith("Basic "):
+            return False
+        try:
+            decoded = base64.b64decode(header[6:]).decode("utf-8")
+        except ValueError:
+            return False
+        return decoded == f"{self.username}:{self.password}"
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        method = environ.get("REQUEST_METHOD", "GET").upper()
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        body = environ["wsgi.input"].read(length) if length else b""
+        if path.startswith("/fake/"):
+            return self._admin(path, method, body, start_response)
+        if not path.startswith("/jsonrpc"):
+            return self._respond(
+                start_response, "404 Not Found", {"error": "Not found."})
+        if not self._authorized(environ):
+            return self._respond(
+                start_response, "401 Unauthorized",
+                {"error": "Unauthorized."})
+        with self.kodi.lock:
+            self.kodi.http_requests += 1
+        self.kodi.delay()
+        if self.kodi.failure_rate and (
+                random.random() < self.kodi.failure_rate):
+            return self._respond(
+                start_response, "500 Internal Server Error",
+                {"error": "Injected failure."})
+        try:
+            data = json.loads(body.decode("utf-8"))
+        except ValueError:
+            return self._respond(start_response, "200 OK", {
+                "id": None,
+                "jsonrpc": "2.0",
+                "error": {"code": -32700, "message": "Parse error."}})
+        if isinstance(data, list):
+            result = [self.kodi.handle_call(call) for call in data]
+        else:
+            result = self.kodi.handle_call(data)
+        return self._respond(start_response, "200 OK", result)
+
+    def _admin(self, path, method, body, start_response):
+        if path == "/fake/state" and method == "GET":
+            return self._respond(start_response, "200 OK", self.kodi.state)
+        if path == "/fake/config" and method == "POST":
+            try:
+                options = json.loads(body.decode("utf-8") or "{}")
+            except ValueError:
+                return self._respond(
+                    start_response, "400 Bad Request",
+                    {"error": "Invalid JSON."})
+            if not isinstance(options, dict):
+                return self._respond(
+                    start_response, "400 Bad Request",
+                    {"error": "Expected a JSON object."})
+            try:
+                self.kodi.configure(**options)
+            except ValueError as exc:
+                return self._respond(
+                    start_response, "400 Bad Request", {"error": str(exc)})
+            return self._respond(start_response, "200 OK", self.kodi.faults)
+        if path == "/fake/reset" and method == "POST":
+            self.kodi.reset()
+            return self._respond(start_response, "200 OK", self.kodi.state)
+        return self._respond(
+            start_response, "404 Not Found", {"error": "Not found."})
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Interface to bind to.")
+@click.option("--port", default=8080, type=int, help="Port to listen on.")
+@click.option("--username", default=None,
+              help="Require basic auth with this username.")
+@click.option("--password", default=None,
+              help="Password to go with --username.")
+@click.option("--latency", default=0.0, type=float,
+              help="Seconds of artificial latency per HTTP request.")
+@click.option("--jitter", default=0.0, type=float,
+              help="Maximum random seconds added to the latency.")
+@click.option("--failure-rate", default=0.0, type=float,
+              help="Probability of answering a request with HTTP 500.")
+@click.option("--error-rate", default=0.0, type=float,
+              help="Probability of a JSON-RPC error for each call.")
+@click.option("--hang-rate", default=0.0, type=float,
+              help="Probability of a request hanging for --hang-time.")
+@click.option("--hang-time", default=30.0, type=float,
+              help="Seconds a hung request is held for.")
+@click.option("--threads", default=10, type=int,
+              help="Number of server worker threads.")
+def run(host, port, username, password, latency, jitter, failure_rate,
+        error_rate, hang_rate, hang_time, threads):
+    """Run a fake Kodi JSON-RPC server."""
+    kodi = FakeKodi(
+        latency=latency, jitter=jitter, failure_rate=failure_rate,
+        error_rate=error_rate, hang_rate=hang_rate, hang_time=hang_time)
+    app = FakeKodiApp(kodi, username=username, password=password)
+    server = wsgi.Server((host, port), app, numthreads=threads)
+    print(f"Fake Kodi JSON-RPC server running at http://{host}:{port}/")
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    run()
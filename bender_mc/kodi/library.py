@@ -0,0 +1,38 @@
+"""
+    bender_mc.kodi.library
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Helpers for tracking the state of the Kodi video library.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+from sqlalchemy import func
+from bender_mc.kodi.models.video import (
+    Bookmark, Episode, File, Movie, TvShow)
+
+
+def library_fingerprint(db_session):
+    """Get a cheap value that changes whenever the library does.
+
+    Combines the row count, highest id and total title length of
+    movies, shows and episodes with the latest play time and bookmarks,
+    so adding, removing, renaming or watching something changes the
+    result.
+
+    :return: A tuple, suitable for comparing or using as a cache key.
+
+    """
+    fingerprint = []
+    for model, id_column in ((Movie, Movie.id_movie),
+                             (TvShow, TvShow.id_show),
+                             (Episode, Episode.id_episode)):
+        fingerprint.extend(db_session.query(
+            func.count(id_column),
+            func.max(id_column),
+            func.coalesce(func.sum(func.length(model.title)), 0)).one())
+    fingerprint.append(db_session.query(func.max(File.last_played)).scalar())
+    fingerprint.extend(db_session.query(
+        func.count(Bookmark.id_bookmark),
+        func.max(Bookmark.id_bookmark),
+        func.coalesce(func.sum(Bookmark.time_in_seconds), 0)).one())
+    return tuple(fingerprint)
@@ -0,0 +1,94 @@
+"""
+    bender_mc.kodi.playlist
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Builds the JSON-RPC calls needed to queue up and start a playlist.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+
+
+MEDIA_ID_KEYS = {
+    "movie": "movieid",
+    "episode": "episodeid",
+    "musicvideo": "musicvideoid"
+}
+
+
+class PlaylistBuilder(object):
+
+    """Collects playlist items and turns them into one RPC batch.
+
+    Items play in the order they were added. The generated calls are
+    meant to be sent as a single JSON-RPC batch, which Kodi executes in
+    array order:
+
+    1. ``Playlist.Clear`` empties the playlist.
+    2. ``Playlist.Add`` appends every item at once, in order.
+    3. ``Player.Open`` starts the first item, resuming if requested.
+    4. ``GUI.SetFullscreen`` switches to fullscreen video.
+
+    :param int playlist_id: Kodi playlist to build (1 is video).
+
+    """
+
+    def __init__(self, playlist_id=1):
+        self.playlist_id = playlist_id
+        self.items = []
+
+    def add(self, media_type, media_id):
+        """Append a single item to the end of the playlist.
+
+        :param str media_type: One of `movie`, `episode` or
+            `musicvideo`.
+        :param int media_id: Kodi database id of the item.
+        :return: This builder, to allow chaining.
+
+        """
+        if media_type not in MEDIA_ID_KEYS:
+            raise ValueError(f"Unsupported media type: {media_type}")
+        self.items.append({MEDIA_ID_KEYS[media_type]: media_id})
+        return self
+
+    def extend(self, media_type, media_ids):
+        """Append several items of the same type, in order."""
+        for media_id in media_ids:
+            self.add(media_type, media_id)
+        return self
+
+    @staticmethod
+    def resume_option(resume_time):
+        """Convert seconds into a ``Player.Open`` resume option."""
+        if not resume_time:
+            return False
+        resume_time = int(resume_time)
+        return {
+            "hours": resume_time // 3600,
+            "minutes": (resume_time % 3600) // 60,
+            "seconds": resume_time % 60
+        }
+
+    def calls(self, resume_time=None, fullscreen=True):
+        """Get the ordered list of `(method, params)` calls.
+
+        :param resume_time: Seconds into the first item to start at.
+        :param bool fullscreen: Whether to switch to fullscreen video
+            once the player has opened.
+
+        """
+        if not self.items:
+            raise ValueError("Can't build an empty playlist.")
+        calls = [
+            ("Playlist.Clear", {"playlistid": self.playlist_id}),
+            ("Playlist.Add", {
+                "playlistid": self.playlist_id,
+                "item": list(self.items)
+            }),
+            ("Player.Open", {
+                "item": {"playlistid": self.playlist_id, "position": 0},
+                "options": {"resume": self.resume_option(resume_time)}
+            })
+        ]
+        if fullscreen:
+            calls.append(("GUI.SetFullscreen", {"fullscreen": True}))
+        return calls
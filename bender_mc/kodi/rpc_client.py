@@ -7,44 +7,247 @@
 # :copyright: (c) 2020 by Nicholas Repole and contributors.
 #             See AUTHORS for more details.
 # :license: MIT - See LICENSE for more details.
+import threading
 import time
 from drowsy.log import Loggable
 import requests
+from bender_mc import metrics
+from bender_mc.kodi.playlist import PlaylistBuilder
+
+
+class KodiRpcError(Exception):
+
+    """Raised when a Kodi RPC call can't be completed."""
+
+    def __init__(self, message, code=None):
+        self.message = message
+        self.code = code
+        super(KodiRpcError, self).__init__(message)
+
+
+class KodiUnavailableError(KodiRpcError):
+
+    """Raised when Kodi can't be reached, or the circuit is open."""
+
+
+class KodiTimeoutError(KodiRpcError):
+
+    """Raised when a call times out or the request deadline passed."""
+
+
+class CircuitBreaker(Loggable):
+
+    """Fail fast once Kodi has stopped responding.
+
+    After `failure_threshold` consecutive failures the circuit opens
+    and calls are rejected without touching the network. Once
+    `reset_timeout` seconds have passed, a single trial call is let
+    through; its success closes the circuit again, its failure keeps
+    it open for another `reset_timeout` seconds.
+
+    :param int failure_threshold: Consecutive failures before opening.
+    :param float reset_timeout: Seconds to stay open before allowing a
+        trial call.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=15.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return `True` if a call may be attempted right now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and (
+                    time.monotonic() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                self.logger.info("Kodi responded, closing circuit.")
+            self.failures = 0
+            self.opened_at = None
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    self.logger.warning(
+                        "Kodi is unresponsive, opening circuit.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
 
 
 class KodiRpcClient(Loggable):
 
-    def __init__(self, base_url, username, password):
+    def __init__(self, base_url, username, password, timeout=5.0,
+                 connect_timeout=2.0, deadline=None, circuit_breaker=None,
+                 session=None):
         """
 
         :param str base_url:
         :param username:
         :param password:
+        :param float timeout: Maximum seconds to wait on any one call.
+        :param float connect_timeout: Maximum seconds to wait for a
+            connection to Kodi to be established.
+        :param deadline: Optional :class:`~bender_mc.utils.Deadline`
+            that bounds every call made by this client.
+        :param circuit_breaker: Optional :class:`CircuitBreaker`,
+            typically shared between clients for the same Kodi.
+        :param session: Optional :class:`requests.Session` to reuse,
+            so connections to Kodi are kept alive across clients.
 
         """
         self.username = username
         self.password = password
         self.base_url = base_url
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.deadline = deadline
+        self.circuit_breaker = circuit_breaker
         self.req_counter = 140
-        self.req_session = requests.Session()
+        self.req_session = session or requests.Session()
         if not self.base_url.endswith("/"):
             self.base_url += "/"
 
-    def post_rpc(self, method, params):
+    def _timeouts(self, method):
+        """Get a (connect, read) timeout tuple bounded by the deadline."""
+        timeout = self.timeout
+        connect_timeout = self.connect_timeout
+        if self.deadline is not None:
+            if self.deadline.expired:
+                raise KodiTimeoutError(
+                    f"Request deadline passed before calling {method}.",
+                    code="deadline_exceeded")
+            timeout = self.deadline.bound(timeout)
+            connect_timeout = self.deadline.bound(connect_timeout)
+            if any(t is not None and t <= 0
+                   for t in (timeout, connect_timeout)):
+                # The deadline passed since checking it, and requests
+                # rejects a zero timeout.
+                raise KodiTimeoutError(
+                    f"Request deadline passed before calling {method}.",
+                    code="deadline_exceeded")
+        return connect_timeout, timeout
+
+    def _post(self, payload, label):
+        """Post a JSON-RPC payload, enforcing timeouts and the breaker.
+
+        :param list payload: List of JSON-RPC call dicts.
+        :param str label: Name used in the url and error messages.
+
+        """
+        timeouts = self._timeouts(label)
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            raise KodiUnavailableError(
+                "Kodi is not responding.", code="kodi_unavailable")
+        url = self.base_url + f"jsonrpc?{label}"
+        succeeded = False
+        try:
+            with metrics.timed("rpc", label):
+                result = self.req_session.post(
+                    url,
+                    auth=(self.username, self.password),
+                    headers={"Connection": "keep-alive"},
+                    json=payload,
+                    timeout=timeouts)
+            if result.status_code >= 500:
+                metrics.rpc_errors.inc(label, f"http_{result.status_code}")
+            else:
+                succeeded = True
+        except requests.Timeout:
+            metrics.rpc_errors.inc(label, "kodi_timeout")
+            raise KodiTimeoutError(
+                f"Kodi timed out responding to {label}.",
+                code="kodi_timeout")
+        except requests.ConnectionError:
+            metrics.rpc_errors.inc(label, "kodi_unavailable")
+            raise KodiUnavailableError(
+                f"Unable to connect to Kodi for {label}.",
+                code="kodi_unavailable")
+        except requests.RequestException as exc:
+            metrics.rpc_errors.inc(label, "kodi_error")
+            raise KodiUnavailableError(
+                f"Unable to call Kodi for {label}: {exc}",
+                code="kodi_unavailable")
+        finally:
+            # Recorded whatever happened, so a failed half open trial
+            # can't leave the circuit stuck rejecting calls.
+            if breaker is not None:
+                if succeeded:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+        return result
+
+    def _call_data(self, method, params):
         data = {
             "jsonrpc": "2.0",
             "method": method,
             "params": params,
             "id": self.req_counter
         }
-        url = self.base_url + f"jsonrpc?{method}"
-        result = self.req_session.post(
-            url,
-            auth=(self.username, self.password),
-            headers={"Connection": "keep-alive"},
-            json=[data])
         self.req_counter += 1
-        return result
+        return data
+
+    def post_rpc(self, method, params):
+        return self._post([self._call_data(method, params)], method)
+
+    def post_rpc_batch(self, calls):
+        """Send several calls to Kodi in a single HTTP request.
+
+        Kodi executes the calls of a batch one after the other, in the
+        order given.
+
+        :param list calls: List of `(method, params)` tuples.
+        :return: List of JSON-RPC response dicts, in the same order as
+            `calls`.
+        :raise KodiRpcError: If Kodi returns an error for any call.
+
+        """
+        payload = [self._call_data(method, params) for method, params in calls]
+        label = ",".join(method for method, _ in calls)
+        response = self._post(payload, label)
+        try:
+            by_id = {r.get("id"): r for r in response.json()}
+        except (ValueError, AttributeError):
+            raise KodiRpcError(
+                f"Invalid response from Kodi for {label}.",
+                code="kodi_error")
+        results = []
+        for data in payload:
+            result = by_id.get(data["id"])
+            if result is None or "error" in result:
+                error = (result or {}).get("error") or {}
+                raise KodiRpcError(
+                    f"Kodi failed to execute {data['method']}: "
+                    f"{error.get('message', 'no response')}",
+                    code="kodi_error")
+            results.append(result)
+        return results
+
+    def ping(self):
+        """Check Kodi is responding, returning `True` if it is."""
+        return self.post_rpc(
+            method="JSONRPC.Ping", params={}).json()[0]["result"] == "pong"
 
     def get_monitor(self):
         return self.post_rpc(
@@ -97,56 +300,21 @@ class KodiRpcClient(Loggable):
         return result
 
     def play_video(self, media_id, media_type, resume_time=None):
-        media_ids = []
-        if isinstance(media_id, list):
-            media_ids = media_id
-            media_id = media_ids[0]
-            media_ids.pop(0)
+        """Replace the video playlist and start playing it.
+
+        The whole playlist is built and started in a single request.
+
+        :param media_id: Id of the item to play, or a list of ids to
+            queue up in order, the first of which is played.
+        :param str media_type: `movie` or `episode`.
+        :param resume_time: Seconds into the first item to start at.
+
+        """
+        media_ids = media_id if isinstance(media_id, list) else [media_id]
         # TODO - Get playlist id? Assuming 1..
-        playlist_id = 1
-        clear_playlist = self.post_rpc(
-            method="Playlist.Clear",
-            params=[playlist_id]
-        )
-        if media_type == "movie":
-            media_id_key = "movieid"
-        else:
-            media_id_key = "episodeid"
-        playlist_insert = self.post_rpc(
-            method="Playlist.Insert",
-            params=[playlist_id, 0, {media_id_key: media_id}]
-        )
-        player_open = self.post_rpc(
-            method="Player.Open",
-            params={
-                "item": {
-                    "position": 0,
-                    "playlistid": playlist_id
-                },
-                "options": {
-                    "resume": {"hours": 1, "minutes": 0, "seconds": 8}
-                }
-            }
-        )
-        gui_set_fullscreen = self.post_rpc(
-            method="GUI.SetFullscreen",
-            params=[True]
-        )
-        if resume_time:
-            time.sleep(.5)
-            player_seek = self.post_rpc(
-                method="Player.Seek",
-                params={
-                    "playerid": 1,
-                    "value":  {"seconds": int(resume_time)}
-                }
-            )
-        for i, next_id in media_ids:
-            queue_insert = self.post_rpc(
-                method="Playlist.Insert",
-                params=[playlist_id, (i + 1), {media_id_key: next_id}]
-            )
-        return
+        builder = PlaylistBuilder(playlist_id=1)
+        builder.extend(media_type, media_ids)
+        return self.post_rpc_batch(builder.calls(resume_time=resume_time))
 
     def play_mlb(self, list_index, is_home, game_status):
         open_mlb = self.post_rpc(
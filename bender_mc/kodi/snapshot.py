@@ -0,0 +1,468 @@
+"""
+    bender_mc.kodi.snapshot
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Read-only snapshot of the video library, stored in a compact binary
+    file that worker processes memory map rather than each building
+    their own copy.
+
+    File layout (little-endian)::
+
+        header
+        string offsets   (string_count + 1) x uint32
+        movies           movie_count x MOVIE
+        tv shows         show_count x SHOW
+        episodes         episode_count x EPISODE, sorted by show,
+                         season and episode number
+        string data      utf-8
+
+    Strings are referred to by their index in the string table, with
+    index 0 always being the empty string.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import mmap
+import os
+import struct
+import time
+from drowsy.log import Loggable
+from sqlalchemy import select
+from bender_mc.kodi.models.video import Bookmark, Episode, File, Movie, TvShow
+
+MAGIC = b"BMLS"
+FORMAT_VERSION = 2
+
+# magic, format version, fingerprint string, string count, movie count,
+# show count, episode count
+HEADER = struct.Struct("<4sIIIIII")
+OFFSET = struct.Struct("<I")
+# id_movie, title, slot text, play count
+MOVIE = struct.Struct("<iIIi")
+# id_show, title, slot text
+SHOW = struct.Struct("<iII")
+# id_episode, id_show, season, episode, title, slot text, play count,
+# last played, flags
+EPISODE = struct.Struct("<iiiiIIiIB")
+EPISODE_RESUMABLE = 1
+EPISODE_HAS_FILE = 2
+
+
+class SnapshotError(Exception):
+
+    """Raised when a snapshot file is missing or unreadable."""
+
+
+def _to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class _StringTable(object):
+
+    def __init__(self):
+        self.strings = [""]
+        self.indexes = {"": 0}
+
+    def add(self, value):
+        if value is None:
+            return 0
+        value = str(value)
+        index = self.indexes.get(value)
+        if index is None:
+            index = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+
+def build_snapshot(db_session, fingerprint, slots):
+    """Serialize the video library into the snapshot format.
+
+    :param db_session: Session for the Kodi video database.
+    :param fingerprint: Value identifying the state of the library, as
+        from :func:`~bender_mc.kodi.library.library_fingerprint`.
+    :param slots: `(movies, tv_shows, episodes)` dicts mapping spoken
+        text to ``{id}-{media_type}``, as generated for the slots API.
+    :return: The snapshot, as bytes.
+
+    """
+    strings = _StringTable()
+    slot_texts = {}
+    for results in slots:
+        for spoken_text, converted_value in results.items():
+            slot_texts[converted_value] = spoken_text
+    movies = db_session.query(
+        Movie.id_movie, Movie.title, File.play_count
+    ).outerjoin(File, Movie.id_file == File.id_file).all()
+    tv_shows = db_session.query(TvShow.id_show, TvShow.title).all()
+    resumable = select([Bookmark.id_file]).where(
+        Bookmark.time_in_seconds > 0)
+    episodes = db_session.query(
+        Episode.id_episode, Episode.id_show, Episode.season_number,
+        Episode.episode_number, Episode.title, File.id_file,
+        File.play_count, File.last_played, File.id_file.in_(resumable)
+    ).outerjoin(File, Episode.id_file == File.id_file).all()
+    rows = []
+    for id_movie, title, play_count in movies:
+        rows.append(MOVIE.pack(
+            id_movie, strings.add(title),
+            strings.add(slot_texts.get(f"{id_movie}-movie")),
+            -1 if play_count is None else play_count))
+    movie_rows = b"".join(rows)
+    rows = []
+    for id_show, title in tv_shows:
+        rows.append(SHOW.pack(
+            id_show, strings.add(title),
+            strings.add(slot_texts.get(f"{id_show}-tvshow"))))
+    show_rows = b"".join(rows)
+    episode_values = []
+    for (id_episode, id_show, season, episode, title, id_file, play_count,
+         last_played, has_bookmark) in episodes:
+        flags = 0
+        if id_file is not None:
+            flags |= EPISODE_HAS_FILE
+        if has_bookmark:
+            flags |= EPISODE_RESUMABLE
+        episode_values.append((
+            _to_int(id_show), _to_int(season), _to_int(episode),
+            id_episode, title, play_count, last_played, flags))
+    episode_values.sort()
+    rows = []
+    for (id_show, season, episode, id_episode, title, play_count,
+         last_played, flags) in episode_values:
+        rows.append(EPISODE.pack(
+            id_episode, id_show, season, episode, strings.add(title),
+            strings.add(slot_texts.get(f"{id_episode}-episode")),
+            -1 if play_count is None else play_count,
+            strings.add(last_played), flags))
+    episode_rows = b"".join(rows)
+    fingerprint_index = strings.add(repr(fingerprint))
+    encoded = [value.encode("utf-8") for value in strings.strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, fingerprint_index, len(encoded),
+        len(movies), len(tv_shows), len(episode_values))
+    return b"".join([
+        header,
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        movie_rows, show_rows, episode_rows,
+        b"".join(encoded)])
+
+
+def write_snapshot(path, data):
+    """Atomically replace the snapshot at `path` with `data`.
+
+    Readers with the old file mapped keep their view of it until they
+    reattach.
+
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+class LibrarySnapshot(Loggable):
+
+    """Read only view of a serialized library snapshot.
+
+    Rows are decoded on access straight from `buffer`, which is
+    typically a memory mapped file shared by every worker process.
+
+    :param buffer: The snapshot data, e.g. an :class:`mmap.mmap`.
+    :param str path: The file the snapshot was loaded from, if any.
+    :param file_id: Identity of that file when it was loaded, see
+        :meth:`is_stale`.
+
+    """
+
+    def __init__(self, buffer, path=None, file_id=None):
+        self.buffer = buffer
+        self.path = path
+        self.file_id = file_id
+        if len(buffer) < HEADER.size:
+            raise SnapshotError("Snapshot is truncated.")
+        (magic, version, fingerprint_index, self.string_count,
+         self.movie_count, self.show_count,
+         self.episode_count) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SnapshotError("Not a compatible library snapshot.")
+        self._offsets_start = HEADER.size
+        self._movies_start = (
+            self._offsets_start + OFFSET.size * (self.string_count + 1))
+        self._shows_start = self._movies_start + MOVIE.size * self.movie_count
+        self._episodes_start = (
+            self._shows_start + SHOW.size * self.show_count)
+        self._strings_start = (
+            self._episodes_start + EPISODE.size * self.episode_count)
+        if len(buffer) < self._strings_start:
+            raise SnapshotError("Snapshot is truncated.")
+        self.fingerprint = self.string(fingerprint_index)
+
+    @classmethod
+    def open(cls, path):
+        """Memory map the snapshot file at `path`.
+
+        :raise SnapshotError: If the file is missing or invalid.
+
+        """
+        try:
+            with open(path, "rb") as snapshot_file:
+                file_id = cls._file_id(os.fstat(snapshot_file.fileno()))
+                buffer = mmap.mmap(
+                    snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exc:
+            raise SnapshotError(f"Unable to open snapshot: {exc}") from exc
+        return cls(buffer, path=path, file_id=file_id)
+
+    @staticmethod
+    def _file_id(stat):
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def is_stale(self):
+        """Whether the file this was loaded from has been replaced."""
+        if self.path is None:
+            return False
+        try:
+            return self._file_id(os.stat(self.path)) != self.file_id
+        except OSError:
+            return True
+
+    def string(self, index):
+        start, end = struct.unpack_from(
+            "<II", self.buffer, self._offsets_start + OFFSET.size * index)
+        start += self._strings_start
+        end += self._strings_start
+        return self.buffer[start:end].decode("utf-8")
+
+    def movies(self):
+        """Iterate `(id_movie, title, slot_text, play_count)` rows."""
+        for i in range(self.movie_count):
+            id_movie, title, slot, play_count = MOVIE.unpack_from(
+                self.buffer, self._movies_start + MOVIE.size * i)
+            yield (id_movie, self.string(title), self.string(slot),
+                   None if play_count < 0 else play_count)
+
+    def tv_shows(self):
+        """Iterate `(id_show, title, slot_text)` rows."""
+        for i in range(self.show_count):
+            id_show, title, slot = SHOW.unpack_from(
+                self.buffer, self._shows_start + SHOW.size * i)
+            yield id_show, self.string(title), self.string(slot)
+
+    def _episode(self, i):
+        return EPISODE.unpack_from(
+            self.buffer, self._episodes_start + EPISODE.size * i)
+
+    def episodes(self, id_show=None):
+        """Iterate episode rows in show, season, episode order.
+
+        Rows are `(id_episode, id_show, season, episode, title,
+        slot_text, play_count, last_played, resumable, has_file)`
+        tuples.
+
+        :param int id_show: Only include episodes of this show.
+
+        """
+        start, end = 0, self.episode_count
+        if id_show is not None:
+            start, end = self._show_range(id_show)
+        for i in range(start, end):
+            (id_episode, episode_show, season, episode, title, slot,
+             play_count, last_played, flags) = self._episode(i)
+            yield (id_episode, episode_show, season, episode,
+                   self.string(title), self.string(slot),
+                   None if play_count < 0 else play_count,
+                   self.string(last_played) or None,
+                   bool(flags & EPISODE_RESUMABLE),
+                   bool(flags & EPISODE_HAS_FILE))
+
+    def _show_range(self, id_show):
+        """Binary search for the episode rows belonging to a show."""
+        low, high = 0, self.episode_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._episode(mid)[1] < id_show:
+                low = mid + 1
+            else:
+                high = mid
+        start = low
+        high = self.episode_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._episode(mid)[1] <= id_show:
+                low = mid + 1
+            else:
+                high = mid
+        return start, low
+
+    def iter_slots(self, media_type):
+        """Iterate `(spoken_text, converted_value)` slot pairs.
+
+        :param str media_type: ``movie``, ``tvshow``, or ``episode``.
+
+        """
+        if media_type == "movie":
+            rows = ((row[0], row[2]) for row in self.movies())
+        elif media_type == "tvshow":
+            rows = ((row[0], row[2]) for row in self.tv_shows())
+        else:
+            rows = ((row[0], row[5]) for row in self.episodes())
+        for media_id, spoken_text in rows:
+            if spoken_text:
+                yield spoken_text, f"{media_id}-{media_type}"
+
+    def video_slots(self):
+        """Get slots in the same format as
+        :func:`~bender_mc.api.slots.generate_video_slots`."""
+        return tuple(
+            dict(self.iter_slots(media_type))
+            for media_type in ("movie", "tvshow", "episode"))
+
+    def next_episode_id(self, id_show, id_episode=None):
+        """Find the episode of a show to play next.
+
+        Mirrors :func:`~bender_mc.api.video.find_next_episode`: the
+        episode after `id_episode` if given, otherwise the most recently
+        played episode with a resume point, the first unplayed episode,
+        or the episode after the most recently played one. Loops back
+        to the first episode if nothing else fits. As in the database
+        queries, episodes without a file are never played or unplayed.
+
+        :return: An episode id, or `None` if the show has no episodes.
+
+        """
+        episodes = list(self.episodes(id_show))
+        by_number = {(row[2], row[3]): row for row in episodes}
+        last_played = None
+        with_files = [row for row in episodes if row[9]]
+        if id_episode is not None:
+            for row in with_files:
+                if row[0] == id_episode:
+                    last_played = row
+                    break
+        else:
+            # Most recent first, never played last, as in SQLite
+            played = sorted(
+                with_files, key=lambda r: r[7] or "", reverse=True)
+            for row in played:
+                if row[8]:
+                    return row[0]
+            for row in with_files:
+                if row[6] is None:
+                    return row[0]
+            if played:
+                last_played = played[0]
+        if last_played is not None:
+            season, episode = last_played[2], last_played[3]
+            for key in ((season, episode + 1), (season + 1, 1)):
+                if key in by_number:
+                    return by_number[key][0]
+        first = by_number.get((1, 1))
+        return first[0] if first is not None else None
+
+
+class SnapshotPublisher(Loggable):
+
+    """Keeps a process attached to an up to date library snapshot.
+
+    Any process that finds the snapshot out of date with the database
+    rebuilds and republishes it. A lock file keeps concurrent workers
+    from all rebuilding at once; the others wait and then attach to the
+    new file.
+
+    :param str path: Where the snapshot file lives.
+    :param float lock_timeout: Seconds after which a lock file is
+        assumed to have been abandoned.
+
+    """
+
+    def __init__(self, path, lock_timeout=30.0):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.lock_timeout = lock_timeout
+        self.snapshot = None
+
+    def _attach(self):
+        if self.snapshot is None or self.snapshot.is_stale():
+            try:
+                self.snapshot = LibrarySnapshot.open(self.path)
+            except SnapshotError:
+                self.snapshot = None
+        return self.snapshot
+
+    def _acquire_lock(self):
+        try:
+            fd = os.open(
+                self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.stat(self.lock_path).st_mtime
+            except OSError:
+                return False
+            if age > self.lock_timeout:
+                self.logger.warning("Removing abandoned snapshot lock.")
+                try:
+                    os.remove(self.lock_path)
+                except OSError:
+                    pass
+            return False
+        os.close(fd)
+        return True
+
+    def _release_lock(self):
+        try:
+            os.remove(self.lock_path)
+        except OSError:
+            pass
+
+    def get(self, db_session, fingerprint, build_slots):
+        """Get a snapshot matching `fingerprint`, rebuilding if needed.
+
+        :param db_session: Session for the Kodi video database.
+        :param fingerprint: Current library fingerprint.
+        :param build_slots: Callable taking `db_session` and returning
+            slots for :func:`build_snapshot`.
+        :return: A :class:`LibrarySnapshot`.
+
+        """
+        expected = repr(fingerprint)
+        deadline = time.monotonic() + self.lock_timeout
+        locked = False
+        while True:
+            snapshot = self._attach()
+            if snapshot is not None and snapshot.fingerprint == expected:
+                return snapshot
+            locked = self._acquire_lock()
+            if locked:
+                break
+            if time.monotonic() > deadline:
+                # Build anyway, but leave the lock to its owner.
+                break
+            # Another process is publishing, wait for it.
+            time.sleep(.05)
+        try:
+            data = build_snapshot(
+                db_session, fingerprint, build_slots(db_session))
+            try:
+                write_snapshot(self.path, data)
+            except OSError:
+                # e.g. the old file is still mapped on Windows. Serve
+                # this process from memory instead.
+                self.logger.exception("Unable to publish library snapshot.")
+                self.snapshot = LibrarySnapshot(data)
+                return self.snapshot
+        finally:
+            if locked:
+                self._release_lock()
+        self.logger.info("Published library snapshot.")
+        return self._attach()
@@ -10,13 +10,24 @@ import os
 import ast
 import configparser
 import logging
+import signal
+import threading
+import time
 from logging.handlers import TimedRotatingFileHandler
 import click
 import flask
 from .api import (
-    video_api_blueprint, slots_blueprint, media_center_api_blueprint)
-from .api.utils import set_db_engine
-from .server import run_wsgi_servers
+    video_api_blueprint, slots_blueprint, media_center_api_blueprint,
+    jobs_blueprint, metrics_blueprint, profiles_blueprint)
+from .api.utils import (
+    set_db_engine, set_profiler, reset_config_registries, dispose_db_engines,
+    warn_unapplied_config)
+from .metrics import instrument_app
+from .profiling import RequestProfiler
+from .server_timing import instrument_server_timing
+from .server import run_wsgi_servers, reload_wsgi_servers
+from .startup import StartupReport
+from .warmup import warm_up, PRELOAD_STEPS
 
 
 def initialize_logger(log_input, user_data_path):
@@ -62,8 +73,16 @@ def initialize_logger(log_input, user_data_path):
         logging.getLogger('sqlalchemy').setLevel(logging.INFO)
 
 
-def get_app(user_data_path):
+def get_app(user_data_path, profile=None):
+    """Build the bender-mc Flask app.
+
+    :param user_data_path: Folder containing config.ini.
+    :param profile: Fraction of requests to profile, overriding the
+        `[profiling]` config section. `None` to use the config.
+
+    """
     app = flask.Flask(__name__)
+    instrument_app(app)
     app_config = app.config
     config = configparser.ConfigParser()
     config.read(os.path.join(user_data_path, "config.ini"))
@@ -76,8 +95,13 @@ def get_app(user_data_path):
                 app_config[section][item[0]] = None
     # Set up database(s)
     if "global" in app_config:
-        set_db_engine("video", app_config["global"]["video_db_connect_string"])
-        set_db_engine("music", app_config["global"]["music_db_connect_string"])
+        pool_size = app_config["global"].get("db_pool_size", 5)
+        set_db_engine(
+            "video", app_config["global"]["video_db_connect_string"],
+            pool_size=pool_size)
+        set_db_engine(
+            "music", app_config["global"]["music_db_connect_string"],
+            pool_size=pool_size)
     else:
         raise ValueError(
             "Must specify a [global] section in your config.")
@@ -92,7 +116,6 @@ def get_app(user_data_path):
         app_config["api_server"]["https_forced"] = False
     if not "root" not in app_config["api_server"]:
         app_config["api_server"]["root"] = ""
-    print("Kodi Assistant is now running.")
     http_url = None
     https_url = None
     hostname = app_config["api_server"].get("hostname") or "localhost"
@@ -120,12 +143,15 @@ def get_app(user_data_path):
             http_url = f"{protocol}://{hostname}:{port}/{root}/api"
         else:
             http_url = f"{protocol}://{hostname}:{port}/api"
+    # Printed once the app is warmed up and listening, see run()
+    ready_message = None
     if http_url and https_url:
-        print(f"API up and running at {http_url} and {https_url}")
+        ready_message = f"API up and running at {http_url} and {https_url}"
     elif http_url:
-        print(f"API up and running at {http_url}.")
+        ready_message = f"API up and running at {http_url}."
     elif https_url:
-        print(f"API up and running at {https_url}.")
+        ready_message = f"API up and running at {https_url}."
+    app_config["api_server"]["ready_message"] = ready_message
     # set global config
     if "global" not in app_config:
         app_config["global"] = {}
@@ -133,25 +159,144 @@ def get_app(user_data_path):
     app.register_blueprint(video_api_blueprint, url_prefix="/api/video")
     app.register_blueprint(media_center_api_blueprint, url_prefix="/api/mediaCenter")
     app.register_blueprint(slots_blueprint, url_prefix="/slots")
+    app.register_blueprint(jobs_blueprint, url_prefix="/api/jobs")
+    app.register_blueprint(metrics_blueprint)
+    app.register_blueprint(profiles_blueprint, url_prefix="/api/profiles")
+    # Set up sampling profiler
+    profiling_config = app_config.get("profiling", {})
+    if profile is None and profiling_config.get("enabled", False):
+        profile = profiling_config.get("sample_rate", .05)
+    if profile:
+        profiler = RequestProfiler(
+            output_dir=os.path.join(user_data_path, "profiles"),
+            sample_rate=profile,
+            keep=profiling_config.get("keep", 100))
+        profiler.instrument(app)
+        set_profiler(profiler)
+    instrument_server_timing(
+        app,
+        debug_footer=app_config["api_server"].get("timing_debug", False))
     return app
 
 
+def reload_app(user_data_path, profile=None):
+    """Rebuild the app from the current config and switch to it
+    without dropping requests.
+
+    The new app is warmed up before it starts taking traffic, see
+    :func:`init_worker`.
+
+    """
+    logger = logging.getLogger("kodi_api")
+    logger.info("Reloading.")
+    reset_config_registries()
+    try:
+        app = get_app(user_data_path, profile=profile)
+    except Exception:
+        logger.exception("Unable to reload, config is invalid.")
+        return None
+    warn_unapplied_config(app.config)
+    reload_wsgi_servers(app=app, user_data_path=user_data_path)
+    logger.info("Reload complete.")
+    return app
+
+
+def preload_app(app):
+    """Do the warm up work that's safe to share with forked workers."""
+    warm_up(app, steps=PRELOAD_STEPS)
+    # Workers must not share the pooled connections.
+    dispose_db_engines()
+
+
+def init_worker(app, worker, is_device):
+    """Get a server process ready to serve `app`.
+
+    :param int worker: Index of the worker process.
+    :param bool is_device: Whether this process owns the devices.
+
+    """
+    warm_up(app, device=is_device)
+
+
+def watch_config(user_data_path, on_change, interval=2.0):
+    """Call `on_change` whenever config.ini is modified.
+
+    Polls from a daemon thread, so works the same on every platform.
+
+    """
+    config_path = os.path.join(user_data_path, "config.ini")
+
+    def get_mtime():
+        try:
+            return os.stat(config_path).st_mtime
+        except OSError:
+            return None
+
+    def poll():
+        last_mtime = get_mtime()
+        while True:
+            time.sleep(interval)
+            mtime = get_mtime()
+            if mtime != last_mtime:
+                last_mtime = mtime
+                on_change()
+
+    thread = threading.Thread(
+        target=poll, name="bender-mc-config-watcher", daemon=True)
+    thread.start()
+    return thread
+
+
 @click.command()
 @click.option('--log',
               type=click.Choice(["fatal", "critical", "error", "warning",
                                  "info", "debug", "sql"]),
               default="info",
               help="Logging level to use.")
-def run(log):
+@click.option('--profile',
+              type=float,
+              is_flag=False,
+              flag_value=.05,
+              default=None,
+              help=("Profile a fraction of requests (default .05), "
+                    "saving them to profiles/."))
+def run(log, profile):
     """Initializes logging, launches an instance of our Kodi API.
 
     :param log:
+    :param profile: Fraction of requests to profile.
     :return:
 
     """
+    startup_report = StartupReport()
     # TODO - figure out the right way to do this across OS...
     user_data_path = os.getcwd()
-    initialize_logger(log, user_data_path)
-    app = get_app(user_data_path)
+    with startup_report.phase("logging"):
+        initialize_logger(log, user_data_path)
+    with startup_report.phase("app"):
+        app = get_app(user_data_path, profile=profile)
+    app.config["startup_report"] = startup_report
     # app.run(host="192.168.1.99", debug=True)
-    run_wsgi_servers(app=app, user_data_path=user_data_path)
+    # Includes warming up, which happens in each server process.
+    with startup_report.phase("servers"):
+        run_wsgi_servers(
+            app=app, user_data_path=user_data_path, preload=preload_app,
+            worker_init=init_worker)
+    print("Kodi Assistant is now running.")
+    if app.config["api_server"].get("ready_message"):
+        print(app.config["api_server"]["ready_message"])
+    logging.getLogger("kodi_api").info(startup_report.summary())
+    print(startup_report.summary())
+    # Reloads run one at a time, off the signal handler's thread.
+    reload_lock = threading.Lock()
+
+    def trigger_reload(*args):
+        def do_reload():
+            with reload_lock:
+                reload_app(user_data_path, profile=profile)
+        threading.Thread(target=do_reload, name="bender-mc-reload").start()
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, trigger_reload)
+    if app.config["api_server"].get("reload_on_change", False):
+        watch_config(user_data_path, trigger_reload)
@@ -0,0 +1,181 @@
+"""
+    bender_mc.loadgen
+    ~~~~~~~~~~~~~~~~~
+
+    Load generator for benchmarking voice command latency.
+
+    Fires concurrent requests at a running bender-mc API (typically
+    backed by :mod:`bender_mc.kodi.fake_server`) and reports throughput
+    and latency percentiles.
+
+    Run it with ``python -m bender_mc.loadgen``.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+import requests
+
+
+# name: (http method, path relative to the server root, body)
+SCENARIOS = {
+    "pause": ("POST", "/api/video/player/state", "pause"),
+    "resume": ("POST", "/api/video/player/state", "resume"),
+    "next": ("POST", "/api/video/player/state", "next"),
+    "movie": ("POST", "/api/video/player/media",
+              {"mediaType": "movie", "mediaId": 1}),
+    "tvshow": ("POST", "/api/video/player/media",
+               {"mediaType": "tvshow", "mediaId": 1, "queueNext": 5}),
+    "volume": ("POST", "/api/mediaCenter/speakers/volume",
+               {"volumeLevel": "increase"}),
+    "monitor": ("POST", "/api/mediaCenter/monitors/switch", {}),
+    "slots": ("GET", "/slots/movies", None),
+    "movies": ("GET", "/api/video/movies", None),
+}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class LoadGenerator(object):
+
+    """Issue requests for a list of scenarios from a pool of threads.
+
+    :param str base_url: Root url of the bender-mc server.
+    :param list scenarios: Scenario names from :data:`SCENARIOS`, used
+        round robin.
+    :param int concurrency: Number of requests in flight at once.
+    :param float timeout: Per request timeout in seconds.
+
+    """
+
+    def __init__(self, base_url, scenarios, concurrency=1, timeout=30.0):
+        self.base_url = base_url.rstrip("/")
+        self.scenarios = scenarios
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.results = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counter = 0
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _next_scenario(self):
+        with self._lock:
+            name = self.scenarios[self._counter % len(self.scenarios)]
+            self._counter += 1
+        return name
+
+    def fire(self):
+        name = self._next_scenario()
+        method, path, body = SCENARIOS[name]
+        kwargs = {"timeout": self.timeout}
+        if isinstance(body, dict):
+            kwargs["json"] = body
+        elif body is not None:
+            kwargs["data"] = body
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, **kwargs)
+            status = response.status_code
+        except requests.RequestException as exc:
+            status = type(exc).__name__
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.results.append((name, status, elapsed))
+
+    def run(self, total=None, duration=None):
+        """Run until `total` requests are sent or `duration` elapses."""
+        deadline = time.monotonic() + duration if duration else None
+        remaining = [total]
+
+        def worker():
+            while True:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                if total is not None:
+                    with self._lock:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                self.fire()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(worker) for _ in range(self.concurrency)]
+        # Raise anything that went wrong in a worker, rather than
+        # reporting a run that didn't happen.
+        for future in futures:
+            future.result()
+        return time.perf_counter() - start
+
+    def report(self, wall_time):
+        """Summarize results per scenario and overall."""
+        summary = {}
+        groups = {}
+        for name, status, elapsed in self.results:
+            groups.setdefault(name, []).append((status, elapsed))
+        groups["all"] = [(s, e) for _, s, e in self.results]
+        for name, rows in groups.items():
+            latencies = sorted(e for _, e in rows)
+            errors = sum(
+                1 for s, _ in rows if not isinstance(s, int) or s >= 400)
+            summary[name] = {
+                "requests": len(rows),
+                "errors": errors,
+                "p50Ms": _ms(percentile(latencies, .5)),
+                "p95Ms": _ms(percentile(latencies, .95)),
+                "p99Ms": _ms(percentile(latencies, .99)),
+                "maxMs": _ms(latencies[-1] if latencies else None),
+            }
+        summary["all"]["wallTimeS"] = round(wall_time, 3)
+        summary["all"]["requestsPerS"] = round(
+            len(self.results) / wall_time, 2) if wall_time else None
+        return summary
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 2)
+
+
+@click.command()
+@click.option("--url", default="http://localhost:5000",
+              help="Root url of the bender-mc server.")
+@click.option("--scenario", "scenarios", multiple=True,
+              type=click.Choice(sorted(SCENARIOS)), default=["pause"],
+              help="Scenario to run, may be given multiple times.")
+@click.option("--concurrency", default=4, type=int,
+              help="Number of concurrent clients.")
+@click.option("--requests", "total", default=None, type=int,
+              help="Total number of requests to send.")
+@click.option("--duration", default=None, type=float,
+              help="Seconds to run for (used if --requests isn't set).")
+@click.option("--timeout", default=30.0, type=float,
+              help="Per request timeout in seconds.")
+def run(url, scenarios, concurrency, total, duration, timeout):
+    """Benchmark a running bender-mc server."""
+    if total is None and duration is None:
+        total = 100
+    generator = LoadGenerator(
+        url, list(scenarios), concurrency=concurrency, timeout=timeout)
+    wall_time = generator.run(total=total, duration=duration)
+    print(json.dumps(generator.report(wall_time), indent=2))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,453 @@
+"""
+    bender_mc.metrics
+    ~~~~~~~~~~~~~~~~~
+
+    Low overhead in-process metrics, exposed in the Prometheus text
+    format.
+
+    Covers HTTP requests, SQLAlchemy queries, Kodi RPC calls, and
+    external processes (SoundVolumeView, PowerShell).
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import bisect
+import glob
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    """Monotonically increasing value, tracked per set of labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.values)
+
+    @staticmethod
+    def merge(values, other):
+        """Add the `other` snapshot's values into `values`."""
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, values=None):
+        """Yield `(sample name, value)` pairs for `values`, by default
+        this counter's own."""
+        if values is None:
+            values = self.snapshot()
+        for labels, value in sorted(values.items()):
+            yield self.name + _format_labels(
+                self.labelnames, labels), value
+
+
+class Histogram(object):
+
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        # See forward_observations.
+        self.forward = None
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if self.forward is not None:
+            self.forward(self.name, value, labels)
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                labels: ([*counts], total, count)
+                for labels, (counts, total, count) in self.values.items()}
+
+    @staticmethod
+    def merge(values, other):
+        """Add the `other` snapshot's values into `values`."""
+        for labels, (counts, total, count) in other.items():
+            state = values.get(labels)
+            if state is None or len(state[0]) != len(counts):
+                values[labels] = ([*counts], total, count)
+                continue
+            values[labels] = (
+                [a + b for a, b in zip(state[0], counts)],
+                state[1] + total, state[2] + count)
+
+    def samples(self, values=None):
+        """Yield `(sample name, value)` pairs for `values`, by default
+        this histogram's own."""
+        if values is None:
+            values = self.snapshot()
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            bounds = self.buckets + (float("inf"), )
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket" + _format_labels(
+                    self.labelnames, labels,
+                    ("le", _format_value(float(bound)))), cumulative
+            yield self.name + "_sum" + _format_labels(
+                self.labelnames, labels), total
+            yield self.name + "_count" + _format_labels(
+                self.labelnames, labels), count
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def get(self, name):
+        """Get a metric by name, or `None`."""
+        for metric in self.metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def clear(self):
+        """Forget every value recorded so far."""
+        for metric in self.metrics:
+            metric.clear()
+
+    def snapshot(self):
+        """Get a picklable copy of every metric's values, by name."""
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self, snapshots=()):
+        """Render all metrics in the Prometheus text format.
+
+        :param snapshots: Other :meth:`snapshot` results, e.g. from
+            other processes, to add to this registry's own values.
+
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            values = metric.snapshot()
+            for snapshot in snapshots:
+                other = snapshot.get(metric.name)
+                if other:
+                    metric.merge(values, other)
+            for sample, value in metric.samples(values):
+                lines.append(f"{sample} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter(
+    "bender_mc_http_requests_total",
+    "HTTP requests handled.", ("route", "method", "status"))
+http_request_duration = registry.histogram(
+    "bender_mc_http_request_duration_seconds",
+    "Time spent handling HTTP requests.", ("route", "method"))
+db_queries = registry.counter(
+    "bender_mc_db_queries_total",
+    "SQL statements executed.", ("engine", ))
+db_query_duration = registry.histogram(
+    "bender_mc_db_query_duration_seconds",
+    "Time spent executing SQL statements.", ("engine", ))
+db_queries_per_request = registry.histogram(
+    "bender_mc_db_queries_per_request",
+    "SQL statements executed per HTTP request.", ("route", ),
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250))
+db_duration_per_request = registry.histogram(
+    "bender_mc_db_duration_per_request_seconds",
+    "Total SQL time per HTTP request.", ("route", ))
+rpc_duration = registry.histogram(
+    "bender_mc_kodi_rpc_duration_seconds",
+    "Time spent on Kodi JSON-RPC calls.", ("method", ))
+rpc_errors = registry.counter(
+    "bender_mc_kodi_rpc_errors_total",
+    "Failed Kodi JSON-RPC calls.", ("method", "code"))
+process_duration = registry.histogram(
+    "bender_mc_process_duration_seconds",
+    "Time spent waiting on external processes.", ("name", ))
+browser_duration = registry.histogram(
+    "bender_mc_browser_duration_seconds",
+    "Time spent driving the browser with Selenium.", ("action", ))
+audio_duration = registry.histogram(
+    "bender_mc_audio_duration_seconds",
+    "Time spent on audio backend calls.", ("action", ))
+
+_histograms = {
+    "db": db_query_duration,
+    "rpc": rpc_duration,
+    "process": process_duration,
+    "browser": browser_duration,
+    "audio": audio_duration
+}
+
+# Per thread accumulation of time spent in each category during the
+# request currently being handled by that thread.
+_request_state = threading.local()
+
+# Directory processes sharing metrics save them to, see share_metrics.
+_share_directory = None
+
+
+def share_metrics(directory, interval=2.0):
+    """Save this process's metrics to `directory` every `interval`
+    seconds, and include every other process's saved metrics in
+    :func:`render`.
+
+    Used by prefork workers, so whichever one serves ``/metrics``
+    reports the totals of them all, up to `interval` seconds old.
+
+    """
+    global _share_directory
+    _share_directory = directory
+    path = os.path.join(directory, f"{os.getpid()}.metrics")
+
+    def save():
+        while True:
+            time.sleep(interval)
+            temp_path = path + ".tmp"
+            try:
+                with open(temp_path, "wb") as metrics_file:
+                    pickle.dump(registry.snapshot(), metrics_file)
+                os.replace(temp_path, path)
+            except OSError:
+                # Directory removed while stopping.
+                return
+
+    threading.Thread(
+        target=save, name="bender-mc-metrics-share", daemon=True).start()
+
+
+def forget_shared_metrics(directory, pid):
+    """Remove the metrics saved by process `pid`, once it's exited."""
+    try:
+        os.remove(os.path.join(directory, f"{pid}.metrics"))
+    except OSError:
+        pass
+
+
+def render():
+    """Render this process's metrics, plus those shared by others, see
+    :func:`share_metrics`."""
+    snapshots = []
+    if _share_directory is not None:
+        own = f"{os.getpid()}.metrics"
+        for path in glob.glob(os.path.join(_share_directory, "*.metrics")):
+            if os.path.basename(path) == own:
+                continue
+            try:
+                with open(path, "rb") as metrics_file:
+                    snapshots.append(pickle.load(metrics_file))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+    return registry.render(snapshots)
+
+
+def forward_observations(send):
+    """Pass every histogram observation to `send` instead of recording
+    it.
+
+    Used by worker processes, whose own metrics are never rendered, to
+    have them recorded by the parent process instead.
+
+    :param send: Callable taking the metric name, observed value and
+        tuple of labels.
+
+    """
+    for metric in registry.metrics:
+        if isinstance(metric, Histogram):
+            metric.forward = send
+
+
+def begin_request():
+    _request_state.start = time.perf_counter()
+    _request_state.durations = {}
+    _request_state.counts = {}
+
+
+def current_request():
+    """Get the current thread's request state without ending it.
+
+    :return: Same as :func:`end_request`.
+
+    """
+    start = getattr(_request_state, "start", None)
+    if start is None:
+        return None
+    return (time.perf_counter() - start, dict(_request_state.durations),
+            dict(_request_state.counts))
+
+
+def end_request():
+    """Stop accumulating for this thread's request.
+
+    :return: A `(elapsed, durations, counts)` tuple, where durations
+        and counts are dicts keyed by category. `None` if no request
+        was begun.
+
+    """
+    start = getattr(_request_state, "start", None)
+    if start is None:
+        return None
+    result = (time.perf_counter() - start, _request_state.durations,
+              _request_state.counts)
+    _request_state.start = None
+    return result
+
+
+def record(category, name, seconds):
+    """Record time spent on a `category` of work (db, rpc, process,
+    browser, audio).
+
+    Observed into that category's histogram, and attributed to the
+    request being handled by the current thread, if any.
+
+    """
+    histogram = _histograms.get(category)
+    if histogram is not None:
+        histogram.observe(seconds, name)
+    if getattr(_request_state, "start", None) is not None:
+        durations = _request_state.durations
+        counts = _request_state.counts
+        durations[category] = durations.get(category, 0.0) + seconds
+        counts[category] = counts.get(category, 0) + 1
+
+
+@contextmanager
+def timed(category, name):
+    """Context manager that :func:`record`s the time spent inside."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(category, name, time.perf_counter() - start)
+
+
+def instrument_engine(engine, name):
+    """Time every statement executed by a SQLAlchemy `engine`."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("bender_mc_query_start", []).append(
+            time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        starts = conn.info.get("bender_mc_query_start")
+        if starts:
+            db_queries.inc(name)
+            record("db", name, time.perf_counter() - starts.pop())
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("bender_mc_query_start"):
+            conn.info["bender_mc_query_start"].pop()
+
+
+def _route_name():
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return "unmatched"
+
+
+def instrument_app(app):
+    """Collect per route request counts and latencies for `app`."""
+    @app.before_request
+    def metrics_before_request():
+        begin_request()
+
+    @app.after_request
+    def metrics_after_request(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def metrics_teardown_request(error):
+        state = end_request()
+        if state is None:
+            return
+        elapsed, durations, counts = state
+        route = _route_name()
+        status = g.get("metrics_status", 500)
+        http_requests.inc(route, request.method, str(status))
+        http_request_duration.observe(elapsed, route, request.method)
+        db_queries_per_request.observe(counts.get("db", 0), route)
+        db_duration_per_request.observe(durations.get("db", 0.0), route)
@@ -0,0 +1,340 @@
+"""
+    bender_mc.playback
+    ~~~~~~~~~~~~~~~~~~
+
+    Plays announcements from a prioritized queue on a long lived
+    player, so callers don't wait for them to finish.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import heapq
+import itertools
+import sys
+import threading
+import uuid
+from drowsy.log import Loggable
+from bender_mc import playsound
+
+
+class PlaybackError(Exception):
+
+    """Raised when a sound can't be played."""
+
+
+class Player(Loggable):
+
+    """Interface for something that plays in memory sounds."""
+
+    name = None
+
+    def play(self, data, interrupted):
+        """Play `data`, blocking until it finishes.
+
+        :param data: The sound file's contents, as bytes or a
+            memoryview.
+        :param interrupted: A :class:`threading.Event` that's set if
+            playback should stop early.
+        :return: `True` if it played to the end, or `False` if it was
+            interrupted.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the player."""
+
+
+class FakePlayer(Player):
+
+    """Pretends to play sounds, for testing without an audio sink.
+
+    Every sound played is recorded in `played`.
+
+    :param float duration: Seconds each sound pretends to last.
+
+    """
+
+    name = "fake"
+
+    def __init__(self, duration=0.0):
+        self.duration = duration
+        self.played = []
+
+    def play(self, data, interrupted):
+        self.played.append(bytes(data))
+        return not interrupted.wait(self.duration)
+
+
+class PlaysoundPlayer(Player):
+
+    """Plays sounds with :mod:`bender_mc.playsound`.
+
+    Only Windows supports cutting a sound off; elsewhere an interrupted
+    sound plays on, but is no longer waited for.
+
+    """
+
+    name = "playsound"
+
+    def play(self, data, interrupted):
+        done = threading.Event()
+        errors = []
+
+        def play_sound():
+            try:
+                playsound.playsound(data)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                done.set()
+
+        threading.Thread(
+            target=play_sound, name="bender-mc-playsound",
+            daemon=True).start()
+        while not done.wait(.05):
+            if interrupted.is_set():
+                if sys.platform.startswith("win"):
+                    import winsound
+                    winsound.PlaySound(None, 0)
+                return False
+        if errors:
+            raise PlaybackError(str(errors[0])) from errors[0]
+        return True
+
+
+class GstPlayer(Player):
+
+    """Plays sounds through a single, reused GStreamer pipeline.
+
+    The pipeline (``appsrc ! decodebin ! audioconvert ! audioresample !
+    autoaudiosink``) is built once. Each sound is pushed into the
+    appsrc and the pipeline is reset to READY between sounds, which is
+    much cheaper than initializing GStreamer and building a new playbin
+    every time.
+
+    """
+
+    name = "gstreamer"
+
+    def __init__(self):
+        try:
+            import gi
+            gi.require_version("Gst", "1.0")
+            from gi.repository import Gst
+        except (ImportError, ValueError) as exc:
+            raise PlaybackError(
+                "PyGObject and GStreamer are required for GStreamer "
+                "playback.") from exc
+        Gst.init(None)
+        self._gst = Gst
+        pipeline = Gst.Pipeline.new("bender-mc-playback")
+        elements = {}
+        for factory in ("appsrc", "decodebin", "audioconvert",
+                        "audioresample", "autoaudiosink"):
+            elements[factory] = Gst.ElementFactory.make(factory, None)
+            if elements[factory] is None:
+                raise PlaybackError(
+                    f"Missing GStreamer element: {factory}")
+            pipeline.add(elements[factory])
+        elements["appsrc"].set_property("format", Gst.Format.BYTES)
+        elements["appsrc"].link(elements["decodebin"])
+        elements["audioconvert"].link(elements["audioresample"])
+        elements["audioresample"].link(elements["autoaudiosink"])
+        # decodebin's source pad only appears once it knows what it's
+        # decoding, and is removed again on each reset.
+        elements["decodebin"].connect("pad-added", self._on_pad_added)
+        self._convert = elements["audioconvert"]
+        self._src = elements["appsrc"]
+        self._pipeline = pipeline
+        self._bus = pipeline.get_bus()
+        pipeline.set_state(Gst.State.READY)
+
+    def _on_pad_added(self, element, pad):
+        sink_pad = self._convert.get_static_pad("sink")
+        if not sink_pad.is_linked():
+            pad.link(sink_pad)
+
+    def play(self, data, interrupted):
+        Gst = self._gst
+        self._pipeline.set_state(Gst.State.READY)
+        # Drop messages left over from the last sound.
+        self._bus.set_flushing(True)
+        self._bus.set_flushing(False)
+        self._src.emit("push-buffer", Gst.Buffer.new_wrapped(bytes(data)))
+        self._src.emit("end-of-stream")
+        try:
+            result = self._pipeline.set_state(Gst.State.PLAYING)
+            if result == Gst.StateChangeReturn.FAILURE:
+                raise PlaybackError("Unable to start the playback pipeline.")
+            while not interrupted.is_set():
+                message = self._bus.timed_pop_filtered(
+                    50 * Gst.MSECOND,
+                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+                if message is None:
+                    continue
+                if message.type == Gst.MessageType.ERROR:
+                    error, debug = message.parse_error()
+                    raise PlaybackError(
+                        f"Unable to play sound: {error.message}")
+                return True
+            return False
+        finally:
+            self._pipeline.set_state(Gst.State.READY)
+
+    def close(self):
+        self._pipeline.set_state(self._gst.State.NULL)
+
+
+PLAYERS = {
+    FakePlayer.name: FakePlayer,
+    PlaysoundPlayer.name: PlaysoundPlayer,
+    GstPlayer.name: GstPlayer
+}
+
+
+def get_player(name="auto"):
+    """Create a player by name.
+
+    :param str name: One of :data:`PLAYERS`, or ``auto`` to pick the
+        one for this platform.
+    :raise PlaybackError: If the player can't be used here.
+
+    """
+    if name in (None, "auto"):
+        if sys.platform.startswith(("win", "darwin")):
+            name = PlaysoundPlayer.name
+        else:
+            name = GstPlayer.name
+    try:
+        player_cls = PLAYERS[name]
+    except KeyError:
+        raise PlaybackError(f"Unknown player: {name}")
+    return player_cls()
+
+
+class Announcement(object):
+
+    """A sound waiting to be, or being, played.
+
+    :param data: The sound file's contents.
+    :param int priority: Higher priorities are played first.
+    :param bool interrupt: Whether to cut off whatever's playing if it
+        has the same or a lower priority.
+
+    """
+
+    def __init__(self, data, priority=0, interrupt=False):
+        self.id = str(uuid.uuid4())
+        self.data = data
+        self.priority = priority
+        self.interrupt = interrupt
+        self.interrupted = threading.Event()
+        # Set if it was dropped from a full queue without playing.
+        self.dropped = False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "priority": self.priority,
+            "interrupt": self.interrupt
+        }
+
+
+class PlaybackService(Loggable):
+
+    """Plays queued announcements one at a time on a worker thread.
+
+    Announcements are played highest priority first, then in the order
+    they were queued. One queued with `interrupt` set stops the current
+    announcement, unless that has a higher priority; interrupted
+    announcements are dropped rather than resumed.
+
+    :param player: The :class:`Player` to use. Defaults to the one for
+        this platform.
+    :param int max_queued: Most announcements to hold at once. The
+        lowest priority, newest ones are dropped beyond this.
+
+    """
+
+    def __init__(self, player=None, max_queued=50):
+        self.player = player or get_player()
+        self.max_queued = max_queued
+        self.current = None
+        self._queue = []
+        self._counter = itertools.count()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="bender-mc-playback", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, data, priority=0, interrupt=False):
+        """Queue a sound to be played, returning straight away.
+
+        :return: The queued :class:`Announcement`, which has `dropped`
+            set if the queue was full and it was the one dropped.
+
+        """
+        announcement = Announcement(data, priority, interrupt)
+        with self._condition:
+            heapq.heappush(
+                self._queue,
+                (-priority, next(self._counter), announcement))
+            if len(self._queue) > self.max_queued:
+                entry = max(self._queue)
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                dropped = entry[2]
+                dropped.dropped = True
+                self.logger.warning(
+                    f"Announcement queue full, dropped {dropped.id}.")
+            current = self.current
+            if (interrupt and current is not None and
+                    current.priority <= priority):
+                current.interrupted.set()
+            self._condition.notify()
+        return announcement
+
+    def queued(self):
+        """Get the queued announcements, in the order they'll play."""
+        with self._condition:
+            return [entry[2] for entry in sorted(self._queue)]
+
+    def stop(self):
+        """Stop the current announcement and drop any queued ones."""
+        with self._condition:
+            del self._queue[:]
+            if self.current is not None:
+                self.current.interrupted.set()
+
+    def close(self):
+        """Stop playing and shut down the worker and player."""
+        with self._condition:
+            self._closed = True
+            del self._queue[:]
+            if self.current is not None:
+                self.current.interrupted.set()
+            self._condition.notify()
+        self._thread.join()
+        self.player.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                announcement = heapq.heappop(self._queue)[2]
+                self.current = announcement
+            try:
+                if not self.player.play(
+                        announcement.data, announcement.interrupted):
+                    self.logger.debug(
+                        f"Announcement {announcement.id} interrupted.")
+            except Exception:
+                self.logger.exception(
+                    f"Unable to play announcement {announcement.id}.")
+            finally:
+                with self._condition:
+                    self.current = None
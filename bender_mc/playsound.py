@@ -26,6 +26,23 @@ SOFTWARE.
 class PlaysoundException(Exception):
     pass
 
+def _isBuffer(sound):
+    """Whether `sound` is the sound's contents rather than a path."""
+    return isinstance(sound, (bytes, bytearray, memoryview))
+
+def _playsoundWinMemory(sound, block = True):
+    """Play an in memory WAV with winsound, which can't play from
+    memory asynchronously itself."""
+    import winsound
+    data = bytes(sound)
+
+    if block:
+        winsound.PlaySound(data, winsound.SND_MEMORY)
+    else:
+        from threading import Thread
+        Thread(target=winsound.PlaySound,
+               args=(data, winsound.SND_MEMORY), daemon=True).start()
+
 def _playsoundWin(sound, block = True):
     '''
     Utilizes windll.winmm. Tested and known to work with MP3 and WAVE on
@@ -37,7 +54,12 @@ def _playsoundWin(sound, block = True):
     https://github.com/michaelgundlach/mp3play
 
     I never would have tried using windll.winmm without seeing his code.
+
+    In memory sounds (bytes or memoryview) must be WAVE data.
     '''
+    if _isBuffer(sound):
+        return _playsoundWinMemory(sound, block)
+
     from ctypes import c_buffer, windll
     from random import random
     from time   import sleep
@@ -77,11 +99,24 @@ def _playsoundOSX(sound, block = True):
     http://stackoverflow.com/a/34568298/901641
 
     I never would have tried using AppKit.NSSound without seeing his code.
+
+    In memory sounds (bytes or memoryview) are loaded with initWithData.
     '''
     from AppKit     import NSSound
-    from Foundation import NSURL
+    from Foundation import NSData, NSURL
     from time       import sleep
 
+    if _isBuffer(sound):
+        data = bytes(sound)
+        nsdata = NSData.dataWithBytes_length_(data, len(data))
+        nssound = NSSound.alloc().initWithData_(nsdata)
+        if not nssound:
+            raise IOError('Unable to load sound from memory')
+        nssound.play()
+        if block:
+            sleep(nssound.duration())
+        return
+
     if '://' not in sound:
         if not sound.startswith('/'):
             from os import getcwd
@@ -101,6 +136,9 @@ def _playsoundNix(sound, block=True):
 
     Inspired by this:
     https://gstreamer.freedesktop.org/documentation/tutorials/playback/playbin-usage.html
+
+    In memory sounds (bytes or memoryview) are pushed through an appsrc
+    and decoded as they play, without touching the disk.
     """
     if not block:
         raise NotImplementedError(
@@ -120,6 +158,9 @@ def _playsoundNix(sound, block=True):
 
     Gst.init(None)
 
+    if _isBuffer(sound):
+        return _playGstBuffer(Gst, sound)
+
     playbin = Gst.ElementFactory.make('playbin', 'playbin')
     if sound.startswith(('http://', 'https://')):
         playbin.props.uri = sound
@@ -137,6 +178,32 @@ def _playsoundNix(sound, block=True):
     bus.poll(Gst.MessageType.EOS, Gst.CLOCK_TIME_NONE)
     playbin.set_state(Gst.State.NULL)
 
+def _playGstBuffer(Gst, sound):
+    """Play an in memory sound through appsrc, blocking until done."""
+    pipeline = Gst.parse_launch(
+        'appsrc name=src ! decodebin ! audioconvert ! audioresample ! '
+        'autoaudiosink')
+    src = pipeline.get_by_name('src')
+    src.set_property('format', Gst.Format.BYTES)
+    # new_wrapped takes ownership of (and so needs) a bytes object.
+    src.emit('push-buffer', Gst.Buffer.new_wrapped(bytes(sound)))
+    src.emit('end-of-stream')
+
+    set_result = pipeline.set_state(Gst.State.PLAYING)
+    if set_result == Gst.StateChangeReturn.FAILURE:
+        pipeline.set_state(Gst.State.NULL)
+        raise PlaysoundException(
+            "pipeline.set_state returned " + repr(set_result))
+
+    bus = pipeline.get_bus()
+    message = bus.timed_pop_filtered(
+        Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        error, debug = message.parse_error()
+        raise PlaysoundException(
+            "Unable to play sound from memory: " + error.message)
+
 
 from platform import system
 system = system()
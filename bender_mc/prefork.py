@@ -0,0 +1,404 @@
+"""
+    bender_mc.prefork
+    ~~~~~~~~~~~~~~~~~
+
+    Multi-process serving, with worker processes sharing the listening
+    ports and one device worker owning the audio and browser
+    controllers.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+import requests
+from urllib3.exceptions import HTTPError, ReadTimeoutError
+from bender_mc import metrics
+
+logger = logging.getLogger(__name__)
+
+PREFORK_SUPPORTED = hasattr(os, "fork")
+
+# Headers that only apply to a single connection, and so must not be
+# passed along by a proxy.
+HOP_BY_HOP_HEADERS = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade"))
+
+
+def find_free_port(hostname="127.0.0.1"):
+    """Get a currently unused TCP port on `hostname`."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((hostname, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class DeviceProxy(object):
+
+    """WSGI middleware forwarding device routes to the device worker.
+
+    Requests under one of `prefixes` are sent on to `device_url`, the
+    private loopback listener of the worker that owns the audio and
+    browser controllers and the background jobs. Anything else is
+    handled by `app` in this process.
+
+    :param app: WSGI application for everything else.
+    :param str device_url: Base url of the device worker, e.g.
+        ``http://127.0.0.1:5099``.
+    :param prefixes: Path prefixes to forward.
+    :param float connect_timeout: Seconds to wait to connect to the
+        device worker.
+    :param float read_timeout: Most seconds to wait for the device
+        worker to respond, lowered by a client's `X-Request-Timeout`
+        header.
+
+    """
+
+    def __init__(self, app, device_url, prefixes, connect_timeout=2.0,
+                 read_timeout=35.0):
+        self.app = app
+        self.device_url = device_url.rstrip("/")
+        self.prefixes = tuple(prefixes)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+
+    def _read_timeout(self, environ):
+        timeout = self.read_timeout
+        try:
+            requested = float(environ.get("HTTP_X_REQUEST_TIMEOUT") or 0)
+        except ValueError:
+            requested = 0
+        if requested > 0:
+            # The device worker has a moment to answer with its own
+            # deadline error first.
+            timeout = min(timeout, requested + 1)
+        return timeout
+
+    @staticmethod
+    def _error(start_response, status, message, code):
+        content = (f'{{"message": "{message}", "code": "{code}"}}'
+                   .encode("utf-8"))
+        start_response(status, [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(content))),
+            ("Retry-After", "1")])
+        return [content]
+
+    def __call__(self, environ, start_response):
+        if not environ.get("PATH_INFO", "").startswith(self.prefixes):
+            return self.app(environ, start_response)
+        path = environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")
+        url = self.device_url + quote(path)
+        if environ.get("QUERY_STRING"):
+            url += "?" + environ["QUERY_STRING"]
+        headers = {}
+        for key, value in environ.items():
+            if key.startswith("HTTP_"):
+                name = key[5:].replace("_", "-").title()
+                if name.lower() not in HOP_BY_HOP_HEADERS:
+                    headers[name] = value
+        if environ.get("CONTENT_TYPE"):
+            headers["Content-Type"] = environ["CONTENT_TYPE"]
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        body = environ["wsgi.input"].read(length) if length > 0 else None
+        remote_addr = environ.get("REMOTE_ADDR")
+        if remote_addr:
+            forwarded_for = headers.get("X-Forwarded-For")
+            headers["X-Forwarded-For"] = (
+                f"{forwarded_for}, {remote_addr}" if forwarded_for
+                else remote_addr)
+        try:
+            response = self.session.request(
+                environ["REQUEST_METHOD"], url, headers=headers, data=body,
+                timeout=(self.connect_timeout, self._read_timeout(environ)),
+                stream=True, allow_redirects=False)
+            content = response.raw.read()
+        except (requests.Timeout, ReadTimeoutError):
+            logger.error(f"Device worker didn't respond to {path} in time.")
+            return self._error(
+                start_response, "504 Gateway Timeout",
+                "Device worker didn't respond in time.",
+                "device_worker_timeout")
+        except (requests.RequestException, HTTPError):
+            logger.exception("Unable to reach the device worker.")
+            return self._error(
+                start_response, "503 Service Unavailable",
+                "Device worker unavailable.", "device_worker_unavailable")
+        response_headers = [
+            (name, value) for name, value in response.raw.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS]
+        start_response(
+            f"{response.status_code} {response.reason}", response_headers)
+        return [content]
+
+
+class PreforkSupervisor(object):
+
+    """Runs and supervises a set of forked server worker processes.
+
+    Every worker binds the public ports with SO_REUSEPORT, so the
+    kernel spreads connections between them. Worker 0 is the device
+    worker: it's the only one to create the audio controller and
+    browser, and it also listens on a private loopback `device_port`
+    that the other workers proxy device routes to.
+
+    Workers that exit unexpectedly are restarted. Each worker reports
+    once it's warmed up and serving, see :meth:`wait_ready`, and
+    shares its metrics with the others through a temporary directory,
+    see :func:`~bender_mc.metrics.share_metrics`.
+
+    :param app: The app each worker serves.
+    :param int workers: Number of worker processes.
+    :param int device_port: Loopback port of the device worker.
+    :param start_generation: Callable taking the app, a generation
+        number, and `device_port` or `device_url` keyword arguments,
+        that starts serving in the current process and returns the
+        generation.
+    :param worker_init: Optional callable taking the app, worker index
+        and whether it's the device worker, run in each new worker
+        before it starts serving.
+    :param float drain_grace: Seconds workers keep serving after being
+        asked to stop, see :meth:`ServerGeneration.stop`.
+
+    """
+
+    def __init__(self, app, workers, device_port, start_generation,
+                 worker_init=None, drain_grace=1.0):
+        self.app = app
+        self.workers = workers
+        self.device_port = device_port
+        self.start_generation = start_generation
+        self.worker_init = worker_init
+        self.drain_grace = drain_grace
+        self.generation = 0
+        # pid -> (worker index, time started)
+        self.children = {}
+        self.stopping = False
+        self.master_pid = os.getpid()
+        self.metrics_dir = None
+        # Indexes of the workers of the current generation that are
+        # serving.
+        self._ready = set()
+        self._ready_changed = threading.Condition()
+        self._ready_pipe = None
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def start(self):
+        """Fork the workers and start supervising them.
+
+        Must be called from the main thread, as it installs handlers
+        for SIGTERM and SIGINT that stop the workers.
+
+        """
+        self.metrics_dir = tempfile.mkdtemp(prefix="bender-mc-metrics-")
+        self._ready_pipe = os.pipe()
+        threading.Thread(
+            target=self._read_ready, name="bender-mc-ready",
+            daemon=True).start()
+        with self._lock:
+            self.generation += 1
+            for index in range(self.workers):
+                self._spawn(index)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._handle_stop_signal)
+        self._thread = threading.Thread(
+            target=self._supervise, name="bender-mc-supervisor")
+        self._thread.start()
+
+    def wait_ready(self, timeout=None):
+        """Wait for every worker of the current generation to be warmed
+        up and serving.
+
+        :return: `True` if they all are, `False` if `timeout` seconds
+            passed first.
+
+        """
+        with self._ready_changed:
+            return self._ready_changed.wait_for(
+                lambda: len(self._ready) >= self.workers, timeout)
+
+    def reload(self, app, ready_timeout=300):
+        """Replace every worker with one serving `app`, without
+        dropping requests.
+
+        The old device worker is stopped first, as two would fight
+        over the speakers and browser; device routes are answered with
+        503s until its replacement is up. The other new workers are
+        started alongside the old ones, which are asked to stop and
+        drain once the new workers are ready, or `ready_timeout`
+        seconds have passed.
+
+        """
+        with self._lock:
+            old_children = list(self.children)
+            old_devices = [
+                pid for pid in old_children if self.children[pid][0] == 0]
+            for pid in old_devices:
+                # Forget them first, so they aren't restarted on exit.
+                self.children.pop(pid, None)
+                self._signal(pid, signal.SIGTERM)
+        self._reap(old_devices, timeout=self.drain_grace + 10)
+        with self._lock:
+            self.app = app
+            self.generation += 1
+            with self._ready_changed:
+                self._ready.clear()
+            for index in range(self.workers):
+                self._spawn(index)
+        if not self.wait_ready(ready_timeout):
+            logger.warning(
+                f"New workers weren't ready within {ready_timeout}s, "
+                f"stopping the old ones anyway.")
+        old_children = [pid for pid in old_children if pid not in old_devices]
+        with self._lock:
+            for pid in old_children:
+                self.children.pop(pid, None)
+                self._signal(pid, signal.SIGTERM)
+        self._reap(old_children, timeout=self.drain_grace + 10)
+        for pid in old_devices + old_children:
+            metrics.forget_shared_metrics(self.metrics_dir, pid)
+        logger.info(f"Reloaded {self.workers} workers.")
+
+    def stop(self):
+        """Ask every worker to stop, and wait for them to exit."""
+        with self._lock:
+            self.stopping = True
+            children = list(self.children)
+            self.children.clear()
+        for pid in children:
+            self._signal(pid, signal.SIGTERM)
+        self._reap(children, timeout=self.drain_grace + 10)
+        if self.metrics_dir is not None:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def _read_ready(self):
+        """Note each worker that reports being ready, until stopped."""
+        with os.fdopen(self._ready_pipe[0], "rb") as ready_file:
+            for line in ready_file:
+                try:
+                    generation, index = map(int, line.split())
+                except ValueError:
+                    continue
+                with self._ready_changed:
+                    if generation == self.generation:
+                        self._ready.add(index)
+                        self._ready_changed.notify_all()
+
+    def _handle_stop_signal(self, signum, frame):
+        threading.Thread(target=self.stop, name="bender-mc-stop").start()
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _reap(pids, timeout):
+        """Wait for `pids` to exit, killing any that take too long."""
+        end = time.monotonic() + timeout
+        remaining = set(pids)
+        while remaining:
+            for pid in list(remaining):
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    remaining.discard(pid)
+            if remaining and time.monotonic() > end:
+                for pid in remaining:
+                    PreforkSupervisor._signal(pid, signal.SIGKILL)
+                end = float("inf")
+            time.sleep(.05)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self._worker_main(index)
+        self.children[pid] = (index, time.monotonic())
+        logger.info(f"Started worker {index} (pid {pid}).")
+
+    def _supervise(self):
+        while True:
+            with self._lock:
+                if self.stopping:
+                    return
+                children = dict(self.children)
+            for pid, (index, started) in children.items():
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done, status = pid, 0
+                if not done:
+                    continue
+                metrics.forget_shared_metrics(self.metrics_dir, pid)
+                with self._lock:
+                    if self.stopping or self.children.pop(pid, None) is None:
+                        continue
+                    with self._ready_changed:
+                        self._ready.discard(index)
+                    logger.warning(
+                        f"Worker {index} (pid {pid}) exited with status "
+                        f"{status}, restarting.")
+                    if time.monotonic() - started < 1:
+                        # Crashing on start up, don't spin.
+                        time.sleep(1)
+                    self._spawn(index)
+            time.sleep(.5)
+
+    def _worker_main(self, index):
+        """Run a worker. Never returns."""
+        exit_code = 0
+        try:
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            # The supervisor handles these for the whole process group.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if hasattr(signal, "SIGHUP"):
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            # Whatever the master recorded while preloading would be
+            # counted by every worker otherwise.
+            metrics.registry.clear()
+            metrics.share_metrics(self.metrics_dir)
+            is_device = index == 0
+            if self.worker_init is not None:
+                self.worker_init(self.app, index, is_device)
+            if is_device:
+                generation = self.start_generation(
+                    self.app, self.generation, device_port=self.device_port)
+            else:
+                generation = self.start_generation(
+                    self.app, self.generation,
+                    device_url=f"http://127.0.0.1:{self.device_port}")
+            # Short enough to be written in one go, so reports from
+            # different workers don't interleave.
+            os.write(
+                self._ready_pipe[1],
+                f"{self.generation} {index}\n".encode("ascii"))
+            while not stop.wait(1):
+                if os.getppid() != self.master_pid:
+                    # Supervisor is gone.
+                    break
+            generation.stop(grace=self.drain_grace)
+        except BaseException:
+            logger.exception(f"Worker {index} failed.")
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
@@ -0,0 +1,176 @@
+"""
+    bender_mc.profiling
+    ~~~~~~~~~~~~~~~~~~~
+
+    Opt-in sampling profiler for API requests.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from collections import deque
+from flask import g, request
+from drowsy.log import Loggable
+
+
+# Matches the names given to profiles by :meth:`RequestProfiler.finish`.
+PROFILE_NAME_PATTERN = re.compile(
+    r"^\d{8}-\d{6}_(?P<method>[a-z]+)_(?P<slug>.+)_(?P<ms>\d+)ms_\d{3}"
+    r"\.prof$")
+
+
+class RequestProfiler(Loggable):
+
+    """Profiles a random sample of requests with cProfile.
+
+    Each sampled request's profile is written to `output_dir` as
+    ``{timestamp}_{route}_{ms}ms.prof``, loadable with :mod:`pstats`
+    or a viewer like snakeviz. Only the `keep` most recent profiles
+    are kept on disk, including those left by earlier runs.
+
+    :param str output_dir: Directory to write profiles to.
+    :param float sample_rate: Fraction (0-1) of requests to profile.
+    :param int keep: Number of recent profiles to retain.
+
+    """
+
+    def __init__(self, output_dir, sample_rate=.05, keep=100):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.records = deque()
+        self.keep = keep
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        self._load_existing()
+
+    def _load_existing(self):
+        """Pick up the profiles already on disk, so they're listed and
+        pruned along with new ones."""
+        found = []
+        for name in os.listdir(self.output_dir):
+            match = PROFILE_NAME_PATTERN.match(name)
+            if match is None:
+                continue
+            try:
+                recorded_at = os.path.getmtime(
+                    os.path.join(self.output_dir, name))
+            except OSError:
+                continue
+            found.append({
+                "name": name,
+                # Only the slug of the route survives in the name.
+                "route": match.group("slug"),
+                "method": match.group("method").upper(),
+                "latencyMs": float(match.group("ms")),
+                "recordedAt": recorded_at
+            })
+        found.sort(key=lambda r: r["recordedAt"])
+        with self._lock:
+            self.records.extend(found)
+            self._prune()
+
+    def _prune(self):
+        # Called with the lock held.
+        while len(self.records) > self.keep:
+            expired = self.records.popleft()
+            try:
+                os.remove(os.path.join(self.output_dir, expired["name"]))
+            except OSError:
+                pass
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        """Start profiling the current thread.
+
+        :return: The running profile, or `None` if another profile is
+            already active (cProfile only allows one at a time on newer
+            Pythons).
+
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+        return profile
+
+    def finish(self, profile, route, method, elapsed):
+        """Stop `profile` and save it along with the request details."""
+        profile.disable()
+        slug = re.sub(r"[^\w]+", "-", route).strip("-") or "root"
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}_{method.lower()}_"
+                f"{slug}_{int(elapsed * 1000)}ms_{random.randrange(1000):03}"
+                f".prof")
+        path = os.path.join(self.output_dir, name)
+        try:
+            profile.dump_stats(path)
+        except OSError:
+            self.logger.exception("Unable to write request profile.")
+            return None
+        record = {
+            "name": name,
+            "route": route,
+            "method": method,
+            "latencyMs": round(elapsed * 1000, 3),
+            "recordedAt": time.time()
+        }
+        with self._lock:
+            self.records.append(record)
+            self._prune()
+        return record
+
+    def slowest(self, limit=10):
+        """Get the slowest of the recently profiled requests."""
+        with self._lock:
+            records = list(self.records)
+        records.sort(key=lambda r: r["latencyMs"], reverse=True)
+        return records[:limit]
+
+    def get(self, name):
+        with self._lock:
+            for record in self.records:
+                if record["name"] == name:
+                    return record
+        return None
+
+    def summary(self, name, sort="cumulative", limit=40):
+        """Get a text summary of the top functions in a profile.
+
+        :raise OSError: If the profile can't be read, e.g. because it
+            was just pruned.
+
+        """
+        output = io.StringIO()
+        stats = pstats.Stats(
+            os.path.join(self.output_dir, name), stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def instrument(self, app, skip_prefixes=("/api/profiles", "/metrics")):
+        """Profile a sample of the requests handled by `app`."""
+        @app.before_request
+        def profiler_before_request():
+            if request.path.startswith(skip_prefixes):
+                return
+            if self.should_sample():
+                g.profile = self.start()
+                g.profile_started = time.perf_counter()
+
+        @app.teardown_request
+        def profiler_teardown_request(error):
+            profile = g.pop("profile", None)
+            if profile is None:
+                return
+            elapsed = time.perf_counter() - g.pop("profile_started")
+            route = "unmatched"
+            if request.url_rule is not None:
+                route = request.url_rule.rule
+            self.finish(profile, route, request.method, elapsed)
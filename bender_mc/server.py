@@ -7,13 +7,18 @@
 # :copyright: (c) 2020 by Nicholas Repole.
 # :license: MIT - See LICENSE for more details.
 import configparser
+from functools import partial
 from cheroot import wsgi
 from cheroot.ssl.builtin import BuiltinSSLAdapter
 import os
 import logging
+import socket
 import threading
+import time
 import sys
 import subprocess
+from bender_mc.prefork import (
+    DeviceProxy, PreforkSupervisor, PREFORK_SUPPORTED, find_free_port)
 
 logger = logging.getLogger(__name__)
 
@@ -21,29 +26,317 @@ _http_server = None
 _https_server = None
 _snapclient = None
 
+# Paths that must stay responsive no matter how busy the server is.
+CONTROL_PATH_PREFIXES = (
+    "/api/video/player/",
+    "/api/mediaCenter/",
+    "/api/jobs",
+)
 
-def run(app, root_prefix="", hostname="0.0.0.0", http_port=None,
-        https_port=None, https_cert_path=None, https_certkey_path=None):
+# Paths served by the device worker when running multiple processes,
+# since they use the audio and browser controllers or job state that
+# must only exist once.
+DEVICE_PATH_PREFIXES = CONTROL_PATH_PREFIXES
+
+
+class _LaneReleasingIterable(object):
+
+    """Wraps a WSGI response, freeing its lane once it's been sent."""
+
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            self.release()
+
+
+class PriorityLaneDispatcher(object):
+
+    """WSGI middleware splitting traffic into control and bulk lanes.
+
+    Requests under one of `control_prefixes` (player controls, media
+    center controls, job status) go straight through. Everything else,
+    such as `/slots` and the generic REST router, is bulk traffic and
+    may only occupy `bulk_threads` server threads at once. The
+    remaining threads form a lane reserved for control requests, so
+    heavy collection queries can't starve a pause command.
+
+    Bulk requests that find their lane full are rejected straight away
+    with a 503 and a `Retry-After` header. Waiting for room would tie
+    up a server thread the control lane might need.
+
+    :param app: WSGI application to dispatch to.
+    :param int bulk_threads: Max concurrent bulk requests.
+    :param control_prefixes: Path prefixes of the control lane.
+
+    """
+
+    def __init__(self, app, bulk_threads,
+                 control_prefixes=CONTROL_PATH_PREFIXES):
+        self.app = app
+        self.bulk_threads = bulk_threads
+        self.control_prefixes = tuple(control_prefixes)
+        self.bulk_lane = threading.BoundedSemaphore(bulk_threads)
+
+    def is_control(self, path):
+        return path.startswith(self.control_prefixes)
+
+    def __call__(self, environ, start_response):
+        if self.is_control(environ.get("PATH_INFO", "")):
+            return self.app(environ, start_response)
+        if not self.bulk_lane.acquire(blocking=False):
+            body = (b'{"message": "Server is busy, try again shortly.", '
+                    b'"code": "server_busy"}')
+            start_response("503 Service Unavailable", [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(body))),
+                ("Retry-After", "1")])
+            return [body]
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            self.bulk_lane.release()
+            raise
+        return _LaneReleasingIterable(result, self.bulk_lane.release)
+
+
+class AppSwitch(object):
+
+    """WSGI app forwarding to an app that can be replaced at any time.
+
+    Each request is handed to whichever app was current when it
+    arrived, so swapping apps never interrupts a request in flight.
+
+    While `draining`, responses ask clients to close their connection
+    so keep-alive connections move over to the next generation.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.draining = False
+
+    def __call__(self, environ, start_response):
+        if not self.draining:
+            return self.app(environ, start_response)
+
+        def closing_start_response(status, headers, exc_info=None):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != "connection"]
+            headers.append(("Connection", "close"))
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, closing_start_response)
+
+
+class ServerGeneration(object):
+
+    """A set of listening servers and the app they serve.
+
+    :param int number: Generation number, incremented on each reload.
+    :param app_switch: :class:`AppSwitch` the servers dispatch to.
+    :param servers: Prepared :class:`cheroot.wsgi.Server` instances.
+    :param dict settings: The :func:`run` arguments used to build the
+        servers, to tell whether a reload needs to rebind.
+
+    """
+
+    def __init__(self, number, app_switch, servers, settings):
+        self.number = number
+        self.app_switch = app_switch
+        self.servers = servers
+        self.settings = settings
+        self.threads = []
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(
+                target=server.serve,
+                name=f"bender-mc-server-{self.number}")
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, grace=0.0):
+        """Stop accepting connections and wait for requests in flight
+        to finish, up to each server's `shutdown_timeout`.
+
+        :param float grace: Seconds to keep serving first, closing
+            connections after each response, so busy keep-alive
+            clients reconnect cleanly rather than being cut off.
+
+        """
+        if grace > 0:
+            self.app_switch.draining = True
+            time.sleep(grace)
+        for server in self.servers:
+            server.stop()
+
+
+_generation = None
+_generation_lock = threading.Lock()
+_supervisor = None
+_preload = None
+_worker_init = None
+
+# Listening sockets can only be shared between server generations where
+# SO_REUSEPORT is supported. Elsewhere (Windows) reloads swap the app
+# behind the existing sockets instead.
+REUSE_PORT_SUPPORTED = (
+    hasattr(socket, "SO_REUSEPORT") and not sys.platform.startswith("win"))
+
+# Seconds to wait for forked workers to warm up and start serving.
+READY_TIMEOUT = 300
+
+
+def _start_generation(app, number, root_prefix="", hostname="0.0.0.0",
+                      http_port=None, https_port=None, https_cert_path=None,
+                      https_certkey_path=None, threads=10, max_threads=-1,
+                      bulk_threads=None, request_queue_size=5,
+                      device_timeout=35.0, device_port=None, device_url=None):
+    """Start serving `app` from this process.
+
+    :param int device_port: Also listen on this loopback port, for
+        device routes proxied from other workers.
+    :param str device_url: Proxy device routes to the device worker at
+        this url rather than handling them here.
+    :param float device_timeout: Most seconds to wait for the device
+        worker to answer a proxied request.
+    :return: The running :class:`ServerGeneration`.
+
+    """
+    settings = {
+        "root_prefix": root_prefix, "hostname": hostname,
+        "http_port": http_port, "https_port": https_port,
+        "https_cert_path": https_cert_path,
+        "https_certkey_path": https_certkey_path, "threads": threads,
+        "max_threads": max_threads, "bulk_threads": bulk_threads,
+        "request_queue_size": request_queue_size,
+        "device_timeout": device_timeout
+    }
     root_prefix = root_prefix or ""
-    dispatcher = wsgi.PathInfoDispatcher({root_prefix: app})
-    global _http_server
-    global _https_server
-    http_thread = None
-    https_thread = None
+    if bulk_threads is None:
+        bulk_threads = max(threads // 2, 1)
+    bulk_threads = max(min(bulk_threads, threads - 1), 1)
+    app_switch = AppSwitch(app)
+    handler = app_switch
+    if device_url:
+        handler = DeviceProxy(
+            handler, device_url, DEVICE_PATH_PREFIXES,
+            read_timeout=device_timeout)
+    lanes = PriorityLaneDispatcher(handler, bulk_threads=bulk_threads)
+    dispatcher = wsgi.PathInfoDispatcher({root_prefix: lanes})
+    server_kwargs = {
+        "numthreads": threads,
+        "max": max_threads,
+        "request_queue_size": request_queue_size,
+        "reuse_port": REUSE_PORT_SUPPORTED
+    }
+    http_server = None
+    https_server = None
     if http_port:
-        _http_server = wsgi.Server(
-            (hostname, http_port), dispatcher)
-        http_thread = threading.Thread(target=_http_server.start)
+        http_server = wsgi.Server(
+            (hostname, http_port), dispatcher, **server_kwargs)
     if https_port:
-        _https_server = wsgi.Server(
-            (hostname, https_port), dispatcher)
-        _https_server.ssl_adapter = BuiltinSSLAdapter(
+        https_server = wsgi.Server(
+            (hostname, https_port), dispatcher, **server_kwargs)
+        https_server.ssl_adapter = BuiltinSSLAdapter(
             https_cert_path, https_certkey_path)
-        https_thread = threading.Thread(target=_https_server.start)
-    if http_thread is not None:
-        http_thread.start()
-    if https_thread is not None:
-        https_thread.start()
+    servers = [srv for srv in (http_server, https_server) if srv is not None]
+    if device_port:
+        servers.append(wsgi.Server(
+            ("127.0.0.1", device_port), dispatcher, **server_kwargs))
+    prepared = []
+    try:
+        for server in servers:
+            # bind now, so the server is accepting connections on return
+            server.prepare()
+            prepared.append(server)
+    except BaseException:
+        for server in prepared:
+            server.stop()
+        raise
+    generation = ServerGeneration(number, app_switch, servers, settings)
+    generation.start()
+    global _http_server
+    global _https_server
+    _http_server = http_server
+    _https_server = https_server
+    return generation
+
+
+def run(app, root_prefix="", hostname="0.0.0.0", http_port=None,
+        https_port=None, https_cert_path=None, https_certkey_path=None,
+        threads=10, max_threads=-1, bulk_threads=None, request_queue_size=5,
+        workers=1, device_port=None, device_timeout=35.0, preload=None,
+        worker_init=None):
+    """Serve `app` over http and/or https.
+
+    :param int threads: Number of server threads per listener.
+    :param int max_threads: Max threads cheroot may grow to, or -1 for
+        no limit.
+    :param int bulk_threads: Threads bulk (non control) requests may
+        use at once. Defaults to half of `threads`. See
+        :class:`PriorityLaneDispatcher`.
+    :param int request_queue_size: Listen backlog for each socket.
+    :param int workers: Number of worker processes. More than one
+        starts a :class:`~bender_mc.prefork.PreforkSupervisor`, where
+        supported, and :func:`run` returns once they're all serving.
+    :param int device_port: Loopback port the device worker listens
+        on when running multiple workers. Defaults to a free port.
+    :param float device_timeout: Most seconds other workers wait for
+        the device worker to answer a request they pass on to it.
+    :param preload: Optional callable taking the app, run once before
+        forking multiple workers so they share its work.
+    :param worker_init: Optional callable taking the app, worker index
+        and whether that worker owns the devices, run before serving
+        starts (and in each worker process, if there are several).
+
+    """
+    global _generation
+    global _supervisor
+    global _preload
+    global _worker_init
+    _preload = preload
+    _worker_init = worker_init
+    settings = {
+        "root_prefix": root_prefix, "hostname": hostname,
+        "http_port": http_port, "https_port": https_port,
+        "https_cert_path": https_cert_path,
+        "https_certkey_path": https_certkey_path, "threads": threads,
+        "max_threads": max_threads, "bulk_threads": bulk_threads,
+        "request_queue_size": request_queue_size,
+        "device_timeout": device_timeout
+    }
+    if workers > 1 and not (PREFORK_SUPPORTED and REUSE_PORT_SUPPORTED):
+        logger.warning(
+            "Multiple workers aren't supported on this platform, "
+            "running a single process.")
+        workers = 1
+    with _generation_lock:
+        if workers > 1:
+            if preload is not None:
+                preload(app)
+            _supervisor = PreforkSupervisor(
+                app, workers,
+                device_port=device_port or find_free_port(),
+                start_generation=partial(_start_generation, **settings),
+                worker_init=worker_init)
+            _supervisor.start()
+            if not _supervisor.wait_ready(READY_TIMEOUT):
+                logger.warning(
+                    f"Workers weren't all ready within {READY_TIMEOUT}s.")
+        else:
+            if worker_init is not None:
+                worker_init(app, 0, True)
+            _generation = _start_generation(app, 1, **settings)
     snapclient_cmd = (
         "C:\\Users\\repole\\Projects\\snapcast\\bin\\Release\\snapclient.exe "
         "-h 192.168.1.98 "
@@ -51,7 +344,62 @@ def run(app, root_prefix="", hostname="0.0.0.0", http_port=None,
     subprocess.Popen(snapclient_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
-def run_wsgi_servers(app, user_data_path):
+def reload(app, drain_grace=1.0, workers=1, device_port=None, **settings):
+    """Gracefully switch to serving a new `app`.
+
+    Where SO_REUSEPORT is available a new generation of servers is
+    bound alongside the current one, then the old generation stops
+    accepting connections and is drained. Otherwise `app` is swapped
+    in behind the existing servers, and any change to `settings`
+    (ports, threads) only takes effect after a full restart.
+
+    Either way, requests already in flight finish on the old app and
+    no connection attempts are refused along the way.
+
+    :param app: The new app to serve.
+    :param float drain_grace: See :meth:`ServerGeneration.stop`.
+    :param int workers: When running multiple workers, the new number
+        of workers. Every worker is replaced.
+    :param int device_port: Ignored, the device worker keeps its port
+        across reloads.
+    :param settings: Keyword arguments as accepted by :func:`run`.
+
+    """
+    global _generation
+    if _supervisor is not None:
+        with _generation_lock:
+            _supervisor.workers = max(workers, 2)
+            _supervisor.drain_grace = drain_grace
+            _supervisor.start_generation = partial(
+                _start_generation, **settings)
+        if _preload is not None:
+            _preload(app)
+        _supervisor.reload(app, ready_timeout=READY_TIMEOUT)
+        return None
+    with _generation_lock:
+        old = _generation
+        if old is None:
+            raise RuntimeError("Servers must be running to be reloaded.")
+        if _worker_init is not None:
+            _worker_init(app, 0, True)
+        if not REUSE_PORT_SUPPORTED:
+            if dict(old.settings, **settings) != old.settings:
+                logger.warning(
+                    "Server settings changed, but can't be applied without "
+                    "a restart on this platform.")
+            old.app_switch.app = app
+            logger.info(f"Reloaded app for generation {old.number}.")
+            return old
+        _generation = _start_generation(app, old.number + 1, **settings)
+        logger.info(f"Started server generation {_generation.number}, "
+                    f"draining generation {old.number}.")
+        old.stop(grace=drain_grace)
+        logger.info(f"Server generation {old.number} stopped.")
+        return _generation
+
+
+def read_server_settings(user_data_path):
+    """Read the :func:`run` keyword arguments from config.ini."""
     config_file = os.path.join(user_data_path, 'config.ini')
     config_parser = configparser.RawConfigParser()
     config_parser.read(config_file)
@@ -69,20 +417,72 @@ def run_wsgi_servers(app, user_data_path):
     root_prefix = None if root_prefix == "None" else root_prefix
     https_cert_path = os.path.join(user_data_path, 'keys', 'server.crt')
     https_certkey_path = os.path.join(user_data_path, 'keys', 'server.crtkey')
-    run(app, root_prefix, hostname, http_port, https_port, https_cert_path,
-        https_certkey_path)
+    try:
+        threads = config_parser.getint('api_server', 'threads')
+    except (ValueError, TypeError, configparser.Error):
+        threads = 10
+    try:
+        bulk_threads = config_parser.getint('api_server', 'bulk_threads')
+    except (ValueError, TypeError, configparser.Error):
+        bulk_threads = None
+    try:
+        workers = config_parser.getint('api_server', 'workers')
+    except (ValueError, TypeError, configparser.Error):
+        workers = 1
+    try:
+        device_port = config_parser.getint('api_server', 'device_port')
+    except (ValueError, TypeError, configparser.Error):
+        device_port = None
+    try:
+        request_budget = config_parser.getfloat(
+            'api_server', 'request_budget')
+    except (ValueError, TypeError, configparser.Error):
+        request_budget = 30.0
+    return {
+        "root_prefix": root_prefix,
+        "hostname": hostname,
+        "http_port": http_port,
+        "https_port": https_port,
+        "https_cert_path": https_cert_path,
+        "https_certkey_path": https_certkey_path,
+        "threads": threads,
+        "bulk_threads": bulk_threads,
+        "workers": workers,
+        "device_port": device_port,
+        # The device worker answers within the request budget, give
+        # it a little longer before giving up on it.
+        "device_timeout": request_budget + 5
+    }
+
+
+def run_wsgi_servers(app, user_data_path, preload=None, worker_init=None):
+    run(app, preload=preload, worker_init=worker_init,
+        **read_server_settings(user_data_path))
+
+
+def reload_wsgi_servers(app, user_data_path):
+    """Gracefully reload with a new `app` and the current config.
+
+    See :func:`reload`.
+
+    """
+    return reload(app, **read_server_settings(user_data_path))
 
 
 def stop_wsgi_servers():
-    global _http_server
-    global _https_server
-    if _http_server is not None:
-        _http_server.stop()
-    if _https_server is not None:
-        _https_server.stop()
+    if _supervisor is not None:
+        _supervisor.stop()
+    with _generation_lock:
+        if _generation is not None:
+            _generation.stop()
 
 
 def restart_wsgi_servers():
+    """Restart the whole process, dropping any requests in flight.
+
+    Prefer :func:`reload_wsgi_servers` where possible.
+
+    """
     logger.debug("Entering restart_wsgi_servers()")
     args = sys.argv
     args[0] = '"' + args[0] + '"'
@@ -0,0 +1,88 @@
+"""
+    bender_mc.server_timing
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Adds a `Server-Timing` header breaking down where each API
+    request's time went.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import json
+from flask import request
+from bender_mc import metrics
+
+CATEGORY_DESCRIPTIONS = {
+    "db": "SQLite",
+    "rpc": "Kodi RPC",
+    "process": "External processes",
+    "browser": "Selenium"
+}
+
+
+def timing_breakdown():
+    """Get the current request's time per category, in milliseconds.
+
+    :return: Dict with a `total` and `app` (time not attributed to any
+        other category) entry, plus `{"dur": ms, "count": n}` for each
+        category that was used. `None` outside of a request.
+
+    """
+    state = metrics.current_request()
+    if state is None:
+        return None
+    elapsed, durations, counts = state
+    breakdown = {}
+    attributed = 0.0
+    for category in CATEGORY_DESCRIPTIONS:
+        if category in durations:
+            attributed += durations[category]
+            breakdown[category] = {
+                "dur": round(durations[category] * 1000, 3),
+                "count": counts.get(category, 0)
+            }
+    breakdown["app"] = {"dur": round(max(elapsed - attributed, 0) * 1000, 3)}
+    breakdown["total"] = {"dur": round(elapsed * 1000, 3)}
+    return breakdown
+
+
+def format_server_timing(breakdown):
+    """Format a :func:`timing_breakdown` as a Server-Timing value."""
+    entries = []
+    for name, timing in breakdown.items():
+        entry = f"{name};dur={timing['dur']}"
+        description = CATEGORY_DESCRIPTIONS.get(name)
+        if description:
+            entry += f';desc="{description} ({timing["count"]} calls)"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+
+def instrument_server_timing(app, debug_footer=False):
+    """Emit a `Server-Timing` header on every response from `app`.
+
+    Relies on the per request accounting set up by
+    :func:`bender_mc.metrics.instrument_app`.
+
+    :param bool debug_footer: If `True`, JSON object responses also get
+        the breakdown added under a `_timing` key. Can be requested
+        per call with `?debugTiming=true` as well.
+
+    """
+    @app.after_request
+    def server_timing_after_request(response):
+        breakdown = timing_breakdown()
+        if breakdown is None:
+            return response
+        response.headers["Server-Timing"] = format_server_timing(breakdown)
+        wants_footer = debug_footer or request.args.get(
+            "debugTiming", "").lower() in ("1", "true", "yes")
+        if wants_footer and response.mimetype == "application/json" and (
+                not response.direct_passthrough):
+            try:
+                data = json.loads(response.get_data())
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                data["_timing"] = breakdown
+                response.set_data(json.dumps(data))
+        return response
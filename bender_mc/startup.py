@@ -0,0 +1,57 @@
+"""
+    bender_mc.startup
+    ~~~~~~~~~~~~~~~~~
+
+    Tracks how long each stage of starting the server takes.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import time
+from contextlib import contextmanager
+import psutil
+from drowsy.log import Loggable
+
+
+class StartupReport(Loggable):
+
+    """Records named startup phases and summarizes them.
+
+    Time between the process being created and this report being
+    created (interpreter start up and imports) is recorded as the
+    first phase, `imports`.
+
+    """
+
+    def __init__(self):
+        self.phases = []
+        now = time.time()
+        try:
+            process_started = psutil.Process().create_time()
+        except psutil.Error:
+            process_started = now
+        self.started_at = process_started
+        self.phases.append(("imports", max(now - process_started, 0.0)))
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing a named phase of startup."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    @property
+    def total(self):
+        return sum(duration for _, duration in self.phases)
+
+    def to_dict(self):
+        return {
+            "totalS": round(self.total, 3),
+            "phases": {name: round(d, 3) for name, d in self.phases}
+        }
+
+    def summary(self):
+        phases = ", ".join(
+            f"{name} {duration:.3f}s" for name, duration in self.phases)
+        return f"Started in {self.total:.3f}s ({phases})."
@@ -6,6 +6,71 @@
 """
 # :copyright: (c) 2020 by Nicholas Repole.
 # :license: MIT - See LICENSE for more details.
+import os
+import subprocess
+import time
+from bender_mc import metrics
+
+
+class Deadline(object):
+
+    """Latency budget for a unit of work, such as an API request.
+
+    :param budget: Number of seconds from now until the deadline
+        passes, or `None` for no deadline.
+
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.expires_at = None
+        if budget is not None:
+            self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        """Seconds left before the deadline, `None` if unbounded."""
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and self.remaining() <= 0
+
+    def bound(self, timeout):
+        """Shrink `timeout` so that it doesn't outlive the deadline."""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+
+def run_process(args, name=None, **kwargs):
+    """Run an external process to completion, timing how long it takes.
+
+    :param list args: Command line to run.
+    :param str name: Name to record the duration under. Defaults to
+        the executable's file name.
+    :param kwargs: Passed on to :class:`subprocess.Popen`.
+    :return: The finished :class:`subprocess.Popen` instance.
+
+    """
+    name = name or os.path.basename(str(args[0]))
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    with metrics.timed("process", name):
+        p = subprocess.Popen(args, **kwargs)
+        p.communicate()
+    return p
+
+
+def check_process_output(args, name=None, **kwargs):
+    """Like :func:`subprocess.check_output`, but timed."""
+    name = name or os.path.basename(str(args[0]))
+    with metrics.timed("process", name):
+        return subprocess.check_output(args, **kwargs)
+
 
 def deformat_title(formatted_title):
     return formatted_title.replace(
@@ -0,0 +1,167 @@
+"""
+    bender_mc.warmup
+    ~~~~~~~~~~~~~~~~
+
+    Pays first request costs up front, before the server starts
+    accepting connections.
+"""
+# :copyright: (c) 2022 by Nicholas Repole.
+# :license: MIT - See LICENSE for more details.
+import logging
+import time
+from sqlalchemy import text
+from bender_mc.api.utils import (
+    db_engines, get_audio_commands, get_playback_service,
+    get_rpc_circuit_breaker, get_rpc_session, get_scoped_db_session,
+    load_browser_controller, load_db_sessions, close_db_sessions)
+
+DEFAULT_STEPS = (
+    "mappers", "schemas", "db", "slots", "kodi", "audio", "playback",
+    "browser")
+# Steps only run by the process that owns the devices.
+DEVICE_STEPS = ("audio", "playback", "browser")
+# Steps that are safe to run once before forking worker processes, as
+# they don't touch devices. Database connections they open must be
+# disposed of before forking.
+PRELOAD_STEPS = ("mappers", "schemas", "imports", "slots")
+
+logger = logging.getLogger("kodi_api")
+
+
+def warm_mappers(app):
+    """Import the models and configure their mappers."""
+    from sqlalchemy.orm import configure_mappers
+    import bender_mc.kodi.models.video
+    configure_mappers()
+
+
+def warm_schemas(app):
+    """Import the resources and build each of their schemas."""
+    import bender_mc.kodi.resources.video as video_resources
+    for value in vars(video_resources).values():
+        options = getattr(value, "Meta", None)
+        schema_cls = getattr(options, "schema_cls", None)
+        if schema_cls is not None:
+            schema_cls()
+
+
+def warm_imports(app):
+    """Import modules that are otherwise only loaded on first use."""
+    from bender_mc.api.slots import get_inflector
+    get_inflector()
+
+
+def warm_db(app):
+    """Fill each engine's connection pool."""
+    pool_size = app.config["global"].get("db_pool_size", 5) or 1
+    for engine in db_engines.values():
+        connections = []
+        try:
+            for _ in range(pool_size):
+                connection = engine.connect()
+                connection.execute(text("SELECT 1"))
+                connections.append(connection)
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+def warm_slots(app):
+    """Build the cached video slot values, publishing the shared
+    library snapshot if it's out of date."""
+    from bender_mc.api.slots import get_video_slots
+    with app.app_context():
+        load_db_sessions()
+        try:
+            get_video_slots(get_scoped_db_session("video"))
+        finally:
+            close_db_sessions()
+
+
+def warm_kodi(app):
+    """Open the shared keep-alive connection to Kodi."""
+    from bender_mc.kodi.rpc_client import KodiRpcClient
+    config = app.config
+    if "kodirpc" not in config:
+        return
+    client = KodiRpcClient(
+        base_url=config["kodirpc"]["url"],
+        username=config["kodirpc"]["username"],
+        password=config["kodirpc"]["password"],
+        timeout=config["kodirpc"].get("timeout", 5),
+        connect_timeout=config["kodirpc"].get("connect_timeout", 2),
+        circuit_breaker=get_rpc_circuit_breaker(config),
+        session=get_rpc_session(config))
+    client.ping()
+
+
+def warm_audio(app):
+    """Create the audio controller and its command queue."""
+    get_audio_commands()
+
+
+def warm_playback(app):
+    """Create the announcement player and its queue."""
+    get_playback_service()
+
+
+def warm_browser(app):
+    """Create the browser controller if it's to keep a standby browser
+    ready, which starts it logging in."""
+    if not app.config.get("browser", {}).get("standby", False):
+        return
+    with app.app_context():
+        load_browser_controller()
+
+
+WARMUP_STEPS = {
+    "mappers": warm_mappers,
+    "schemas": warm_schemas,
+    "imports": warm_imports,
+    "db": warm_db,
+    "slots": warm_slots,
+    "kodi": warm_kodi,
+    "audio": warm_audio,
+    "playback": warm_playback,
+    "browser": warm_browser
+}
+
+
+def warm_up(app, steps=None, device=True):
+    """Run warm up steps for `app`.
+
+    A failing step is logged and skipped; the server should still
+    start if, say, Kodi isn't running yet.
+
+    :param app: The Flask app to warm up.
+    :param steps: Names of the steps to run, in order. Defaults to the
+        `[warmup] steps` config value, or all steps.
+    :param bool device: Whether this process owns the devices. Other
+        worker processes skip :data:`DEVICE_STEPS`.
+    :return: A dict of step name to seconds taken, or `None` if the
+        step failed.
+
+    """
+    config = app.config.get("warmup", {})
+    if not config.get("enabled", True):
+        return {}
+    if steps is None:
+        steps = config.get("steps") or DEFAULT_STEPS
+    if not device:
+        steps = [name for name in steps if name not in DEVICE_STEPS]
+    timings = {}
+    for name in steps:
+        step = WARMUP_STEPS.get(name)
+        if step is None:
+            logger.warning(f"Unknown warm up step {name}.")
+            continue
+        start = time.perf_counter()
+        try:
+            step(app)
+        except Exception:
+            logger.warning(f"Warm up step {name} failed.", exc_info=True)
+            timings[name] = None
+            continue
+        timings[name] = time.perf_counter() - start
+        logger.debug(f"Warm up step {name} took {timings[name]:.3f}s.")
+    return timings
@@ -0,0 +1,34 @@
+import flask
+import pytest
+from bender_mc.api import utils
+from bender_mc.api.jobs import jobs_blueprint
+from bender_mc.api.media_center import media_center_api_blueprint
+from bender_mc.api.video import video_api_blueprint
+
+
+@pytest.fixture
+def app():
+    """A bare app serving the API against an empty in memory db."""
+    app = flask.Flask("bender_mc")
+    app.config.update({
+        "api_server": {"coalesce": True},
+        "kodirpc": {
+            "url": "http://kodi.invalid/", "username": "", "password": ""},
+        "jobs": {"enabled": True, "workers": 2, "retained": 10,
+                 "callback_hosts": ["hooks.example"]}
+    })
+    app.register_blueprint(video_api_blueprint, url_prefix="/api/video")
+    app.register_blueprint(
+        media_center_api_blueprint, url_prefix="/api/mediaCenter")
+    app.register_blueprint(jobs_blueprint, url_prefix="/api/jobs")
+    utils.set_db_engine("video", "sqlite://")
+    yield app
+    for manager in utils.job_manager_registry:
+        manager.shutdown(wait=False)
+    del utils.job_manager_registry[:]
+    del utils.single_flight_registry[:]
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
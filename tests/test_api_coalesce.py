@@ -0,0 +1,98 @@
+import threading
+import pytest
+from bender_mc.api import video
+from bender_mc.kodi.rpc_client import KodiRpcClient
+
+
+@pytest.fixture
+def toggling(monkeypatch):
+    """Make pausing block until the returned event is set."""
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def play_pause_toggle(self):
+        calls.append(self)
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(
+        KodiRpcClient, "play_pause_toggle", play_pause_toggle)
+    yield started, release, calls
+    release.set()
+
+
+def test_duplicates_share_a_copied_response(app, client, toggling):
+    started, release, calls = toggling
+    leader = []
+
+    @app.after_request
+    def mark(response):
+        response.headers.add("X-Seen", "1")
+        return response
+
+    thread = threading.Thread(target=lambda: leader.append(
+        client.post("/api/video/player/state", data="pause")))
+    thread.start()
+    assert started.wait(5)
+    followers = []
+    follower = threading.Thread(target=lambda: followers.append(
+        client.post("/api/video/player/state", data="pause")))
+    follower.start()
+    release.set()
+    thread.join(5)
+    follower.join(5)
+    assert len(calls) == 1
+    assert followers[0].json == leader[0].json == {"result": "success"}
+    assert followers[0].headers["X-Coalesced"] == "true"
+    assert "X-Coalesced" not in leader[0].headers
+    assert leader[0].headers.getlist("X-Seen") == ["1"]
+    assert followers[0].headers.getlist("X-Seen") == ["1"]
+
+
+def test_repeated_commands_run_again(client, toggling):
+    started, release, calls = toggling
+    release.set()
+    for _ in range(3):
+        response = client.post("/api/video/player/state", data="pause")
+        assert "X-Coalesced" not in response.headers
+    assert len(calls) == 3
+
+
+def test_duplicate_job_shared(client, monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def play_media(data):
+        calls.append(data)
+        release.wait(5)
+
+    monkeypatch.setattr(video, "play_media", play_media)
+    body = {"mediaType": "nba", "mediaTitle": "celtics"}
+    first = client.post("/api/video/player/media", json=body)
+    # Key order doesn't matter.
+    second = client.post(
+        "/api/video/player/media",
+        json={"mediaTitle": "celtics", "mediaType": "nba"})
+    other = client.post(
+        "/api/video/player/media", json={"mediaType": "movie",
+                                         "mediaTitle": "heat"})
+    assert first.status_code == second.status_code == 202
+    assert first.json["jobId"] == second.json["jobId"]
+    assert other.json["jobId"] != first.json["jobId"]
+    release.set()
+    client.get(f"/api/jobs/{first.json['jobId']}?wait=5")
+    third = client.post("/api/video/player/media", json=body)
+    assert third.json["jobId"] != first.json["jobId"]
+    client.get(f"/api/jobs/{third.json['jobId']}?wait=5")
+    assert len(calls) == 3
+
+
+def test_coalescing_disabled(app, client, monkeypatch):
+    app.config["api_server"]["coalesce"] = False
+    monkeypatch.setattr(video, "play_media", lambda data: None)
+    body = {"mediaType": "movie", "mediaTitle": "heat"}
+    first = client.post("/api/video/player/media", json=body)
+    client.get(f"/api/jobs/{first.json['jobId']}?wait=5")
+    second = client.post("/api/video/player/media", json=body)
+    assert first.json["jobId"] != second.json["jobId"]
@@ -0,0 +1,99 @@
+import threading
+import pytest
+from bender_mc.api import video
+
+
+@pytest.fixture
+def playing(monkeypatch):
+    """Make play_media block until the returned event is set."""
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def play_media(data):
+        calls.append(data)
+        started.set()
+        release.wait(5)
+        return {"result": "success"}
+
+    monkeypatch.setattr(video, "play_media", play_media)
+    yield started, release, calls
+    release.set()
+
+
+NBA = {"mediaType": "nba", "mediaTitle": "celtics"}
+
+
+def test_media_returns_job(client, playing):
+    started, release, calls = playing
+    response = client.post("/api/video/player/media", json=NBA)
+    assert response.status_code == 202
+    job_id = response.json["jobId"]
+    assert response.headers["Location"].endswith(f"/api/jobs/{job_id}")
+    release.set()
+    status = client.get(f"/api/jobs/{job_id}?wait=5").json
+    assert status["status"] == "succeeded"
+
+
+def test_sync_play_holds_browser(client, playing):
+    started, release, calls = playing
+    responses = []
+    sync_play = threading.Thread(target=lambda: responses.append(
+        client.post("/api/video/player/media?sync=true", json=NBA)))
+    sync_play.start()
+    assert started.wait(5)
+    response = client.post(
+        "/api/video/player/media", json=dict(NBA, mediaTitle="heat"))
+    assert response.status_code == 409
+    assert response.json["code"] == "job_conflict"
+    release.set()
+    sync_play.join(5)
+    assert responses[0].status_code == 200
+    assert len(calls) == 1
+
+
+def test_sync_play_waits_for_browser_job(client, playing):
+    started, release, calls = playing
+    client.post("/api/video/player/media", json=NBA)
+    assert started.wait(5)
+    response = client.post(
+        "/api/video/player/media?sync=true",
+        json=dict(NBA, mediaTitle="heat"))
+    assert response.status_code == 409
+    assert len(calls) == 1
+
+
+def test_callback_url_must_be_allowed(client, playing):
+    response = client.post("/api/video/player/media", json=dict(
+        NBA, callbackUrl="http://169.254.169.254/latest"))
+    assert response.status_code == 400
+    assert response.json["code"] == "callback_not_allowed"
+    assert not playing[2]
+
+
+def test_allowed_callback_url(client, playing, monkeypatch):
+    posted = []
+    monkeypatch.setattr(
+        "bender_mc.api.utils.requests.post",
+        lambda url, **kwargs: posted.append(url))
+    started, release, calls = playing
+    release.set()
+    response = client.post("/api/video/player/media", json=dict(
+        NBA, callbackUrl="https://HOOKS.example/done"))
+    assert response.status_code == 202
+    job_id = response.json["jobId"]
+    client.get(f"/api/jobs/{job_id}?wait=5")
+    assert posted == ["https://HOOKS.example/done"]
+
+
+def test_jobs_full(app, client, playing):
+    app.config["jobs"]["retained"] = 2
+    started, release, calls = playing
+    for title in ("one", "two"):
+        response = client.post("/api/video/player/media", json={
+            "mediaType": "movie", "mediaTitle": title})
+        assert response.status_code == 202
+    response = client.post("/api/video/player/media", json={
+        "mediaType": "movie", "mediaTitle": "three"})
+    assert response.status_code == 503
+    assert response.json["code"] == "jobs_full"
@@ -0,0 +1,72 @@
+import json
+import os
+import pytest
+from bender_mc.browser_controller import parse_scoreboard
+
+
+@pytest.fixture(scope="module")
+def cards():
+    path = os.path.join(
+        os.path.dirname(__file__), "fixtures", "nba_scoreboard_cards.json")
+    with open(path) as fixture_file:
+        return json.load(fixture_file)
+
+
+def test_regular_live_game(cards):
+    assert parse_scoreboard([cards["regular_live"]]) == [{
+        "watchLink": cards["regular_live"]["watchLink"],
+        "awayTeam": "BOS",
+        "awayScore": "78",
+        "homeTeam": "NYK",
+        "homeScore": "74",
+        "status": "LIVE",
+        "period": 3
+    }]
+
+
+def test_playoff_game(cards):
+    game, = parse_scoreboard([cards["playoff_live"]])
+    assert (game["awayTeam"], game["awayScore"]) == ("BOS", "101")
+    assert (game["homeTeam"], game["homeScore"]) == ("MIA", "96")
+    assert (game["status"], game["period"]) == ("LIVE", 4)
+
+
+def test_final_ignores_blank_lines(cards):
+    game, = parse_scoreboard([cards["regular_final"]])
+    assert (game["awayTeam"], game["homeTeam"]) == ("LAL", "GSW")
+    assert (game["status"], game["period"]) == ("COMPLETED", 4)
+
+
+def test_half(cards):
+    game, = parse_scoreboard([cards["regular_half"]])
+    assert (game["status"], game["period"]) == ("BREAK", 3)
+
+
+def test_end_of_quarter(cards):
+    game, = parse_scoreboard([cards["regular_end_quarter"]])
+    assert (game["status"], game["period"]) == ("BREAK", 2)
+
+
+def test_pregame(cards):
+    game, = parse_scoreboard([cards["regular_pregame"]])
+    assert (game["awayTeam"], game["homeTeam"]) == ("SAS", "DAL")
+    assert (game["status"], game["period"]) == ("PREGAME", 0)
+
+
+def test_cards_without_link_are_skipped(cards):
+    assert parse_scoreboard([cards["no_link"]]) == []
+
+
+def test_unrecognized_cards_are_skipped(cards):
+    assert parse_scoreboard([cards["unrecognized"]]) == []
+
+
+def test_whole_scoreboard_keeps_order(cards):
+    games = parse_scoreboard(list(cards.values()))
+    assert [game["homeTeam"] for game in games] == [
+        "NYK", "GSW", "DEN", "MIL", "DAL", "MIA"]
+
+
+def test_no_cards():
+    assert parse_scoreboard(None) == []
+    assert parse_scoreboard([]) == []
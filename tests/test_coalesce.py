@@ -0,0 +1,94 @@
+import threading
+import pytest
+from bender_mc.coalesce import SingleFlight
+
+
+def start_leader(flight, key="key", result="result", exception=None):
+    """Start a call that runs until the returned release event is set."""
+    started = threading.Event()
+    release = threading.Event()
+    outcome = []
+
+    def func():
+        started.set()
+        release.wait(5)
+        if exception is not None:
+            raise exception
+        return result
+
+    def lead():
+        try:
+            outcome.append(flight.do(key, func))
+        except Exception as exc:
+            outcome.append(exc)
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    assert started.wait(5)
+    return release, thread, outcome
+
+
+def test_single_call_runs():
+    assert SingleFlight().do("key", lambda x: x * 2, 2) == (4, False)
+
+
+def test_duplicate_shares_running_call():
+    flight = SingleFlight()
+    release, thread, outcome = start_leader(flight)
+    followers = []
+    follower = threading.Thread(target=lambda: followers.append(
+        flight.do("key", pytest.fail, "duplicate ran")))
+    follower.start()
+    release.set()
+    thread.join(5)
+    follower.join(5)
+    assert outcome == [("result", False)]
+    assert followers == [("result", True)]
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+    release, thread, outcome = start_leader(flight)
+    assert flight.do("other", lambda: "other") == ("other", False)
+    release.set()
+    thread.join(5)
+
+
+def test_finished_call_forgotten():
+    flight = SingleFlight()
+    calls = []
+    flight.do("toggle", calls.append, 1)
+    flight.do("toggle", calls.append, 2)
+    assert calls == [1, 2]
+    assert not flight.calls
+
+
+def test_exception_shared():
+    flight = SingleFlight()
+    release, thread, outcome = start_leader(
+        flight, exception=ValueError("bad"))
+    errors = []
+
+    def follow():
+        try:
+            flight.do("key", pytest.fail, "duplicate ran")
+        except ValueError as exc:
+            errors.append(exc)
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    release.set()
+    thread.join(5)
+    follower.join(5)
+    assert errors == outcome
+    assert not flight.calls
+
+
+def test_follower_timeout():
+    flight = SingleFlight()
+    release, thread, outcome = start_leader(flight)
+    with pytest.raises(TimeoutError):
+        flight.do("key", pytest.fail, "duplicate ran", timeout=.05)
+    release.set()
+    thread.join(5)
+    assert outcome == [("result", False)]
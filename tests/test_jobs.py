@@ -0,0 +1,130 @@
+import threading
+import pytest
+from bender_mc.jobs import Job, JobConflictError, JobManager, JobsFullError
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(max_workers=2, max_retained=3)
+    yield manager
+    manager.shutdown(wait=False)
+
+
+def blocked():
+    """Get a job function that runs until the returned event is set."""
+    release = threading.Event()
+    return (lambda: release.wait(5)), release
+
+
+def test_job_result(manager):
+    job = manager.submit("add", lambda: 1 + 1)
+    assert job.wait(5)
+    assert job.status == Job.SUCCEEDED
+    assert job.result == 2
+    assert manager.get(job.id) is job
+
+
+def test_job_failure(manager):
+    def fail():
+        raise ValueError("nope")
+
+    job = manager.submit("fail", fail)
+    assert job.wait(5)
+    assert job.status == Job.FAILED
+    assert job.error == {"message": "nope", "code": "job_failed"}
+
+
+def test_on_finished(manager):
+    finished = []
+    job = manager.submit("noop", lambda: None, on_finished=finished.append)
+    job.wait(5)
+    manager.shutdown()
+    assert finished == [job]
+
+
+def test_group_conflict(manager):
+    func, release = blocked()
+    first = manager.submit("play", func, group="browser")
+    with pytest.raises(JobConflictError) as info:
+        manager.submit("play", lambda: None, group="browser")
+    assert info.value.job is first
+    assert manager.unfinished("browser") is first
+    # Other groups and ungrouped jobs aren't affected.
+    manager.submit("other", lambda: None, group="speakers").wait(5)
+    manager.submit("free", lambda: None).wait(5)
+    release.set()
+    first.wait(5)
+    assert manager.unfinished("browser") is None
+    manager.submit("play", lambda: None, group="browser").wait(5)
+
+
+def test_failed_job_frees_group(manager):
+    def fail():
+        raise RuntimeError()
+
+    manager.submit("play", fail, group="browser").wait(5)
+    assert manager.unfinished("browser") is None
+
+
+def test_finished_jobs_pruned_oldest_first(manager):
+    jobs = [manager.submit(str(i), lambda: None) for i in range(5)]
+    for job in jobs:
+        job.wait(5)
+    manager.submit("last", lambda: None).wait(5)
+    assert len(manager.jobs) == 3
+    assert manager.get(jobs[0].id) is None
+    assert manager.get(jobs[4].id) is jobs[4]
+
+
+def test_unfinished_jobs_never_forgotten(manager):
+    func, release = blocked()
+    jobs = [manager.submit(str(i), func) for i in range(3)]
+    with pytest.raises(JobsFullError):
+        manager.submit("one more", lambda: None)
+    assert [manager.get(job.id) for job in jobs] == jobs
+    release.set()
+    for job in jobs:
+        job.wait(5)
+    manager.submit("one more", lambda: None).wait(5)
+    assert manager.get(jobs[0].id) is None
+
+
+def test_reserve_holds_group(manager):
+    with manager.reserve("play", "browser") as job:
+        assert job.status == Job.RUNNING
+        assert manager.get(job.id) is job
+        with pytest.raises(JobConflictError):
+            manager.submit("play", lambda: None, group="browser")
+    assert job.status == Job.SUCCEEDED
+    assert job.finished
+    assert manager.unfinished("browser") is None
+
+
+def test_reserve_conflicts_with_job(manager):
+    func, release = blocked()
+    first = manager.submit("play", func, group="browser")
+    with pytest.raises(JobConflictError) as info:
+        with manager.reserve("play", "browser"):
+            pass
+    assert info.value.job is first
+    release.set()
+
+
+def test_reserve_failure(manager):
+    with pytest.raises(KeyError):
+        with manager.reserve("play", "browser") as job:
+            raise KeyError("missing")
+    assert job.status == Job.FAILED
+    assert manager.unfinished("browser") is None
+
+
+def test_duplicate_key_shares_job(manager):
+    func, release = blocked()
+    first = manager.submit("play", func, group="browser", key="same")
+    assert manager.submit("play", func, group="browser", key="same") is first
+    with pytest.raises(JobConflictError):
+        manager.submit("play", func, group="browser", key="other")
+    release.set()
+    first.wait(5)
+    second = manager.submit("play", lambda: None, key="same")
+    assert second is not first
@@ -0,0 +1,59 @@
+import pytest
+from werkzeug.test import Client
+from bender_mc.kodi.fake_server import FakeKodi, FakeKodiApp
+from bender_mc.loadgen import LoadGenerator, percentile
+
+
+@pytest.fixture
+def client():
+    return Client(FakeKodiApp(FakeKodi()))
+
+
+def test_fake_config_changes_faults(client):
+    response = client.post("/fake/config", json={"latency": "0.5"})
+    assert response.status_code == 200
+    assert response.json["latency"] == 0.5
+
+
+@pytest.mark.parametrize("body", [
+    {"latency": "slow"}, {"error_rate": [1]}, [1, 2], "0.5"])
+def test_fake_config_rejects_bad_values(client, body):
+    response = client.post("/fake/config", json=body)
+    assert response.status_code == 400
+    assert client.get("/fake/state").json["faults"]["latency"] == 0.0
+
+
+def test_fake_config_rejects_invalid_json(client):
+    response = client.post("/fake/config", data=b"{")
+    assert response.status_code == 400
+
+
+def test_fake_jsonrpc_call(client):
+    response = client.post("/jsonrpc", json={
+        "jsonrpc": "2.0", "id": 1, "method": "JSONRPC.Ping"})
+    assert response.json["result"] == "pong"
+
+
+def test_percentile():
+    assert percentile([], .5) is None
+    assert percentile([1, 2, 3, 4, 5], .5) == 3
+    assert percentile([1, 2, 3, 4, 5], .99) == 5
+
+
+def test_run_counts_requests():
+    generator = LoadGenerator("http://localhost", ["pause"], concurrency=3)
+    fired = []
+    generator.fire = lambda: fired.append(1)
+    generator.run(total=10)
+    assert len(fired) == 10
+
+
+def test_run_raises_worker_errors():
+    generator = LoadGenerator("http://localhost", ["pause"], concurrency=2)
+
+    def fire():
+        raise RuntimeError("broken")
+
+    generator.fire = fire
+    with pytest.raises(RuntimeError):
+        generator.run(total=4)
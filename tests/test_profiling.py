@@ -0,0 +1,74 @@
+import cProfile
+import os
+import flask
+import pytest
+from bender_mc.api import utils
+from bender_mc.api.profiles import profiles_blueprint
+from bender_mc.profiling import RequestProfiler
+
+
+def write_profile(directory, name, mtime):
+    path = os.path.join(str(directory), name)
+    cProfile.Profile().dump_stats(path)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def record(profiler, route="/api/video/movies", elapsed=.01):
+    profile = profiler.start()
+    sum(range(100))
+    return profiler.finish(profile, route, "GET", elapsed)
+
+
+def test_keeps_recent_profiles(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), keep=2)
+    records = [record(profiler, elapsed=i / 100) for i in range(3)]
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        r["name"] for r in records[1:])
+    assert profiler.slowest()[0] == records[2]
+    assert "function calls" in profiler.summary(records[2]["name"])
+
+
+def test_prunes_profiles_from_earlier_runs(tmp_path):
+    oldest = write_profile(
+        tmp_path, "20220101-000000_get_slots-movies_50ms_001.prof", 1000)
+    newer = write_profile(
+        tmp_path, "20220101-000001_post_api-jobs_7ms_002.prof", 2000)
+    other = tmp_path / "notes.txt"
+    other.write_text("not a profile")
+    profiler = RequestProfiler(str(tmp_path), keep=1)
+    assert not os.path.exists(oldest)
+    loaded = profiler.get(os.path.basename(newer))
+    assert loaded["method"] == "POST"
+    assert loaded["latencyMs"] == 7.0
+    new = record(profiler)
+    assert not os.path.exists(newer)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        [new["name"], "notes.txt"])
+
+
+@pytest.fixture
+def profiles_client(tmp_path):
+    app = flask.Flask("bender_mc")
+    app.register_blueprint(profiles_blueprint, url_prefix="/api/profiles")
+    profiler = RequestProfiler(str(tmp_path))
+    utils.set_profiler(profiler)
+    yield app.test_client(), profiler
+    del utils.profiler_registry[:]
+
+
+def test_summary(profiles_client):
+    client, profiler = profiles_client
+    name = record(profiler)["name"]
+    response = client.get(f"/api/profiles/{name}?sort=nonsense")
+    assert response.status_code == 200
+    assert "function calls" in response.get_data(as_text=True)
+
+
+def test_pruned_profile_not_found(profiles_client):
+    client, profiler = profiles_client
+    name = record(profiler)["name"]
+    os.remove(os.path.join(profiler.output_dir, name))
+    response = client.get(f"/api/profiles/{name}")
+    assert response.status_code == 404
+    assert response.json["code"] == "profile_not_found"
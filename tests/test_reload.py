@@ -0,0 +1,42 @@
+import logging
+import pytest
+from bender_mc.api import utils
+
+
+@pytest.fixture
+def kept_config():
+    utils.kept_registry_config.clear()
+    yield utils.kept_registry_config
+    utils.kept_registry_config.clear()
+
+
+def test_job_manager_config_remembered(app, kept_config):
+    with app.app_context():
+        utils.get_job_manager()
+    assert kept_config["jobs"] == app.config["jobs"]
+
+
+def test_warns_about_changed_sections(app, kept_config, caplog):
+    with app.app_context():
+        utils.get_job_manager()
+    new_config = dict(app.config, jobs=dict(app.config["jobs"], workers=8))
+    with caplog.at_level(logging.WARNING):
+        assert utils.warn_unapplied_config(new_config) == ["jobs"]
+    assert "[jobs]" in caplog.text
+    assert utils.warn_unapplied_config(app.config) == []
+
+
+def test_unused_sections_ignored(app, kept_config):
+    new_config = dict(app.config, jobs={"workers": 8})
+    assert utils.warn_unapplied_config(new_config) == []
+
+
+def test_reset_forgets_config_registries(app):
+    with app.app_context():
+        flight = utils.get_single_flight()
+        breaker = utils.get_rpc_circuit_breaker(app.config)
+        manager = utils.get_job_manager()
+        utils.reset_config_registries()
+        assert utils.get_single_flight() is not flight
+        assert utils.get_rpc_circuit_breaker(app.config) is not breaker
+        assert utils.get_job_manager() is manager
@@ -0,0 +1,157 @@
+import pytest
+import requests
+from bender_mc.kodi import rpc_client
+from bender_mc.kodi.rpc_client import (
+    CircuitBreaker, KodiRpcClient, KodiTimeoutError, KodiUnavailableError)
+from bender_mc.utils import Deadline
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rpc_client.time, "monotonic", clock)
+    return clock
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeSession(object):
+
+    """Answers posts from a list of responses or exceptions."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = []
+
+    def post(self, url, **kwargs):
+        self.posts.append((url, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def pong():
+    return FakeResponse(body=[{"id": 140, "result": "pong"}])
+
+
+def make_client(session, **kwargs):
+    return KodiRpcClient(
+        "http://kodi", "user", "pass", session=session, **kwargs)
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.now += 9.9
+    assert not breaker.allow()
+    clock.now += .1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only the one trial call is let through.
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_failed_trial_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 5
+    assert not breaker.allow()
+    clock.now += 5
+    assert breaker.allow()
+
+
+def test_client_records_outcomes(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    session = FakeSession(
+        requests.Timeout(), requests.ConnectionError(), pong())
+    client = make_client(session, circuit_breaker=breaker)
+    with pytest.raises(KodiTimeoutError):
+        client.ping()
+    with pytest.raises(KodiUnavailableError):
+        client.ping()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(KodiUnavailableError):
+        client.ping()
+    # Rejected without touching the network.
+    assert len(session.posts) == 2
+    clock.now += 10
+    assert client.ping()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.parametrize("outcome", [
+    requests.exceptions.InvalidURL(), FakeResponse(status_code=503)])
+def test_failed_trial_doesnt_stick_half_open(clock, outcome):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.now += 10
+    client = make_client(FakeSession(outcome), circuit_breaker=breaker)
+    try:
+        client.ping()
+    except Exception:
+        pass
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 10
+    assert breaker.allow()
+
+
+def test_timeouts_bounded_by_deadline(clock):
+    session = FakeSession(pong())
+    client = make_client(
+        session, timeout=5, connect_timeout=2, deadline=Deadline(1))
+    client.ping()
+    connect_timeout, timeout = session.posts[0][1]["timeout"]
+    assert connect_timeout <= 1 and timeout <= 1
+
+
+def test_expired_deadline_skips_the_call(clock):
+    session = FakeSession()
+    client = make_client(session, deadline=Deadline(0))
+    with pytest.raises(KodiTimeoutError) as info:
+        client.ping()
+    assert info.value.code == "deadline_exceeded"
+    assert not session.posts
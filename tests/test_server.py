@@ -0,0 +1,55 @@
+import threading
+from werkzeug.test import Client
+from bender_mc.server import PriorityLaneDispatcher
+
+
+class BlockingApp(object):
+
+    """WSGI app holding bulk requests until `release` is set."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.entered = threading.Semaphore(0)
+
+    def __call__(self, environ, start_response):
+        if environ["PATH_INFO"].startswith("/slots"):
+            self.entered.release()
+            self.release.wait(5)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"ok"]
+
+
+def test_bulk_lane_full_rejects_without_waiting():
+    app = BlockingApp()
+    client = Client(PriorityLaneDispatcher(app, bulk_threads=2))
+    threads = [
+        threading.Thread(target=lambda: client.get("/slots/movies").close())
+        for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        assert app.entered.acquire(timeout=5)
+    response = client.get("/slots/movies")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    response.close()
+    # Control requests still get through.
+    assert client.post("/api/video/player/state").status_code == 200
+    app.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert client.get("/slots/movies").status_code == 200
+
+
+def test_bulk_lane_released_on_error():
+    def failing(environ, start_response):
+        raise RuntimeError()
+
+    lanes = PriorityLaneDispatcher(failing, bulk_threads=1)
+    client = Client(lanes)
+    for _ in range(2):
+        try:
+            client.get("/slots/movies")
+        except RuntimeError:
+            pass
+    assert lanes.bulk_lane.acquire(blocking=False)